@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
 import getopt
+import signal
 import sys
+import time
 
+from pythales.batcher import PinBlockBatcher
+from pythales.handoff import take_over
 from pythales.hsm import HSM
+from pythales.keys import read_key_inventory
+from pythales.memo import ResponseMemo
+from pythales.model import PerformanceModel, parse_service_times
+from pythales.profiler import Profiler
+from pythales.ring import AffinityDispatcher, RingDispatcher
+from pythales.scheduler import Scheduler, parse_class_limits
 
 def show_help(name):
     """
@@ -12,11 +22,33 @@ def show_help(name):
     print('Usage: python3 {} [OPTIONS]... '.format(name))
     print('Thales HSM command simulator')
     print('  -p, --port=[PORT]\t\tTCP port to listen, 1500 by default')
+    print('  --unix=[PATH]\t\t\tListen on the unix domain socket instead of the TCP port')
+    print('  --udp\t\t\t\tListen on the UDP port, one request per datagram')
     print('  -k, --key=[KEY]\t\tTCP port to listen, 1500 by default')
     print('  -h, --header=[HEADER]\t\tmessage header, empty by default')
     print('  -d, --debug\t\t\tEnable debug mode (show CVV/PVV mismatch etc)')
     print('  -s, --skip-parity\t\t\tSkip key parity checks')
     print('  -a, --approve-all\t\t\tApprove all requests')
+    print('  -w, --batch-workers=[NUMBER]\tEvaluate XB batched commands in parallel')
+    print('  --workers=[NUMBER]\t\tProcess the requests in worker processes (shared memory transport), sequential stream server only')
+    print('  --control=[PATH]\t\tControl socket for the hot restart: the server started with the PATH of the running one\n\t\t\t\ttakes over its listening socket, the running one drains its clients and exits')
+    print('  --affinity\t\t\tRoute the requests to the workers by the key (TPK, ZPK, CVK, PVK pair) they use')
+    print('  --async\t\t\tProcess the requests of all the clients concurrently (asyncio)')
+    print('  --cps=[NUMBER]\t\tLicensed calls per second (performance model, implies --async)')
+    print('  --burst=[NUMBER]\t\tCalls allowed in a burst over the --cps limit, 1 by default')
+    print('  --service-times=[SPEC]\tService times in ms, e.g. NC=0.1,CW=uniform:2:4,*=exp:1 (implies --async)')
+    print('  --max-in-flight=[NUMBER]\tReject the requests over the limit with error 41 (implies --async)')
+    print('  --concurrency=[NUMBER]\tSchedule the requests by priority class, processing NUMBER at once (implies --async)')
+    print('  --queue-limits=[SPEC]\tPer-class queue limits, e.g. health:100,auth:1000,bulk:50')
+    print('  --deadlines=[SPEC]\t\tPer-class queueing deadlines in ms, e.g. auth:200,bulk:2000')
+    print('  --batch-window=[MICROSECONDS]\tDecrypt the PIN blocks under the same key arriving within the window in one batch (implies --async)')
+    print('  --max-batch-size=[NUMBER]\tMaximum number of the PIN blocks in a batch, 32 by default')
+    print('  --memo-size=[NUMBER]\t\tMemoize the responses to up to NUMBER repeated requests (not A0/HC)')
+    print('  --memo-ttl=[SECONDS]\t\tMemoized response lifetime, 60 seconds by default')
+    print('  --keys=[FILE]\t\t\tWarm up the key cache with the keys of the key inventory file before listening')
+    print('  --profile\t\t\tShow per-stage timing percentiles on exit')
+    print('  --profile-command=[CODE]\tWrite cProfile statistics of the command processing, e.g. --profile-command=CW')
+    print('  --profile-output=[FILE]\tcProfile statistics file, hsm.pstats by default')
 
 
 if __name__ == '__main__':
@@ -26,8 +58,30 @@ if __name__ == '__main__':
     debug = False
     skip_parity = None
     approve_all = None
+    batch_workers = None
+    workers = None
+    profile = False
+    profile_command = None
+    profile_output = 'hsm.pstats'
+    concurrent = False
+    cps = None
+    burst = 1
+    service_times = None
+    max_in_flight = None
+    concurrency = None
+    queue_limits = None
+    deadlines = None
+    batch_window = None
+    max_batch_size = 32
+    unix_path = None
+    udp = False
+    memo_size = None
+    memo_ttl = 60
+    inventory = None
+    affinity = False
+    control_path = None
 
-    optlist, args = getopt.getopt(sys.argv[1:], 'h:p:k:dsa', ['header=', 'port=', 'key=', 'debug', 'skip-parity', 'approve-all', 'help'])
+    optlist, args = getopt.getopt(sys.argv[1:], 'h:p:k:dsaw:', ['header=', 'port=', 'key=', 'debug', 'skip-parity', 'approve-all', 'batch-workers=', 'workers=', 'profile', 'profile-command=', 'profile-output=', 'async', 'cps=', 'burst=', 'service-times=', 'max-in-flight=', 'concurrency=', 'queue-limits=', 'deadlines=', 'batch-window=', 'max-batch-size=', 'unix=', 'udp', 'memo-size=', 'memo-ttl=', 'keys=', 'affinity', 'control=', 'help'])
     for opt, arg in optlist:
         if opt in ('-h', '--header'):
             header = arg
@@ -37,6 +91,26 @@ if __name__ == '__main__':
             except ValueError:
                 print('Invalid TCP port: {}'.format(arg))
                 sys.exit()
+        elif opt == '--unix':
+            unix_path = arg
+        elif opt == '--udp':
+            udp = True
+        elif opt in ('--memo-size', '--memo-ttl'):
+            try:
+                value = int(arg)
+            except ValueError:
+                print('Invalid {} value: {}'.format(opt, arg))
+                sys.exit()
+            if opt == '--memo-size':
+                memo_size = value
+            else:
+                memo_ttl = value
+        elif opt == '--keys':
+            try:
+                inventory = read_key_inventory(arg)
+            except OSError as err:
+                print('Invalid key inventory file: {}'.format(err))
+                sys.exit()
         elif opt in ('-k', '--key'):
             key = arg
         elif opt in ('-d', '--debug'):
@@ -45,9 +119,158 @@ if __name__ == '__main__':
             skip_parity = True
         elif opt in ('-a', '--approve-all'):
             approve_all = True
+        elif opt in ('-w', '--batch-workers'):
+            try:
+                batch_workers = int(arg)
+            except ValueError:
+                print('Invalid number of batch workers: {}'.format(arg))
+                sys.exit()
+        elif opt == '--workers':
+            try:
+                workers = int(arg)
+            except ValueError:
+                print('Invalid number of workers: {}'.format(arg))
+                sys.exit()
+        elif opt == '--control':
+            control_path = arg
+        elif opt == '--affinity':
+            affinity = True
+        elif opt == '--profile':
+            profile = True
+        elif opt == '--profile-command':
+            profile = True
+            profile_command = bytes(arg, 'utf-8')
+        elif opt == '--profile-output':
+            profile_output = arg
+        elif opt == '--async':
+            concurrent = True
+        elif opt in ('--batch-window', '--max-batch-size'):
+            try:
+                value = int(arg)
+            except ValueError:
+                print('Invalid {} value: {}'.format(opt, arg))
+                sys.exit()
+            if opt == '--batch-window':
+                batch_window = value
+                concurrent = True
+            else:
+                max_batch_size = value
+        elif opt == '--concurrency':
+            try:
+                concurrency = int(arg)
+            except ValueError:
+                print('Invalid concurrency: {}'.format(arg))
+                sys.exit()
+            concurrent = True
+        elif opt in ('--queue-limits', '--deadlines'):
+            try:
+                limits = parse_class_limits(arg)
+            except ValueError as err:
+                print(err)
+                sys.exit()
+            if opt == '--queue-limits':
+                queue_limits = limits
+            else:
+                deadlines = {priority: limit / 1000 for priority, limit in limits.items()}
+        elif opt in ('--cps', '--burst', '--max-in-flight'):
+            try:
+                value = int(arg)
+            except ValueError:
+                print('Invalid {} value: {}'.format(opt, arg))
+                sys.exit()
+            if opt == '--cps':
+                cps = value
+            elif opt == '--burst':
+                burst = value
+            else:
+                max_in_flight = value
+            concurrent = True
+        elif opt == '--service-times':
+            try:
+                service_times = parse_service_times(arg)
+            except ValueError as err:
+                print(err)
+                sys.exit()
+            concurrent = True
         elif opt in ( '--help'):
             show_help(sys.argv[0])
             sys.exit()
 
-    hsm = HSM(port=port, header=header, key=key, debug=debug, skip_parity=skip_parity, approve_all=approve_all)
-    hsm.run()
+    if workers and (concurrent or udp):
+        # The worker processes are used by the sequential stream server only
+        print('--workers can not be combined with --udp or with the concurrent server options (--async, --cps, --burst, --service-times, --max-in-flight, --concurrency, --batch-window)')
+        sys.exit()
+    if affinity and not workers:
+        print('--affinity requires --workers')
+        sys.exit()
+
+    profiler = Profiler(command_code=profile_command) if profile else None
+
+    dispatcher = None
+    if workers:
+        dispatcher_class = AffinityDispatcher if affinity else RingDispatcher
+        dispatcher = dispatcher_class(workers=workers, header=header, key=key, debug=debug, skip_parity=skip_parity, approve_all=approve_all, batch_workers=batch_workers, inventory=inventory)
+        dispatcher.start()
+
+    model = None
+    if cps or service_times or max_in_flight:
+        model = PerformanceModel(cps=cps, burst=burst, service_times=service_times, max_in_flight=max_in_flight)
+
+    scheduler = None
+    if concurrency:
+        scheduler = Scheduler(concurrency=concurrency, queue_limits=queue_limits, deadlines=deadlines)
+
+    batcher = None
+    if batch_window is not None:
+        batcher = PinBlockBatcher(window=batch_window, max_batch_size=max_batch_size)
+
+    memo = None
+    if memo_size:
+        memo = ResponseMemo(size=memo_size, ttl=memo_ttl)
+
+    hsm = HSM(port=port, header=header, key=key, debug=debug, skip_parity=skip_parity, approve_all=approve_all, batch_workers=batch_workers, profiler=profiler, dispatcher=dispatcher, model=model, scheduler=scheduler, batcher=batcher, unix_path=unix_path, udp=udp, memo=memo, control_path=control_path)
+    # SIGUSR1 toggles the debug mode, SIGUSR2 toggles approving all the requests
+    signal.signal(signal.SIGUSR1, lambda signum, frame: hsm.reload(debug=not hsm.debug))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: hsm.reload(approve_all=not hsm.approve_all))
+
+    if inventory:
+        started = time.perf_counter()
+        invalid = hsm.warm_up(inventory)
+        print('Key inventory: {} keys warmed up in {:.1f}ms, {} invalid'.format(len(inventory), (time.perf_counter() - started) * 1000, len(invalid)))
+        for line_number, key_type, key, reason in invalid:
+            print('  line {}: {} {}: {}'.format(line_number, key_type, key.decode('utf-8', 'replace'), reason))
+
+    # The listening socket is taken over from the running server once the keys are warmed up and the workers are started,
+    # as the running server stops accepting the connections when it hands the socket over
+    if control_path:
+        try:
+            hsm.listener = take_over(control_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # No server running on the control socket
+            pass
+        except OSError as err:
+            print('Error taking over the listening socket: {}'.format(err))
+            sys.exit()
+
+    try:
+        if concurrent:
+            hsm.run_async()
+        else:
+            hsm.run()
+    except KeyboardInterrupt:
+        pass
+
+    # Stopped by the user or drained after the hot restart
+    if dispatcher:
+        if affinity:
+            print(dispatcher.report())
+        dispatcher.stop()
+    if batcher:
+        print(batcher.report())
+    if memo:
+        print(memo.report())
+    if profiler:
+        print(profiler.report())
+        if profile_command:
+            profiler.dump_stats(profile_output)
+            print('cProfile statistics written to {}'.format(profile_output))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import getopt
+import sys
+import time
+
+from multiprocessing import Process, Queue
+
+from pythales.hsm import HSM, parse_message, parse_request
+from pythales.ring import RingDispatcher
+
+
+def show_help(name):
+    """
+    Show help and basic usage
+    """
+    print('Usage: python3 {} [OPTIONS]... '.format(name))
+    print('Compare the shared memory ring dispatch with the queue-based dispatch of the HSM requests')
+    print('  -n, --requests=[NUMBER]\tNumber of requests, 100000 by default')
+    print('  -w, --workers=[NUMBER]\tNumber of worker processes, 2 by default')
+    print('  -i, --in-flight=[NUMBER]\tNumber of requests in flight, 32 by default')
+
+
+def run_queue_worker(requests, responses):
+    """
+    Queue-based worker: the parsed requests and the responses are pickled to pass them between the processes
+    """
+    hsm = HSM(header='SSSS')
+    while True:
+        tag, request = requests.get()
+        if request is None:
+            break
+        responses.put((tag, hsm.get_response(request)))
+
+
+def benchmark_queue(frames, workers, in_flight):
+    requests = Queue()
+    responses = Queue()
+    processes = [Process(target=run_queue_worker, args=(requests, responses), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    started = time.perf_counter()
+    sent = received = 0
+    while received < len(frames):
+        while sent < len(frames) and sent - received < in_flight:
+            command_code, command_data = parse_message(frames[sent], header=b'SSSS')
+            requests.put((sent, parse_request(command_code, command_data)))
+            sent += 1
+        tag, response = responses.get()
+        response.build()
+        received += 1
+    elapsed = time.perf_counter() - started
+
+    for process in processes:
+        requests.put((None, None))
+    for process in processes:
+        process.join()
+    return elapsed
+
+
+def benchmark_ring(frames, workers, in_flight):
+    dispatcher = RingDispatcher(workers=workers, slots=in_flight, header='SSSS')
+    dispatcher.start()
+
+    started = time.perf_counter()
+    sent = received = 0
+    while received < len(frames):
+        while sent < len(frames) and sent - received < in_flight:
+            dispatcher.submit(sent, frames[sent])
+            sent += 1
+        dispatcher.collect()
+        received += 1
+    elapsed = time.perf_counter() - started
+
+    dispatcher.stop()
+    return elapsed
+
+
+if __name__ == '__main__':
+    number = 100000
+    workers = 2
+    in_flight = 32
+
+    optlist, args = getopt.getopt(sys.argv[1:], 'n:w:i:', ['requests=', 'workers=', 'in-flight=', 'help'])
+    for opt, arg in optlist:
+        if opt in ('-n', '--requests'):
+            number = int(arg)
+        elif opt in ('-w', '--workers'):
+            workers = int(arg)
+        elif opt in ('-i', '--in-flight'):
+            in_flight = int(arg)
+        elif opt in ('--help'):
+            show_help(sys.argv[0])
+            sys.exit()
+
+    commands = [
+        b'\x00\x06SSSSNC',
+        b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453',
+    ]
+    frames = [commands[i % len(commands)] for i in range(number)]
+
+    for name, benchmark in (('queue', benchmark_queue), ('shared memory ring', benchmark_ring)):
+        elapsed = benchmark(frames, workers, in_flight)
+        print('{}: {} requests in {:.3f}s, {:.0f} requests/s'.format(name.ljust(18, ' '), number, elapsed, number / elapsed))
@@ -0,0 +1,101 @@
+import asyncio
+
+from Crypto.Cipher import DES3
+
+
+class Batch():
+    """
+    PIN blocks collected for the same key, with the futures of the waiting requests and the times they were queued
+    """
+    def __init__(self, timer):
+        self.pinblocks = []
+        self.futures = []
+        self.queued = []
+        self.timer = timer
+
+
+class PinBlockBatcher():
+    """
+    Micro-batching of the PIN block decryption in the concurrent server.
+
+    The PIN blocks to be decrypted under the same key are collected for up to window microseconds
+    (or until max_batch_size of them are collected) and decrypted by a single multi-block ECB operation,
+    then the decrypted PIN blocks are passed back to the waiting requests.
+    """
+    def __init__(self, window=200, max_batch_size=32):
+        self.window = window / 1000000
+        self.max_batch_size = max_batch_size
+        self.pending = {}
+
+        self.batches = 0
+        self.requests = 0
+        self.max_size = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+
+    async def decrypt(self, key, pinblock):
+        """
+        Decrypt the raw PIN block under the clear key. Return None if the key can not be used
+        """
+        loop = asyncio.get_running_loop()
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = Batch(loop.call_later(self.window, self._flush, key))
+
+        future = loop.create_future()
+        batch.pinblocks.append(pinblock)
+        batch.futures.append(future)
+        batch.queued.append(loop.time())
+        if len(batch.pinblocks) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+
+    def _flush(self, key):
+        """
+        Decrypt the collected PIN blocks and wake up the waiting requests
+        """
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+
+        try:
+            decrypted = DES3.new(key, DES3.MODE_ECB).decrypt(b''.join(batch.pinblocks))
+        except ValueError:
+            decrypted = None
+
+        now = asyncio.get_running_loop().time()
+        size = len(batch.futures)
+        self.batches += 1
+        self.requests += size
+        self.max_size = max(self.max_size, size)
+        for i, (future, queued) in enumerate(zip(batch.futures, batch.queued)):
+            self.wait_time += now - queued
+            self.max_wait_time = max(self.max_wait_time, now - queued)
+            if not future.done():
+                future.set_result(decrypted[i * 8:i * 8 + 8] if decrypted else None)
+
+
+    def get_metrics(self):
+        """
+        Get the batch size and the wait time (in microseconds) metrics
+        """
+        return {
+            'batches': self.batches,
+            'requests': self.requests,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0,
+            'max_batch_size': self.max_size,
+            'mean_wait_time': self.wait_time * 1000000 / self.requests if self.requests else 0,
+            'max_wait_time': self.max_wait_time * 1000000,
+        }
+
+
+    def report(self):
+        """
+        Get the metrics as text
+        """
+        metrics = self.get_metrics()
+        return 'PIN block batches: {batches}, requests: {requests}, batch size mean/max: {mean_batch_size:.1f}/{max_batch_size}, ' \
+            'wait time mean/max: {mean_wait_time:.0f}/{max_wait_time:.0f}us'.format(**metrics)
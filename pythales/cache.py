@@ -0,0 +1,55 @@
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+    """
+    Bounded cache discarding the least recently used entries. The cache is shared by the threads evaluating
+    the batched commands, so the lookups and the updates are serialized by the lock
+    """
+    def __init__(self, size=1024):
+        super().__init__()
+        self.size = size
+        self.lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        """
+        Get the cached value and mark it as the most recently used
+        """
+        with self.lock:
+            try:
+                value = self[key]
+            except KeyError:
+                return default
+            self.move_to_end(key)
+            return value
+
+
+    def set(self, key, value):
+        """
+        Cache the value, discarding the least recently used one if the cache is full
+        """
+        with self.lock:
+            self[key] = value
+            self.move_to_end(key)
+            if len(self) > self.size:
+                self.popitem(last=False)
+
+
+    def discard(self, key, value=None):
+        """
+        Discard the cached value of the key. If the value is given, it is discarded only if it is still the cached one
+        """
+        with self.lock:
+            if key in self and (value is None or self[key] is value):
+                del self[key]
+
+
+    def clear(self):
+        """
+        Discard all the cached values
+        """
+        with self.lock:
+            super().clear()
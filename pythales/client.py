@@ -0,0 +1,562 @@
+import asyncio
+import queue
+import socket
+import struct
+
+from collections import deque
+
+
+MAX_MESSAGE_LENGTH = 0xFFFF
+
+
+def _to_bytes(value):
+    """
+    Get the field value as bytes (str values are encoded)
+    """
+    return value.encode('utf-8') if isinstance(value, str) else bytes(value)
+
+
+def build_a0(mode, key_type, key_scheme, zmk=None, zmk_flag=None):
+    """
+    A0 - Generate a Key. The ZMK (or TMK, with zmk_flag) is used in mode 1 to export the key
+    """
+    data = [b'A0', _to_bytes(mode), _to_bytes(key_type), _to_bytes(key_scheme)]
+    if zmk_flag is not None:
+        data += [b';', _to_bytes(zmk_flag)]
+    if zmk is not None:
+        data.append(_to_bytes(zmk))
+    return b''.join(data)
+
+
+def build_bu(key_type_code, key_length_flag, key):
+    """
+    BU - Generate a Key check value
+    """
+    return b''.join([b'BU', _to_bytes(key_type_code), _to_bytes(key_length_flag), _to_bytes(key)])
+
+
+def build_ca(tpk, destination_key, maximum_pin_length, pinblock, source_format, destination_format, account_number):
+    """
+    CA - Translate PIN from TPK to ZPK
+    """
+    return b''.join([b'CA', _to_bytes(tpk), _to_bytes(destination_key), _to_bytes(maximum_pin_length), _to_bytes(pinblock),
+        _to_bytes(source_format), _to_bytes(destination_format), _to_bytes(account_number)])
+
+
+def build_cw(cvk, pan, expiry_date, service_code):
+    """
+    CW - Generate a Card Verification Code
+    """
+    return b''.join([b'CW', _to_bytes(cvk), _to_bytes(pan), b';', _to_bytes(expiry_date), _to_bytes(service_code)])
+
+
+def build_cy(cvk, cvv, pan, expiry_date, service_code):
+    """
+    CY - Verify CVV/CSC
+    """
+    return b''.join([b'CY', _to_bytes(cvk), _to_bytes(cvv), _to_bytes(pan), b';', _to_bytes(expiry_date), _to_bytes(service_code)])
+
+
+def build_da(tpk, pvk, maximum_pin_length, pinblock, pinblock_format, check_length, account_number, decimalization_table,
+        pin_validation_data, offset):
+    """
+    DA - Verify PIN using IBM offset method
+    """
+    return b''.join([b'DA', _to_bytes(tpk), _to_bytes(pvk), _to_bytes(maximum_pin_length), _to_bytes(pinblock),
+        _to_bytes(pinblock_format), _to_bytes(check_length), _to_bytes(account_number), _to_bytes(decimalization_table),
+        _to_bytes(pin_validation_data), _to_bytes(offset)])
+
+
+def build_dc(tpk, pvk, pinblock, pinblock_format, account_number, pvki, pvv):
+    """
+    DC - Verify PIN
+    """
+    return b''.join([b'DC', _to_bytes(tpk), _to_bytes(pvk), _to_bytes(pinblock), _to_bytes(pinblock_format),
+        _to_bytes(account_number), _to_bytes(pvki), _to_bytes(pvv)])
+
+
+def build_de(pvk, pin, check_length, account_number, decimalization_table, pin_validation_data):
+    """
+    DE - Generate an IBM PIN Offset
+    """
+    return b''.join([b'DE', _to_bytes(pvk), _to_bytes(pin), _to_bytes(check_length), _to_bytes(account_number),
+        _to_bytes(decimalization_table), _to_bytes(pin_validation_data)])
+
+
+def build_ea(zpk, pvk, maximum_pin_length, pinblock, pinblock_format, check_length, account_number, decimalization_table,
+        pin_validation_data, offset):
+    """
+    EA - Verify interchange PIN using IBM offset method
+    """
+    return b''.join([b'EA', _to_bytes(zpk), _to_bytes(pvk), _to_bytes(maximum_pin_length), _to_bytes(pinblock),
+        _to_bytes(pinblock_format), _to_bytes(check_length), _to_bytes(account_number), _to_bytes(decimalization_table),
+        _to_bytes(pin_validation_data), _to_bytes(offset)])
+
+
+def build_ec(zpk, pvk, pinblock, pinblock_format, account_number, pvki, pvv):
+    """
+    EC - Verify an Interchange PIN using ABA PVV method
+    """
+    return b''.join([b'EC', _to_bytes(zpk), _to_bytes(pvk), _to_bytes(pinblock), _to_bytes(pinblock_format),
+        _to_bytes(account_number), _to_bytes(pvki), _to_bytes(pvv)])
+
+
+def build_ee(pvk, offset, minimum_pin_length, account_number, decimalization_table, pin_validation_data):
+    """
+    EE - Derive a PIN using the IBM offset method
+    """
+    return b''.join([b'EE', _to_bytes(pvk), _to_bytes(offset), _to_bytes(minimum_pin_length), _to_bytes(account_number),
+        _to_bytes(decimalization_table), _to_bytes(pin_validation_data)])
+
+
+def build_fa(zmk, zpk):
+    """
+    FA - Translate a ZPK from ZMK to LMK
+    """
+    return b''.join([b'FA', _to_bytes(zmk), _to_bytes(zpk)])
+
+
+def build_g0(bdk, zpk, ksn_descriptor, ksn, pinblock, destination_format, account_number):
+    """
+    G0 - Translate a PIN from BDK to ZPK encryption (3DES DUKPT)
+    """
+    return b''.join([b'G0', _to_bytes(bdk), _to_bytes(zpk), _to_bytes(ksn_descriptor), _to_bytes(ksn), _to_bytes(pinblock),
+        _to_bytes(destination_format), _to_bytes(account_number)])
+
+
+def build_gq(bdk, pvk, ksn_descriptor, ksn, pinblock, account_number, pvki, pvv):
+    """
+    GQ - Verify a PIN using the ABA PVV method (3DES DUKPT)
+    """
+    return b''.join([b'GQ', _to_bytes(bdk), _to_bytes(pvk), _to_bytes(ksn_descriptor), _to_bytes(ksn), _to_bytes(pinblock),
+        _to_bytes(account_number), _to_bytes(pvki), _to_bytes(pvv)])
+
+
+def build_hc(current_key, tmk_key_scheme='U', lmk_key_scheme='U'):
+    """
+    HC - Generate a TMK, TPK or PVK
+    """
+    return b''.join([b'HC', _to_bytes(current_key), b';', _to_bytes(tmk_key_scheme), _to_bytes(lmk_key_scheme)])
+
+
+def build_j2():
+    """
+    J2 - Get HSM Loading
+    """
+    return b'J2'
+
+
+def build_j4():
+    """
+    J4 - Get Host Command Volumes
+    """
+    return b'J4'
+
+
+def build_j8():
+    """
+    J8 - Get Health Check Accumulated Counts
+    """
+    return b'J8'
+
+
+def build_kq(mode_flag, scheme_id, mk_ac, pan_psn, atc, unpredictable_number, transaction_data, arqc, arc=None):
+    """
+    KQ - ARQC Verification and/or ARPC Generation. The transaction data is hex-encoded, the ARC is sent in modes 1 and 2
+    """
+    transaction_data = _to_bytes(transaction_data)
+    data = [b'KQ', _to_bytes(mode_flag), _to_bytes(scheme_id), _to_bytes(mk_ac), _to_bytes(pan_psn), _to_bytes(atc),
+        _to_bytes(unpredictable_number), '{:02X}'.format(len(transaction_data) // 2).encode('utf-8'), transaction_data,
+        b';', _to_bytes(arqc)]
+    if arc is not None:
+        data.append(_to_bytes(arc))
+    return b''.join(data)
+
+
+def _build_message_command(command_code, flags, key_type, key, iv, message):
+    """
+    Build the M0/M2/M6/M8 command: the flags, the key type and the key, the IV (if any) and the length-prefixed message
+    """
+    message = _to_bytes(message)
+    data = [command_code] + [_to_bytes(flag) for flag in flags] + [_to_bytes(key_type), _to_bytes(key)]
+    if iv is not None:
+        data.append(_to_bytes(iv))
+    data += ['{:04X}'.format(len(message)).encode('utf-8'), message]
+    return b''.join(data)
+
+
+def build_m0(mode_flag, input_format, output_format, key_type, key, message, iv=None):
+    """
+    M0 - Encrypt Data Block. The IV is sent in mode 01 (CBC)
+    """
+    return _build_message_command(b'M0', [mode_flag, input_format, output_format], key_type, key, iv, message)
+
+
+def build_m2(mode_flag, input_format, output_format, key_type, key, message, iv=None):
+    """
+    M2 - Decrypt Data Block. The IV is sent in mode 01 (CBC)
+    """
+    return _build_message_command(b'M2', [mode_flag, input_format, output_format], key_type, key, iv, message)
+
+
+def build_m6(mode_flag, input_format, mac_size, mac_algorithm, padding_method, key_type, key, message, iv=None):
+    """
+    M6 - Generate MAC. The IV is sent in modes 2 and 3
+    """
+    return _build_message_command(b'M6', [mode_flag, input_format, mac_size, mac_algorithm, padding_method], key_type, key,
+        iv, message)
+
+
+def build_m8(mode_flag, input_format, mac_size, mac_algorithm, padding_method, key_type, key, message, mac, iv=None):
+    """
+    M8 - Verify MAC. The IV is sent in modes 2 and 3
+    """
+    return _build_message_command(b'M8', [mode_flag, input_format, mac_size, mac_algorithm, padding_method], key_type, key,
+        iv, message) + _to_bytes(mac)
+
+
+def build_nc():
+    """
+    NC - Diagnostics data
+    """
+    return b'NC'
+
+
+def build_xb(commands):
+    """
+    XB - Batch of commands, each command is sent with its length
+    """
+    if not 0 < len(commands) <= 999:
+        raise ValueError('Number of commands {} is out of range'.format(len(commands)))
+    data = [b'XB', '{:03d}'.format(len(commands)).encode('utf-8')]
+    for command in commands:
+        command = _to_bytes(command)
+        if len(command) > 0xFFFF:
+            raise ValueError('Command of length {} is too long'.format(len(command)))
+        data += ['{:04X}'.format(len(command)).encode('utf-8'), command]
+    return b''.join(data)
+
+
+def build_xv(cvk, pan, expiry_date, service_code, variants):
+    """
+    XV - Generate Card Verification Values
+    """
+    return b''.join([b'XV', _to_bytes(cvk), _to_bytes(pan), b';', _to_bytes(expiry_date), _to_bytes(service_code),
+        _to_bytes(variants)])
+
+
+class FrameWriter():
+    """
+    Preallocated buffer the framed commands (the 2-byte length, the header and the command) are written to,
+    so that many pipelined commands are sent by a single send call without building the intermediate bytes objects
+    """
+    def __init__(self, header=b'', size=65536):
+        self.header = header
+        self.buffer = bytearray(max(size, 2 + MAX_MESSAGE_LENGTH))
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+
+    def add(self, command):
+        """
+        Add the framed command to the buffer. Return False if the buffer has no room for it
+        """
+        header = self.header
+        message_length = len(header) + len(command)
+        if message_length > MAX_MESSAGE_LENGTH:
+            raise ValueError('Command of length {} is too long'.format(len(command)))
+
+        end = self.length + 2 + message_length
+        if end > len(self.buffer):
+            return False
+
+        offset = self.length
+        struct.pack_into('!H', self.buffer, offset, message_length)
+        offset += 2
+        self.view[offset:offset + len(header)] = header
+        offset += len(header)
+        self.view[offset:end] = command
+        self.length = end
+        return True
+
+
+    def getvalue(self):
+        """
+        Get the view of the framed commands
+        """
+        return self.view[:self.length]
+
+
+    def clear(self):
+        """
+        """
+        self.length = 0
+
+
+class FrameReader():
+    """
+    Read the framed responses into the preallocated buffer
+    """
+    def __init__(self, sock, header=b''):
+        self.sock = sock
+        self.header_length = len(header)
+        self.buffer = bytearray(2 + MAX_MESSAGE_LENGTH)
+        self.view = memoryview(self.buffer)
+        self.received = 0
+
+
+    def read(self):
+        """
+        Read the next response, return the response data without the length and the header
+        """
+        buf = self.view
+        while True:
+            if self.received >= 2:
+                length = 2 + struct.unpack_from('!H', buf)[0]
+                if self.received >= length:
+                    data = bytes(buf[2 + self.header_length:length])
+                    self.received -= length
+                    buf[:self.received] = buf[length:length + self.received]
+                    return data
+
+            received = self.sock.recv_into(buf[self.received:])
+            if not received:
+                raise ConnectionError('Connection closed by the HSM')
+            self.received += received
+
+
+class Connection():
+    """
+    Connection to the HSM with its own framing buffers
+    """
+    def __init__(self, host, port, header=b'', timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.writer = FrameWriter(header)
+        self.reader = FrameReader(self.sock, header)
+
+
+    def send(self, commands):
+        """
+        Send the commands, return the number of the commands sent (as many as fit the framing buffer)
+        """
+        writer = self.writer
+        writer.clear()
+        sent = 0
+        for command in commands:
+            if not writer.add(command):
+                break
+            sent += 1
+        self.sock.sendall(writer.getvalue())
+        return sent
+
+
+    def close(self):
+        """
+        """
+        self.sock.close()
+
+
+class Client():
+    """
+    Blocking HSM client with a pool of connections, safe to share between threads.
+
+    call() sends a command and waits for its response, call_many() pipelines the commands over one connection,
+    keeping up to depth commands in flight. The HSM answers the commands of a connection in order, so the responses
+    are correlated with the commands by their position. The responses are returned without the length and the header,
+    e.g. b'ND00...'
+    """
+    def __init__(self, host='127.0.0.1', port=1500, header=b'', pool_size=4, timeout=None):
+        self.host = host
+        self.port = port
+        self.header = _to_bytes(header)
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(pool_size)
+        self.connections = []
+
+
+    def _get_connection(self):
+        """
+        Get the idle connection from the pool or open a new one
+        """
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            connection = Connection(self.host, self.port, self.header, self.timeout)
+            self.connections.append(connection)
+            return connection
+
+
+    def _put_connection(self, connection):
+        """
+        Return the connection to the pool, closing it if the pool is full
+        """
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+            self.connections.remove(connection)
+
+
+    def call(self, command):
+        """
+        Send the command, return the response
+        """
+        return self.call_many([command])[0]
+
+
+    def call_many(self, commands, depth=64):
+        """
+        Send the commands pipelined, return the list of the responses in the order of the commands
+        """
+        connection = self._get_connection()
+        try:
+            responses = []
+            sent = 0
+            while len(responses) < len(commands):
+                in_flight = sent - len(responses)
+                if sent < len(commands) and in_flight <= depth // 2:
+                    sent += connection.send(commands[sent:sent + depth - in_flight])
+                    continue
+                responses.append(connection.reader.read())
+        except BaseException:
+            # The connection state is unknown
+            connection.close()
+            self.connections.remove(connection)
+            raise
+
+        self._put_connection(connection)
+        return responses
+
+
+    def close(self):
+        """
+        Close all the connections
+        """
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.pool = queue.LifoQueue(self.pool.maxsize)
+
+
+class AsyncConnection():
+    """
+    asyncio connection to the HSM: the responses are read by the reader task and passed to the pending futures in order.
+    Once the connection is closed, the pending futures fail with ConnectionError
+    """
+    def __init__(self, reader, writer, header):
+        self.reader = reader
+        self.writer = writer
+        self.header = header
+        self.pending = deque()
+        self.closed = False
+        self.task = asyncio.ensure_future(self._read_responses())
+
+
+    async def _read_responses(self):
+        """
+        """
+        header_length = len(self.header)
+        error = None
+        try:
+            while True:
+                length = await self.reader.readexactly(2)
+                data = await self.reader.readexactly(struct.unpack('!H', length)[0])
+                self.pending.popleft().set_result(data[header_length:])
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            error = err
+        except IndexError:
+            error = ConnectionError('Unexpected response from the HSM')
+        finally:
+            self.closed = True
+            while self.pending:
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection closed: {}'.format(error)))
+            if error is not None:
+                self.writer.close()
+
+
+    def send(self, command):
+        """
+        Send the command, return the future of its response. Raises ConnectionError if the connection is closed
+        """
+        if self.closed:
+            raise ConnectionError('Connection closed')
+        message_length = len(self.header) + len(command)
+        if message_length > MAX_MESSAGE_LENGTH:
+            raise ValueError('Command of length {} is too long'.format(len(command)))
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(b''.join((struct.pack('!H', message_length), self.header, command)))
+        return future
+
+
+    async def close(self):
+        """
+        """
+        self.closed = True
+        self.writer.close()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class AsyncClient():
+    """
+    asyncio HSM client with a pool of connections. The commands are pipelined: call() sends the command
+    over the connection with the fewest responses pending and awaits its response
+    """
+    def __init__(self, host='127.0.0.1', port=1500, header=b'', pool_size=4):
+        self.host = host
+        self.port = port
+        self.header = _to_bytes(header)
+        self.pool_size = pool_size
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+
+    async def _get_connection(self):
+        """
+        Get the connection with the fewest responses pending, opening a new one while the pool is not full.
+        The connections closed by the HSM are removed from the pool
+        """
+        self.connections = [connection for connection in self.connections if not connection.closed]
+        if len(self.connections) < self.pool_size:
+            async with self.lock:
+                if len(self.connections) < self.pool_size:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                    connection = AsyncConnection(reader, writer, self.header)
+                    self.connections.append(connection)
+                    return connection
+        return min(self.connections, key=lambda connection: len(connection.pending))
+
+
+    async def call(self, command):
+        """
+        Send the command, return the response
+        """
+        connection = await self._get_connection()
+        future = connection.send(command)
+        if connection.writer.transport.get_write_buffer_size() > 65536:
+            await connection.writer.drain()
+        return await future
+
+
+    async def call_many(self, commands):
+        """
+        Send the commands, return the list of the responses in the order of the commands
+        """
+        return await asyncio.gather(*[self.call(command) for command in commands])
+
+
+    async def close(self):
+        """
+        Close all the connections
+        """
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
@@ -0,0 +1,84 @@
+from binascii import hexlify
+from Crypto.Cipher import DES, DES3
+
+from pythales.des import encrypt_blocks
+from pythales.dukpt import xor_bytes
+
+
+# Service codes of the CVV variants: the card verification value of the magnetic stripe is calculated
+# with the service code of the card
+CVV2_SERVICE_CODE = b'000'
+ICVV_SERVICE_CODE = b'999'
+
+DECIMAL_DIGITS = b'0123456789'
+HEX_LETTERS = bytes.maketrans(b'ABCDEF', b'012345')
+
+
+def get_digits(data, length=3):
+    """
+    Extract the decimal digits from the hex-encoded data: the decimal digits are taken from left to right,
+    then, if there is not enough of them, the hex letters converted to decimal digits by subtracting 10
+    """
+    digits = data.translate(None, b'ABCDEF')
+    if len(digits) < length:
+        digits += data.translate(HEX_LETTERS, DECIMAL_DIGITS)
+    return digits[:length]
+
+
+class CVV():
+    """
+    Visa CVV calculation with the double length CVK. The key schedules of the CVK are prepared once and shared
+    by all the values calculated with the CVK, the encrypted first block of the card data (the PAN) is shared
+    by the variants of the same card.
+    """
+    def __init__(self, cvk):
+        if len(cvk) != 16:
+            raise ValueError('Incorrect key length')
+        self.des = DES.new(cvk[:8], DES.MODE_ECB)
+        self.des3 = DES3.new(cvk, DES3.MODE_ECB)
+
+
+    def get_cvvs(self, pan, expiry_date, service_codes):
+        """
+        Get the CVVs of the card for the list of the service codes
+        """
+        encrypted_blocks = {}
+        cvvs = []
+        for service_code in service_codes:
+            data = (pan + expiry_date + service_code).ljust(32, b'0')
+            block1, block2 = bytes.fromhex(data[:16].decode('utf-8')), bytes.fromhex(data[16:32].decode('utf-8'))
+
+            encrypted_block = encrypted_blocks.get(block1)
+            if encrypted_block is None:
+                encrypted_block = encrypted_blocks[block1] = self.des.encrypt(block1)
+
+            cvvs.append(get_digits(hexlify(self.des3.encrypt(xor_bytes(encrypted_block, block2))).upper()))
+        return cvvs
+
+
+    def get_cvv(self, pan, expiry_date, service_code):
+        """
+        Get the CVV of the card
+        """
+        return self.get_cvvs(pan, expiry_date, [service_code])[0]
+
+
+def get_visa_cvvs(cards):
+    """
+    Get the CVVs of the batch of the cards, the list of (CVK, PAN, expiry date, service code) with the raw double length CVKs.
+    All the first blocks and then all the second blocks are encrypted by a single call each
+    """
+    cvks, blocks1, blocks2 = [], [], []
+    for cvk, pan, expiry_date, service_code in cards:
+        if len(cvk) != 16:
+            raise ValueError('Incorrect key length')
+        data = bytes.fromhex((pan + expiry_date + service_code).ljust(32, b'0').decode('utf-8'))
+        cvks.append(cvk)
+        blocks1.append(data[:8])
+        blocks2.append(data[8:16])
+    if not cvks:
+        return []
+
+    encrypted = encrypt_blocks([cvk[:8] for cvk in cvks], b''.join(blocks1))
+    encrypted = hexlify(encrypt_blocks(cvks, xor_bytes(encrypted, b''.join(blocks2)))).upper()
+    return [get_digits(encrypted[i:i + 16]) for i in range(0, len(encrypted), 16)]
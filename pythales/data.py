@@ -0,0 +1,69 @@
+from binascii import hexlify, unhexlify
+from Crypto.Cipher import DES, DES3
+
+from pythales.mac import CHUNK_SIZE
+
+
+MODE_ECB = 0
+MODE_CBC = 1
+
+
+class DataCipher():
+    """
+    Encryption and decryption of the data in ECB or CBC mode with the single, double or triple length DES key.
+
+    The data is processed in chunks: each chunk of the input (any bytes-like object, hex-encoded if hex_input is set)
+    is encrypted or decrypted by the cipher directly into the preallocated output buffer. If hex_output is set, the chunk
+    is encrypted or decrypted into the preallocated chunk buffer and hex-encoded into the output buffer.
+    In CBC mode the cipher keeps the chaining state between the calls, so a long message may be processed part by part.
+    """
+    def __init__(self, key, mode=MODE_ECB, iv=None, decrypt=False):
+        if mode not in [MODE_ECB, MODE_CBC]:
+            raise ValueError('Unsupported cipher mode: {}'.format(mode))
+
+        self.mode = mode
+        self.decrypt = decrypt
+        self.iv = iv if iv else b'\x00' * 8
+
+        algorithm = DES if len(key) == 8 else DES3
+        if mode == MODE_CBC:
+            cipher = algorithm.new(key, algorithm.MODE_CBC, self.iv)
+        else:
+            cipher = algorithm.new(key, algorithm.MODE_ECB)
+        self.process = cipher.decrypt if decrypt else cipher.encrypt
+
+
+    def update(self, data, hex_input=False, hex_output=False):
+        """
+        Encrypt or decrypt the data, return the bytearray with the result
+        """
+        data = memoryview(data)
+        step = CHUNK_SIZE * 2 if hex_input else CHUNK_SIZE
+        length = len(data) // 2 if hex_input else len(data)
+        if length % 8 or (hex_input and len(data) % 2):
+            raise ValueError('Data length is not a multiple of 8')
+
+        output = bytearray(length * 2 if hex_output else length)
+        view = memoryview(output)
+        # The binary result of the chunk is hex-encoded into the output buffer
+        scratch = memoryview(bytearray(min(length, CHUNK_SIZE))) if hex_output else None
+        position = 0
+        for offset in range(0, len(data), step):
+            chunk = data[offset:offset + step]
+            if hex_input:
+                chunk = unhexlify(chunk)
+            if hex_output:
+                result = scratch[:len(chunk)]
+            else:
+                result = view[position:position + len(chunk)]
+            self.process(chunk, output=result)
+            if self.mode == MODE_CBC:
+                # The IV to continue with is the last block of the ciphertext
+                self.iv = bytes(chunk[-8:]) if self.decrypt else bytes(result[-8:])
+            if hex_output:
+                encoded = hexlify(result).upper()
+                view[position:position + len(encoded)] = encoded
+                position += len(encoded)
+            else:
+                position += len(chunk)
+        return output
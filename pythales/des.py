@@ -0,0 +1,278 @@
+from Crypto.Cipher import DES, DES3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# DES tables, the bit positions are numbered from 1 (the most significant bit)
+IP = [
+    58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4,
+    62, 54, 46, 38, 30, 22, 14, 6, 64, 56, 48, 40, 32, 24, 16, 8,
+    57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3,
+    61, 53, 45, 37, 29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7,
+]
+
+FP = [IP.index(position) + 1 for position in range(1, 65)]
+
+P = [
+    16, 7, 20, 21, 29, 12, 28, 17, 1, 15, 23, 26, 5, 18, 31, 10,
+    2, 8, 24, 14, 32, 27, 3, 9, 19, 13, 30, 6, 22, 11, 4, 25,
+]
+
+PC1 = [
+    57, 49, 41, 33, 25, 17, 9, 1, 58, 50, 42, 34, 26, 18,
+    10, 2, 59, 51, 43, 35, 27, 19, 11, 3, 60, 52, 44, 36,
+    63, 55, 47, 39, 31, 23, 15, 7, 62, 54, 46, 38, 30, 22,
+    14, 6, 61, 53, 45, 37, 29, 21, 13, 5, 28, 20, 12, 4,
+]
+
+PC2 = [
+    14, 17, 11, 24, 1, 5, 3, 28, 15, 6, 21, 10,
+    23, 19, 12, 4, 26, 8, 16, 7, 27, 20, 13, 2,
+    41, 52, 31, 37, 47, 55, 30, 40, 51, 45, 33, 48,
+    44, 49, 39, 56, 34, 53, 46, 42, 50, 36, 29, 32,
+]
+
+SHIFTS = [1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1]
+
+SBOXES = [
+    [14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7,
+     0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+     4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0,
+     15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13],
+    [15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10,
+     3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5,
+     0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15,
+     13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9],
+    [10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8,
+     13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1,
+     13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7,
+     1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12],
+    [7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15,
+     13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9,
+     10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4,
+     3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14],
+    [2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9,
+     14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6,
+     4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14,
+     11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3],
+    [12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11,
+     10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8,
+     9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6,
+     4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13],
+    [4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1,
+     13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6,
+     1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2,
+     6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12],
+    [13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7,
+     1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2,
+     7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8,
+     2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11],
+]
+
+
+def _permute_bits(value, table, width):
+    """
+    Permute the bits of the integer value of width bits by the table
+    """
+    result = 0
+    for position in table:
+        result = (result << 1) | ((value >> (width - position)) & 1)
+    return result
+
+
+class Tables():
+    """
+    Lookup tables of the vectorized engine: the bit permutations are done by the per-byte tables
+    (the output bits contributed by each input byte), the S-boxes are combined with the P permutation
+    """
+    def __init__(self):
+        self.ip = self._get_byte_tables(IP, 64)
+        self.fp = self._get_byte_tables(FP, 64)
+        self.pc1 = self._get_byte_tables(PC1, 64)
+        self.pc2 = self._get_byte_tables(PC2, 56)
+
+        sp = numpy.zeros((8, 64), dtype=numpy.uint64)
+        for i, sbox in enumerate(SBOXES):
+            for value in range(64):
+                row = ((value >> 4) & 2) | (value & 1)
+                column = (value >> 1) & 0xF
+                sp[i, value] = _permute_bits(sbox[row * 16 + column] << (28 - 4 * i), P, 32)
+        self.sp = sp
+
+
+    def _get_byte_tables(self, table, width):
+        """
+        Get the per-byte tables of the permutation of the value of width bits
+        """
+        values = numpy.arange(256, dtype=numpy.uint64)
+        tables = numpy.zeros((width // 8, 256), dtype=numpy.uint64)
+        for j, position in enumerate(table):
+            byte, bit = divmod(position - 1, 8)
+            tables[byte] |= ((values >> numpy.uint64(7 - bit)) & numpy.uint64(1)) << numpy.uint64(len(table) - 1 - j)
+        return tables
+
+
+_tables = None
+
+
+def _get_tables():
+    """
+    Get the lookup tables, prepared on the first use
+    """
+    global _tables
+    if _tables is None:
+        _tables = Tables()
+    return _tables
+
+
+def _permute(tables, values, width):
+    """
+    Permute the bits of the array of the values of width bits
+    """
+    result = numpy.zeros_like(values)
+    for byte, table in enumerate(tables):
+        result |= table[(values >> numpy.uint64(width - 8 - 8 * byte)) & numpy.uint64(0xFF)]
+    return result
+
+
+def _get_subkeys(keys):
+    """
+    Get the key schedules of the array of the keys: 16 rounds of 8 6-bit subkeys (one for each S-box)
+    """
+    tables = _get_tables()
+    mask = numpy.uint64(0xFFFFFFF)
+    cd = _permute(tables.pc1, keys, 64)
+    c, d = cd >> numpy.uint64(28), cd & mask
+
+    subkeys = []
+    for shift in SHIFTS:
+        left, right = numpy.uint64(shift), numpy.uint64(28 - shift)
+        c = ((c << left) | (c >> right)) & mask
+        d = ((d << left) | (d >> right)) & mask
+        subkey = _permute(tables.pc2, (c << numpy.uint64(28)) | d, 56)
+        subkeys.append([(subkey >> numpy.uint64(42 - 6 * i)) & numpy.uint64(0x3F) for i in range(8)])
+    return subkeys
+
+
+def _des(blocks, subkeys):
+    """
+    Encrypt (or decrypt, with the subkeys reversed) the array of the blocks
+    """
+    tables = _get_tables()
+    sp = tables.sp
+    mask = numpy.uint64(0x3F)
+    shifts = [numpy.uint64(28 - 4 * i) for i in range(8)]
+    one, n31, n32, n33 = numpy.uint64(1), numpy.uint64(31), numpy.uint64(32), numpy.uint64(33)
+
+    data = _permute(tables.ip, blocks, 64)
+    left, right = data >> n32, data & numpy.uint64(0xFFFFFFFF)
+    for round_subkeys in subkeys:
+        # The expansion: the 6-bit groups of the right half, extended by its last bit on the left and the first bit on the right
+        expanded = ((right & one) << n33) | (right << one) | (right >> n31)
+        f = sp[0][((expanded >> shifts[0]) & mask) ^ round_subkeys[0]]
+        for i in range(1, 8):
+            f |= sp[i][((expanded >> shifts[i]) & mask) ^ round_subkeys[i]]
+        left, right = right, left ^ f
+    return _permute(tables.fp, (right << n32) | left, 64)
+
+
+def _get_key_parts(keys, count):
+    """
+    Get the arrays of the 8-byte parts of the keys: one part for DES keys, three parts (K1, K2, K3) for triple DES keys.
+    The keys of different lengths are all extended to the triple length keys
+    """
+    lengths = {len(key) for key in keys}
+    if not lengths <= {8, 16, 24}:
+        raise ValueError('Incorrect key length')
+    if len(keys) not in (1, count):
+        raise ValueError('Expected {} keys but {} are given'.format(count, len(keys)))
+    if len(lengths) > 1:
+        keys = [(key * 3)[:24] if len(key) == 8 else (key + key)[:24] for key in keys]
+
+    parts = [numpy.frombuffer(b''.join(key[i:i + 8] for key in keys), dtype='>u8').astype(numpy.uint64) for i in range(0, len(keys[0]), 8)]
+    if len(parts) == 2:
+        parts.append(parts[0])
+    return parts
+
+
+def _crypt_blocks(keys, data, decrypt):
+    """
+    Encrypt or decrypt the blocks with the numpy engine
+    """
+    if len(data) % 8:
+        raise ValueError('Data must be aligned to the 8-byte block boundary')
+    blocks = numpy.frombuffer(data, dtype='>u8').astype(numpy.uint64)
+    parts = _get_key_parts(keys, len(blocks))
+    schedules = [_get_subkeys(part) for part in parts]
+
+    if len(schedules) == 1:
+        stages = [(schedules[0], decrypt)]
+    elif decrypt:
+        stages = [(schedules[2], True), (schedules[1], False), (schedules[0], True)]
+    else:
+        stages = [(schedules[0], False), (schedules[1], True), (schedules[2], False)]
+
+    for subkeys, reverse in stages:
+        blocks = _des(blocks, subkeys[::-1] if reverse else subkeys)
+    return blocks.astype('>u8').tobytes()
+
+
+def _get_cipher(key):
+    """
+    Get the pycryptodome cipher for the key
+    """
+    if len(key) == 8:
+        return DES.new(key, DES.MODE_ECB)
+    return DES3.new(key, DES3.MODE_ECB)
+
+
+def _crypt_blocks_pycrypto(keys, data, decrypt):
+    """
+    Encrypt or decrypt the blocks one by one with pycryptodome, the ciphers are shared by the blocks with the same key
+    """
+    if len(keys) not in (1, len(data) // 8):
+        raise ValueError('Expected {} keys but {} are given'.format(len(data) // 8, len(keys)))
+    ciphers = {}
+    result = bytearray(len(data))
+    for i in range(0, len(data), 8):
+        key = keys[i // 8] if len(keys) > 1 else keys[0]
+        cipher = ciphers.get(key)
+        if cipher is None:
+            cipher = ciphers[key] = _get_cipher(key)
+        result[i:i + 8] = cipher.decrypt(data[i:i + 8]) if decrypt else cipher.encrypt(data[i:i + 8])
+    return bytes(result)
+
+
+def crypt_blocks(keys, data, decrypt=False):
+    """
+    Encrypt (or decrypt) the 8-byte blocks of the data in ECB mode with DES (8-byte keys) or triple DES (16 or 24-byte keys).
+
+    keys is either the key of all the blocks, encrypted by a single pycryptodome call, or the list of the keys,
+    one for each block. The blocks with the different keys are processed by the vectorized numpy engine
+    if numpy is installed, or one by one with pycryptodome otherwise. Unlike pycryptodome, the numpy engine
+    does not reject the degenerate triple DES keys.
+    """
+    if isinstance(keys, (bytes, bytearray)):
+        cipher = _get_cipher(bytes(keys))
+        return cipher.decrypt(data) if decrypt else cipher.encrypt(data)
+    keys = [bytes(key) for key in keys]
+    if numpy is None:
+        return _crypt_blocks_pycrypto(keys, data, decrypt)
+    return _crypt_blocks(keys, data, decrypt)
+
+
+def encrypt_blocks(keys, data):
+    """
+    Encrypt the 8-byte blocks of the data, see crypt_blocks()
+    """
+    return crypt_blocks(keys, data)
+
+
+def decrypt_blocks(keys, data):
+    """
+    Decrypt the 8-byte blocks of the data, see crypt_blocks()
+    """
+    return crypt_blocks(keys, data, decrypt=True)
@@ -0,0 +1,130 @@
+from Crypto.Cipher import DES, DES3
+
+from pythales.cache import LRUCache
+
+
+KEY_MASK = bytes.fromhex('C0C0C0C000000000C0C0C0C000000000')
+PIN_VARIANT = bytes.fromhex('00000000000000FF00000000000000FF')
+COUNTER_BITS = 21
+COUNTER_MASK = (1 << COUNTER_BITS) - 1
+
+
+def xor_bytes(block1, block2):
+    """
+    XOR two blocks of raw binary data of the same length
+    """
+    return (int.from_bytes(block1, 'big') ^ int.from_bytes(block2, 'big')).to_bytes(len(block1), 'big')
+
+
+def get_ksn_counter(ksn):
+    """
+    Get the transaction counter (the rightmost 21 bits of the 10-byte raw KSN)
+    """
+    return int.from_bytes(ksn[-3:], 'big') & COUNTER_MASK
+
+
+def clear_ksn_counter(ksn):
+    """
+    Get the KSN with the transaction counter bits set to zero
+    """
+    return (int.from_bytes(ksn, 'big') & ~COUNTER_MASK).to_bytes(len(ksn), 'big')
+
+
+def derive_ipek(bdk, ksn):
+    """
+    Derive the initial PIN encryption key from the double length BDK and the 10-byte KSN (ANSI X9.24-1, TDES DUKPT)
+    """
+    data = clear_ksn_counter(ksn)[:8]
+    left = DES3.new(bdk, DES3.MODE_ECB).encrypt(data)
+    right = DES3.new(xor_bytes(bdk, KEY_MASK), DES3.MODE_ECB).encrypt(data)
+    return left + right
+
+
+def generate_key(key, register):
+    """
+    Non-reversible key generation process: derive the next key from the current key and the 8-byte KSN register
+    """
+    def _encrypt_register(key):
+        left, right = key[:8], key[8:]
+        return xor_bytes(DES.new(left, DES.MODE_ECB).encrypt(xor_bytes(register, right)), right)
+
+    return _encrypt_register(xor_bytes(key, KEY_MASK)) + _encrypt_register(key)
+
+
+def derive_key(ipek, ksn):
+    """
+    Derive the current transaction key from the IPEK walking the set bits of the KSN transaction counter
+    """
+    register = int.from_bytes(clear_ksn_counter(ksn)[2:], 'big')
+    counter = get_ksn_counter(ksn)
+
+    key = ipek
+    bit = 1 << (COUNTER_BITS - 1)
+    while bit:
+        if counter & bit:
+            register |= bit
+            key = generate_key(key, register.to_bytes(8, 'big'))
+        bit >>= 1
+    return key
+
+
+def get_pin_key(key):
+    """
+    Get the PIN encryption key variant of the transaction key
+    """
+    return xor_bytes(key, PIN_VARIANT)
+
+
+class DUKPT():
+    """
+    DUKPT key derivation with the bounded (LRU) caches of the derived IPEKs, per BDK and KSN with the counter cleared,
+    and of the intermediate keys on the counter bits walk. A transaction from the same terminal derives only the keys
+    for the counter bits that have changed since the previous transactions.
+    """
+    def __init__(self, cache_size=1024):
+        self.ipeks = LRUCache(cache_size)
+        self.keys = LRUCache(cache_size)
+
+
+    def get_ipek(self, bdk, ksn):
+        """
+        Get the IPEK for the clear BDK and the raw KSN
+        """
+        terminal = (bdk, clear_ksn_counter(ksn))
+        ipek = self.ipeks.get(terminal)
+        if ipek is None:
+            ipek = derive_ipek(bdk, ksn)
+            self.ipeks.set(terminal, ipek)
+        return ipek
+
+
+    def get_key(self, bdk, ksn):
+        """
+        Get the transaction key for the clear BDK and the raw KSN
+        """
+        key = self.get_ipek(bdk, ksn)
+        base_ksn = clear_ksn_counter(ksn)
+        register = int.from_bytes(base_ksn[2:], 'big')
+        counter = get_ksn_counter(ksn)
+
+        partial_counter = 0
+        bit = 1 << (COUNTER_BITS - 1)
+        while bit:
+            if counter & bit:
+                partial_counter |= bit
+                cache_key = (bdk, base_ksn, partial_counter)
+                cached = self.keys.get(cache_key)
+                if cached is None:
+                    key = generate_key(key, (register | partial_counter).to_bytes(8, 'big'))
+                    self.keys.set(cache_key, key)
+                else:
+                    key = cached
+            bit >>= 1
+        return key
+
+
+    def get_pin_key(self, bdk, ksn):
+        """
+        Get the PIN encryption key for the clear BDK and the raw KSN
+        """
+        return get_pin_key(self.get_key(bdk, ksn))
@@ -0,0 +1,73 @@
+from Crypto.Cipher import DES3
+
+from pythales.cache import LRUCache
+from pythales.dukpt import xor_bytes
+from pythales.mac import CBCMAC
+
+
+def derive_card_master_key(imk, pan_psn):
+    """
+    Derive the card master key from the issuer master key and the PAN with the PAN sequence number (EMV option A).
+    pan_psn is the string of digits, the rightmost 16 digits are used.
+    """
+    y = bytes.fromhex(pan_psn[-16:].rjust(16, '0'))
+    cipher = DES3.new(imk, DES3.MODE_ECB)
+    return cipher.encrypt(y) + cipher.encrypt(xor_bytes(y, b'\xFF' * 8))
+
+
+def derive_session_key(mk, atc):
+    """
+    Derive the EMV common session key from the card master key and the 2-byte raw ATC
+    """
+    cipher = DES3.new(mk, DES3.MODE_ECB)
+    return cipher.encrypt(atc + b'\xF0' + b'\x00' * 5) + cipher.encrypt(atc + b'\x0F' + b'\x00' * 5)
+
+
+def get_mac(key, data):
+    """
+    ISO 9797-1 MAC algorithm 3 with padding method 2, as used for the application cryptograms
+    """
+    mac = CBCMAC(key, algorithm=3, padding=2)
+    mac.update(data)
+    return mac.digest()
+
+
+def get_arpc(key, arqc, arc):
+    """
+    Generate the ARPC using method 1: the ARQC XORed with the 2-byte ARC padded with zeros, encrypted under the key
+    """
+    return DES3.new(key, DES3.MODE_ECB).encrypt(xor_bytes(arqc, arc + b'\x00' * 6))
+
+
+class EMV():
+    """
+    EMV application cryptogram keys with the bounded (LRU) caches of the card master keys, per issuer master key
+    and PAN/PSN, and of the session keys, per card master key and ATC.
+    """
+    def __init__(self, cache_size=1024):
+        self.card_keys = LRUCache(cache_size)
+        self.session_keys = LRUCache(cache_size)
+
+
+    def get_card_key(self, imk, pan_psn):
+        """
+        Get the card master key for the clear issuer master key
+        """
+        card = (imk, pan_psn)
+        mk = self.card_keys.get(card)
+        if mk is None:
+            mk = derive_card_master_key(imk, pan_psn)
+            self.card_keys.set(card, mk)
+        return mk
+
+
+    def get_session_key(self, imk, pan_psn, atc):
+        """
+        Get the session key for the clear issuer master key and the raw ATC
+        """
+        mk = self.get_card_key(imk, pan_psn)
+        session_key = self.session_keys.get((mk, atc))
+        if session_key is None:
+            session_key = derive_session_key(mk, atc)
+            self.session_keys.set((mk, atc), session_key)
+        return session_key
@@ -0,0 +1,74 @@
+import os
+import socket
+
+
+HANDOFF_MESSAGE = b'HSM'
+
+
+class ListenerHandoff():
+    """
+    Control unix socket of the running server. The new server process connects to it and receives
+    the listening socket (the file descriptor is passed with SCM_RIGHTS), so that it takes over the new connections
+    without the listening socket being closed in between.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+
+
+    def listen(self):
+        """
+        Start listening on the control socket, replacing the socket file left by the previous run
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+
+
+    def fileno(self):
+        """
+        """
+        return self.sock.fileno()
+
+
+    def hand_over(self, listener):
+        """
+        Accept the new server process and pass the listening socket to it. The control socket is closed (and its file
+        removed) before the connection to the new process is closed, so the new process can listen on the same path
+        """
+        conn, _ = self.sock.accept()
+        with conn:
+            socket.send_fds(conn, [HANDOFF_MESSAGE], [listener.fileno()])
+            self.close()
+
+
+    def close(self):
+        """
+        """
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def take_over(path, timeout=10):
+    """
+    Connect to the control socket of the running server and get its listening socket.
+    Raises FileNotFoundError or ConnectionRefusedError if there is no server running on the control socket
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        message, fds, flags, address = socket.recv_fds(conn, len(HANDOFF_MESSAGE), 1)
+        if message != HANDOFF_MESSAGE or not fds:
+            raise ConnectionError('Listening socket not received from {}'.format(path))
+        # Wait for the running server to release the control socket
+        conn.recv(1)
+    return socket.socket(fileno=fds[0])
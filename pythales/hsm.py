@@ -1,14 +1,34 @@
 
+import asyncio
+import select
 import sys
 import socket
 import struct
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from tracetools.tracetools import trace
 from collections import OrderedDict
+from collections.abc import MutableMapping
 from Crypto.Cipher import DES, DES3
 from binascii import hexlify, unhexlify
-from pynblock.tools import str2bytes, raw2str, raw2B, B2raw, xor, get_visa_pvv, get_visa_cvv, get_digits_from_string, key_CV, get_clear_pin, check_key_parity, modify_key_parity
+from pythales.cache import LRUCache
+from pythales.cvv import CVV, CVV2_SERVICE_CODE, ICVV_SERVICE_CODE, get_visa_cvvs
+from pythales.data import DataCipher
+from pythales.des import decrypt_blocks
+from pythales.dukpt import DUKPT
+from pythales.ibm import IBM3624
+from pythales.emv import EMV, get_mac, get_arpc
+from pythales.handoff import ListenerHandoff
+from pythales.keys import KEY_TYPES, KeyStore
+from pythales.mac import CBCMAC
+from pythales.model import OVERLOAD_ERROR, get_response_code
+from pythales.pvv import get_visa_pvvs
+from pythales.stats import Stats
+from pythales.values import Key, PinBlock, as_key, as_pinblock, get_check_value
+from pynblock.tools import str2bytes, raw2str, raw2B, B2raw, xor, get_visa_pvv, get_digits_from_string, key_CV, get_clear_pin, get_pinblock, modify_key_parity
 
 
 class DummyMessage():
@@ -52,47 +72,109 @@ class DummyMessage():
         if self.description:
             dump = dump + '\t[' + 'Command Description'.ljust(width, ' ') + ']: [' + self.description + ']\n'
         for key, value in self.fields.items():
-            dump = dump + '\t[' + key.ljust(width, ' ') + ']: [' + value.decode('utf-8') + ']\n'
+            dump = dump + '\t[' + key.ljust(width, ' ') + ']: [' + value.decode('utf-8', 'replace') + ']\n'
         return dump
 
 
+class Fields(MutableMapping):
+    """
+    Request fields. The parser records only the field offsets, the field value is sliced from the request data on the first access
+    """
+    def __init__(self, data=b''):
+        self.data = data
+        self.offsets = OrderedDict()
+        self.values = {}
+        self.types = {}
+
+
+    def define(self, field, start, end, value_type=None):
+        """
+        Define the field. The value of the field with the value type (e.g. Key) is returned as the instance of the type
+        """
+        self.offsets[field] = (start, end)
+        if value_type:
+            self.types[field] = value_type
+
+
+    def view(self, field):
+        """
+        Get the memoryview of the field value in the request data, without copying the data
+        """
+        start, end = self.offsets[field]
+        return memoryview(self.data)[start:end]
+
+
+    def __getitem__(self, field):
+        try:
+            return self.values[field]
+        except KeyError:
+            start, end = self.offsets[field]
+            value = self.data[start:end]
+            value_type = self.types.get(field)
+            if value_type:
+                value = value_type(value)
+            self.values[field] = value
+            return value
+
+
+    def __setitem__(self, field, value):
+        if field not in self.offsets:
+            self.offsets[field] = None
+        self.values[field] = value
+
+
+    def __delitem__(self, field):
+        del self.offsets[field]
+        self.values.pop(field, None)
+        self.types.pop(field, None)
+
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
 class A0(DummyMessage):
     def __init__(self, data):
         self.data = data
         self.command_code = b'A0'
         self.description = 'Generate a Key'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # Mode - Indicates the operation of the function
         field_size = 1
-        self.fields['Mode'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Mode', offset, offset + field_size)
+        offset += field_size
 
         # Key type
         field_size = 3
-        self.fields['Key Type'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Type', offset, offset + field_size)
+        offset += field_size
 
         # Key scheme
         field_size = 1
-        self.fields['Key Scheme'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Scheme', offset, offset + field_size)
+        offset += field_size
 
         if self.fields['Mode'] == b'1':
             # Delimiter
             field_size = 1
-            if self.data[0:field_size] == b';':
-                self.data = self.data[field_size:]
+            if data[offset:offset + field_size] == b';':
+                offset += field_size
 
                 field_size = 1
-                self.fields['ZMK/TMK Flag'] = self.data[0:field_size]
-                self.data = self.data[field_size:]
+                self.fields.define('ZMK/TMK Flag', offset, offset + field_size)
+                offset += field_size
 
             # ZMK (or TMK)
-            if self.data[0:1] in [b'U']:
+            if data[offset:offset + 1] in [b'U']:
                 field_size = 33
-                self.fields['ZMK/TMK'] = self.data[0:field_size]
-                self.data = self.data[field_size:]
+                self.fields.define('ZMK/TMK', offset, offset + field_size, Key)
+                offset += field_size
 
 
 class BU(DummyMessage):
@@ -100,23 +182,91 @@ class BU(DummyMessage):
         self.data = data
         self.command_code = b'BU'
         self.description = 'Generate a Key check value'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # Key type code 
         field_size = 2
-        self.fields['Key Type Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Type Code', offset, offset + field_size)
+        offset += field_size
 
         # Key length flag
         field_size = 1
-        self.fields['Key Length Flag'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Length Flag', offset, offset + field_size)
+        offset += field_size
 
         # Key
-        if self.data[0:1] in [b'U']:
+        if data[offset:offset + 1] in [b'U']:
             field_size = 33
-            self.fields['Key'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('Key', offset, offset + field_size, Key)
+            offset += field_size
+
+
+class DA(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'DA'
+        self.description = 'Verify PIN using IBM offset method'
+        self.fields = Fields(data)
+        self._parse_ibm_request('TPK')
+
+
+    def _parse_ibm_request(self, key_type):
+        """
+        Parse the fields common to DA and EA commands
+        """
+        data = self.data
+        offset = 0
+
+        # TPK or ZPK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define(key_type, offset, offset + field_size, Key)
+        offset += field_size
+
+        # PVK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('PVK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # Maximum PIN Length
+        field_size = 2
+        self.fields.define('Maximum PIN Length', offset, offset + field_size)
+        offset += field_size
+
+        # PIN block
+        field_size = 16
+        self.fields.define('PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
+
+        # PIN block format code
+        field_size = 2
+        self.fields.define('PIN block format code', offset, offset + field_size)
+        offset += field_size
+
+        # Check Length
+        field_size = 2
+        self.fields.define('Check Length', offset, offset + field_size)
+        offset += field_size
+
+        # Account Number
+        field_size = 12
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
+
+        # Decimalization Table
+        field_size = 16
+        self.fields.define('Decimalization Table', offset, offset + field_size)
+        offset += field_size
+
+        # PIN Validation Data
+        field_size = 12
+        self.fields.define('PIN Validation Data', offset, offset + field_size)
+        offset += field_size
+
+        # Offset
+        field_size = 12
+        self.fields.define('Offset', offset, offset + field_size)
+        offset += field_size
 
 
 class DC(DummyMessage):
@@ -124,44 +274,86 @@ class DC(DummyMessage):
         self.data = data
         self.command_code = b'DC'
         self.description = 'Verify PIN'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # TPK
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33            
-            self.fields['TPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
+            field_size = 33
+            self.fields.define('TPK', offset, offset + field_size, Key)
+            offset += field_size
 
         # PVK
-        field_size = 33 if self.data[0:1] in [b'U'] else 32
-            
-        self.fields['PVK Pair'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('PVK Pair', offset, offset + field_size, Key)
+        offset += field_size
 
         # PIN block
         field_size = 16
-        self.fields['PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
 
         # PIN block format code
         field_size = 2
-        self.fields['PIN block format code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PIN block format code', offset, offset + field_size)
+        offset += field_size
 
         # Account Number
         field_size = 12
-        self.fields['Account Number'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
 
         # PVKI
         field_size = 1
-        self.fields['PVKI'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PVKI', offset, offset + field_size)
+        offset += field_size
 
         # PVV
         field_size = 4
-        self.fields['PVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PVV', offset, offset + field_size)
+        offset += field_size
+
+
+class DE(DummyMessage):
+    """
+    The PIN is the ISO 9564 format 0 PIN block encrypted under the LMK
+    """
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'DE'
+        self.description = 'Generate an IBM PIN Offset'
+        self.fields = Fields(data)
+        offset = 0
+
+        # PVK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('PVK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # PIN
+        field_size = 16
+        self.fields.define('PIN', offset, offset + field_size, PinBlock)
+        offset += field_size
+
+        # Check Length
+        field_size = 2
+        self.fields.define('Check Length', offset, offset + field_size)
+        offset += field_size
+
+        # Account Number
+        field_size = 12
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
+
+        # Decimalization Table
+        field_size = 16
+        self.fields.define('Decimalization Table', offset, offset + field_size)
+        offset += field_size
+
+        # PIN Validation Data
+        field_size = 12
+        self.fields.define('PIN Validation Data', offset, offset + field_size)
+        offset += field_size
 
 
 class CA(DummyMessage):
@@ -169,44 +361,45 @@ class CA(DummyMessage):
         self.data = data
         self.command_code = b'CA'
         self.description = 'Translate PIN from TPK to ZPK'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # TPK
-        if self.data[0:1] in [b'U', b'T', b'S']:
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
             field_size = 33
-            self.fields['TPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('TPK', offset, offset + field_size, Key)
+            offset += field_size
 
         # Destination Key
-        if self.data[0:1] in [b'U', b'T', b'S']:
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
             field_size = 33
-            self.fields['Destination Key'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('Destination Key', offset, offset + field_size, Key)
+            offset += field_size
 
         # Maximum PIN Length
         field_size = 2
-        self.fields['Maximum PIN Length'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Maximum PIN Length', offset, offset + field_size)
+        offset += field_size
 
         # Source PIN block
         field_size = 16
-        self.fields['Source PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Source PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
 
         # Source PIN block format
         field_size = 2
-        self.fields['Source PIN block format'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Source PIN block format', offset, offset + field_size)
+        offset += field_size
 
         # Destination PIN block format
         field_size = 2
-        self.fields['Destination PIN block format'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Destination PIN block format', offset, offset + field_size)
+        offset += field_size
 
         # Account Number
         field_size = 12
-        self.fields['Account Number'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
 
 
 class CW(DummyMessage):
@@ -214,33 +407,31 @@ class CW(DummyMessage):
         self.data = data
         self.command_code = b'CW'
         self.description = 'Generate a Card Verification Code'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # CVK
-        if self.data[0:1] in [b'U', b'T', b'S']:
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
             field_size = 33
-            self.fields['CVK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('CVK', offset, offset + field_size, Key)
+            offset += field_size
 
         # Primary Account Number
-        delimiter_index = 0
-        for byte in self.data:
-            if byte == 59:  # b';'
-                break
-            delimiter_index += 1
-
-        self.fields['Primary Account Number'] = self.data[0:delimiter_index]
-        self.data = self.data[delimiter_index + 1:]
+        delimiter_index = data.find(b';', offset)
+        if delimiter_index == -1:
+            delimiter_index = len(data)
+        self.fields.define('Primary Account Number', offset, delimiter_index)
+        offset = delimiter_index + 1
 
         # Expiration Date
         field_size = 4
-        self.fields['Expiration Date'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Expiration Date', offset, offset + field_size)
+        offset += field_size
 
         # Service Code
         field_size = 3
-        self.fields['Service Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Service Code', offset, offset + field_size)
+        offset += field_size
 
 
 class CY(DummyMessage):
@@ -248,38 +439,45 @@ class CY(DummyMessage):
         self.data = data
         self.command_code = b'CY'
         self.description = 'Verify CVV/CSC'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # CVK
-        if self.data[0:1] in [b'U', b'T', b'S']:
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
             field_size = 33
-            self.fields['CVK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('CVK', offset, offset + field_size, Key)
+            offset += field_size
 
         # CVV
         field_size = 3
-        self.fields['CVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('CVV', offset, offset + field_size)
+        offset += field_size
 
         # Primary Account Number
-        delimiter_index = 0
-        for byte in self.data:
-            if byte == 59:  # b';'
-                break
-            delimiter_index += 1
-
-        self.fields['Primary Account Number'] = self.data[0:delimiter_index]
-        self.data = self.data[delimiter_index + 1:]
+        delimiter_index = data.find(b';', offset)
+        if delimiter_index == -1:
+            delimiter_index = len(data)
+        self.fields.define('Primary Account Number', offset, delimiter_index)
+        offset = delimiter_index + 1
 
         # Expiration Date
         field_size = 4
-        self.fields['Expiration Date'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Expiration Date', offset, offset + field_size)
+        offset += field_size
 
         # Service Code
         field_size = 3
-        self.fields['Service Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Service Code', offset, offset + field_size)
+        offset += field_size
+
+
+class EA(DA):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'EA'
+        self.description = 'Verify interchange PIN using IBM offset method'
+        self.fields = Fields(data)
+        self._parse_ibm_request('ZPK')
 
 
 class EC(DummyMessage):
@@ -287,49 +485,89 @@ class EC(DummyMessage):
         self.data = data
         self.command_code = b'EC'
         self.description = 'Verify an Interchange PIN using ABA PVV method'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # ZPK
-        if self.data[0:1] in [b'U']:
+        if data[offset:offset + 1] in [b'U']:
             field_size = 33
-        self.fields['ZPK'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('ZPK', offset, offset + field_size, Key)
+        offset += field_size
 
         # PVK Pair
-        field_size = 33 if self.data[0:1] in [b'U'] else 32
-        self.fields['PVK Pair'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('PVK Pair', offset, offset + field_size, Key)
+        offset += field_size
 
         # PIN block
         field_size = 16
-        self.fields['PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
 
         # PIN block format code
         field_size = 2
-        self.fields['PIN block format code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]        
+        self.fields.define('PIN block format code', offset, offset + field_size)
+        offset += field_size
 
-        if self.fields['PIN block format code'] != b'04':
+        if data[offset - field_size:offset] != b'04':
             # Account Number
             field_size = 12
-            self.fields['Account Number'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('Account Number', offset, offset + field_size)
+            offset += field_size
         else:
             # Token
             field_size = 18
-            self.fields['Token'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            self.fields.define('Token', offset, offset + field_size)
+            offset += field_size
 
         # PVKI
         field_size = 1
-        self.fields['PVKI'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('PVKI', offset, offset + field_size)
+        offset += field_size
 
         # PVV
         field_size = 4
-        self.fields['PVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:] 
+        self.fields.define('PVV', offset, offset + field_size)
+        offset += field_size
+
+
+class EE(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'EE'
+        self.description = 'Derive a PIN using the IBM offset method'
+        self.fields = Fields(data)
+        offset = 0
+
+        # PVK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('PVK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # Offset
+        field_size = 12
+        self.fields.define('Offset', offset, offset + field_size)
+        offset += field_size
+
+        # Minimum PIN Length
+        field_size = 2
+        self.fields.define('Minimum PIN Length', offset, offset + field_size)
+        offset += field_size
+
+        # Account Number
+        field_size = 12
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
+
+        # Decimalization Table
+        field_size = 16
+        self.fields.define('Decimalization Table', offset, offset + field_size)
+        offset += field_size
+
+        # PIN Validation Data
+        field_size = 12
+        self.fields.define('PIN Validation Data', offset, offset + field_size)
+        offset += field_size
 
 
 class FA(DummyMessage):
@@ -337,21 +575,115 @@ class FA(DummyMessage):
         self.data = data
         self.command_code = b'FA'
         self.description = 'Translate a ZPK from ZMK to LMK'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # ZMK
-        if self.data[0:1] in [b'U', b'T']:
-            field_size = 33            
-            self.fields['ZMK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+        if data[offset:offset + 1] in [b'U', b'T']:
+            field_size = 33
+            self.fields.define('ZMK', offset, offset + field_size, Key)
+            offset += field_size
 
         # ZPK
-        if self.data[0:1] in [b'U', b'T', b'X']:
-            field_size = 33            
-            self.fields['ZPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+        if data[offset:offset + 1] in [b'U', b'T', b'X']:
+            field_size = 33
+            self.fields.define('ZPK', offset, offset + field_size, Key)
+            offset += field_size
             
 
+class G0(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'G0'
+        self.description = 'Translate a PIN from BDK to ZPK encryption (3DES DUKPT)'
+        self.fields = Fields(data)
+        offset = 0
+
+        # BDK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('BDK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # ZPK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('ZPK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # KSN Descriptor
+        field_size = 3
+        self.fields.define('KSN Descriptor', offset, offset + field_size)
+        offset += field_size
+
+        # Key Serial Number
+        field_size = 20
+        self.fields.define('KSN', offset, offset + field_size)
+        offset += field_size
+
+        # Source encrypted PIN block
+        field_size = 16
+        self.fields.define('Source PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
+
+        # Destination PIN block format
+        field_size = 2
+        self.fields.define('Destination PIN block format', offset, offset + field_size)
+        offset += field_size
+
+        # Account Number
+        field_size = 12
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
+
+
+class GQ(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'GQ'
+        self.description = 'Verify a PIN using the ABA PVV method (3DES DUKPT)'
+        self.fields = Fields(data)
+        offset = 0
+
+        # BDK
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('BDK', offset, offset + field_size, Key)
+        offset += field_size
+
+        # PVK Pair
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('PVK Pair', offset, offset + field_size, Key)
+        offset += field_size
+
+        # KSN Descriptor
+        field_size = 3
+        self.fields.define('KSN Descriptor', offset, offset + field_size)
+        offset += field_size
+
+        # Key Serial Number
+        field_size = 20
+        self.fields.define('KSN', offset, offset + field_size)
+        offset += field_size
+
+        # PIN block
+        field_size = 16
+        self.fields.define('PIN block', offset, offset + field_size, PinBlock)
+        offset += field_size
+
+        # Account Number
+        field_size = 12
+        self.fields.define('Account Number', offset, offset + field_size)
+        offset += field_size
+
+        # PVKI
+        field_size = 1
+        self.fields.define('PVKI', offset, offset + field_size)
+        offset += field_size
+
+        # PVV
+        field_size = 4
+        self.fields.define('PVV', offset, offset + field_size)
+        offset += field_size
+
+
 class HC(DummyMessage):
     """
     Generate a TMK, TPK or PVK
@@ -360,440 +692,2248 @@ class HC(DummyMessage):
         self.data = data
         self.command_code = b'HC'
         self.description = 'Generate a TMK, TPK or PVK'
-        self.fields = OrderedDict()
+        self.fields = Fields(data)
+        offset = 0
 
         # Current Key
-        field_size = 33 if self.data[0:1] in [b'U'] else 16
-        self.fields['Current Key'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('Current Key', offset, offset + field_size, Key)
+        offset += field_size
 
         # ; delimiter
         field_size = 1
-        self.data = self.data[field_size:]
+        offset += field_size
 
         # Key Scheme (TMK)
         field_size = 1
-        self.fields['Key Scheme (TMK)'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Scheme (TMK)', offset, offset + field_size)
+        offset += field_size
 
         # Key Scheme (LMK)
         field_size = 1
-        self.fields['Key Scheme (LMK)'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+        self.fields.define('Key Scheme (LMK)', offset, offset + field_size)
+        offset += field_size
 
 
-class NC(DummyMessage):
+class J2(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'J2'
+        self.description = 'Get HSM Loading'
+        self.fields = Fields(data)
+
+
+class J4(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'J4'
+        self.description = 'Get Host Command Volumes'
+        self.fields = Fields(data)
+
+
+class J8(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'J8'
+        self.description = 'Get Health Check Accumulated Counts'
+        self.fields = Fields(data)
+
+
+class KQ(DummyMessage):
     """
-    Diagnostics data
+    ARQC verification and/or ARPC generation. The binary fields are hex-encoded
     """
     def __init__(self, data):
         self.data = data
-        self.command_code = b'NC'
-        self.description = 'Diagnostics data'
-        self.fields = OrderedDict()
+        self.command_code = b'KQ'
+        self.description = 'ARQC Verification and/or ARPC Generation'
+        self.fields = Fields(data)
+        offset = 0
 
+        # Mode Flag
+        field_size = 1
+        self.fields.define('Mode Flag', offset, offset + field_size)
+        offset += field_size
 
-class OutgoingMessage(DummyMessage):
-    def __init__(self, data=None, header=None):
-        self.header = header
-        self.description = None
-        self.fields = OrderedDict()
+        # Scheme ID
+        field_size = 1
+        self.fields.define('Scheme ID', offset, offset + field_size)
+        offset += field_size
 
+        # MK-AC
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 32
+        self.fields.define('MK-AC', offset, offset + field_size, Key)
+        offset += field_size
 
-    def set_response_code(self, response_code):
-        """
-        """
-        self.command_code = response_code
-        self.fields['Response Code'] = str2bytes(response_code)
+        # PAN/PAN Sequence No
+        field_size = 16
+        self.fields.define('PAN/PSN', offset, offset + field_size)
+        offset += field_size
 
+        # ATC
+        field_size = 4
+        self.fields.define('ATC', offset, offset + field_size)
+        offset += field_size
 
-    def set_error_code(self, error_code):
-        """
-        """
-        self.fields['Error Code'] = str2bytes(error_code)
+        # Unpredictable Number
+        field_size = 8
+        self.fields.define('Unpredictable Number', offset, offset + field_size)
+        offset += field_size
 
+        # Transaction Data Length
+        field_size = 2
+        self.fields.define('Transaction Data Length', offset, offset + field_size)
+        offset += field_size
 
-    def build(self):
+        # Transaction Data
+        try:
+            field_size = int(self.fields['Transaction Data Length'], 16) * 2
+        except ValueError:
+            field_size = 0
+        self.fields.define('Transaction Data', offset, offset + field_size)
+        offset += field_size
+
+        # ; delimiter
+        field_size = 1
+        offset += field_size
+
+        # ARQC
+        field_size = 16
+        self.fields.define('ARQC', offset, offset + field_size)
+        offset += field_size
+
+        if self.fields['Mode Flag'] in [b'1', b'2']:
+            # ARC
+            field_size = 4
+            self.fields.define('ARC', offset, offset + field_size)
+            offset += field_size
+
+
+class M0(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'M0'
+        self.description = 'Encrypt Data Block'
+        self.fields = Fields(data)
+        self._parse_data_request()
+
+
+    def _parse_data_request(self):
         """
-        Build the outgoing message (legacy)
+        Parse the fields common to M0 and M2 commands
         """
-        data = b''
-        for key, value in self.fields.items():
-            data += value
+        data = self.data
+        offset = 0
 
-        return struct.pack("!H", len(self.header) + len(data)) + self.header + data if self.header else struct.pack("!H", len(data)) + data
+        # Mode Flag: 00 - ECB, 01 - CBC
+        field_size = 2
+        self.fields.define('Mode Flag', offset, offset + field_size)
+        offset += field_size
 
+        # Input Format Flag: 0 - binary, 1 - hex-encoded binary, 2 - text
+        field_size = 1
+        self.fields.define('Input Format Flag', offset, offset + field_size)
+        offset += field_size
 
-def parse_message(data=None, header=None):
-    """
-    Parse the incoming message, check the header and return tuple (command code, command data)
-    """
-    if not data:
-        return None
-    
-    length = struct.unpack_from("!H", data[:2])[0]
-    if(length != len(data) - 2):
-        raise ValueError('Expected message of length {0} but actual received message length is {1}'.format(length, len(data) - 2))
-    
-    if header:
-        for h, d in zip(header, data[2:]):
-            if h != d:
-                raise ValueError('Invalid header')
-        header = header 
+        # Output Format Flag: 0 - binary, 1 - hex-encoded binary
+        field_size = 1
+        self.fields.define('Output Format Flag', offset, offset + field_size)
+        offset += field_size
 
-    data = data[2 + len(header) : ] if header else data[2:]
-    return (data[:2], data[2:])
+        # Key Type: 00A - ZEK, 00B - DEK
+        field_size = 3
+        self.fields.define('Key Type', offset, offset + field_size)
+        offset += field_size
 
+        # Key
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('Key', offset, offset + field_size, Key)
+        offset += field_size
 
-class HSM():
-    def __init__(self, header=None, key=None, debug=None, skip_parity=None, port=None, approve_all=None):
-        self.firmware_version = '0007-E000'        
-        self.header = str2bytes(header) if header else b''
-        self.LMK = unhexlify(key) if key else unhexlify('deafbeedeafbeedeafbeedeafbeedeaf')
-        self.cipher = DES3.new(self.LMK, DES3.MODE_ECB)
-        self.debug = debug
-        self.skip_parity_check = skip_parity
-        self.port = port if port else 1500
-        self.approve_all = approve_all
-        if self.approve_all:
-            print('\n\n\tHSM is forced to approve all the requests!\n')
+        if self.fields['Mode Flag'] == b'01':
+            # IV
+            field_size = 16
+            self.fields.define('IV', offset, offset + field_size)
+            offset += field_size
 
+        # Message Length
+        field_size = 4
+        self.fields.define('Message Length', offset, offset + field_size)
+        offset += field_size
 
-    def init_connection(self):
+        # Message
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.bind(('', self.port))   
-            self.sock.listen(5)
-            print('Listening on port {}'.format(self.port))
-        except OSError as msg:
-            print('Error starting server: {}'.format(msg))
-            sys.exit()
+            field_size = int(self.fields['Message Length'], 16)
+        except ValueError:
+            field_size = 0
+        self.fields.define('Message', offset, offset + field_size)
+        offset += field_size
+        return offset
 
 
-    def recv(self, client_name=None):
-        """
-        """
-        data = self.conn.recv(4096)
-        if len(data):
-            trace('<< {} bytes received from {}: '.format(len(data), client_name), data)
-            return data
-        else:
-            self.conn.shutdown(socket.SHUT_RDWR)
-            print ('Client disconnected: {}'.format(client_name))
-            raise IOError
+class M2(M0):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'M2'
+        self.description = 'Decrypt Data Block'
+        self.fields = Fields(data)
+        self._parse_data_request()
 
 
-    def send(self, response, client_name=None):
+class M6(DummyMessage):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'M6'
+        self.description = 'Generate MAC'
+        self.fields = Fields(data)
+        self._parse_mac_request()
+
+
+    def _parse_mac_request(self):
         """
+        Parse the fields common to M6 and M8 commands
         """
-        response_data = response.build()
-        self.conn.send(response_data)
-        trace('>> {} bytes sent to {}:'.format(len(response_data), client_name), response_data)
-        print(response.trace())
-        
+        data = self.data
+        offset = 0
+
+        # Mode Flag: 0 - only block, 1 - first block, 2 - middle block, 3 - last block
+        field_size = 1
+        self.fields.define('Mode Flag', offset, offset + field_size)
+        offset += field_size
+
+        # Input Format Flag: 0 - binary, 1 - hex-encoded binary, 2 - text
+        field_size = 1
+        self.fields.define('Input Format Flag', offset, offset + field_size)
+        offset += field_size
+
+        # MAC Size: 0 - 8H, 1 - 16H
+        field_size = 1
+        self.fields.define('MAC Size', offset, offset + field_size)
+        offset += field_size
+
+        # MAC Algorithm: 1 - ISO 9797 MAC algorithm 1, 3 - ISO 9797 MAC algorithm 3
+        field_size = 1
+        self.fields.define('MAC Algorithm', offset, offset + field_size)
+        offset += field_size
+
+        # Padding Method: 0 - no padding, 1 - ISO 9797 padding method 1, 2 - ISO 9797 padding method 2
+        field_size = 1
+        self.fields.define('Padding Method', offset, offset + field_size)
+        offset += field_size
+
+        # Key Type
+        field_size = 3
+        self.fields.define('Key Type', offset, offset + field_size)
+        offset += field_size
+
+        # Key
+        field_size = 33 if data[offset:offset + 1] in [b'U'] else 16
+        self.fields.define('Key', offset, offset + field_size, Key)
+        offset += field_size
+
+        if self.fields['Mode Flag'] in [b'2', b'3']:
+            # IV
+            field_size = 16
+            self.fields.define('IV', offset, offset + field_size)
+            offset += field_size
+
+        # Message Length
+        field_size = 4
+        self.fields.define('Message Length', offset, offset + field_size)
+        offset += field_size
+
+        # Message
+        try:
+            field_size = int(self.fields['Message Length'], 16)
+        except ValueError:
+            field_size = 0
+        self.fields.define('Message', offset, offset + field_size)
+        offset += field_size
+        return offset
+
+
+class M8(M6):
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'M8'
+        self.description = 'Verify MAC'
+        self.fields = Fields(data)
+        offset = self._parse_mac_request()
+
+        if self.fields['Mode Flag'] in [b'0', b'3']:
+            # MAC
+            field_size = 16 if self.fields['MAC Size'] == b'1' else 8
+            self.fields.define('MAC', offset, offset + field_size)
+            offset += field_size
+
+
+class NC(DummyMessage):
+    """
+    Diagnostics data
+    """
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'NC'
+        self.description = 'Diagnostics data'
+        self.fields = Fields(data)
+
+
+class XB(DummyMessage):
+    """
+    Batch of commands (vendor extension)
+    """
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'XB'
+        self.description = 'Batch of commands'
+        self.fields = Fields(data)
+        offset = 0
+
+        # Number of Commands
+        field_size = 3
+        self.fields.define('Number of Commands', offset, offset + field_size)
+        offset += field_size
+
+        try:
+            number_of_commands = int(self.fields['Number of Commands'])
+        except ValueError:
+            number_of_commands = 0
+
+        for i in range(number_of_commands):
+            # Command Length
+            field_size = 4
+            try:
+                command_length = int(data[offset:offset + field_size], 16)
+            except ValueError:
+                break
+            offset += field_size
+
+            # Command
+            field_size = command_length
+            if len(data) < offset + field_size:
+                break
+            self.fields.define('Command {:03d}'.format(i + 1), offset, offset + field_size)
+            offset += field_size
+
+        # The length of the batch parsed, the data past it is not a part of the batch
+        self.parsed_length = offset
+
+
+    @property
+    def commands(self):
+        """
+        Get the list of the batched commands
+        """
+        return [self.fields[field] for field in self.fields if field.startswith('Command ')]
+
+
+class XV(DummyMessage):
+    """
+    Generate the card verification values of several variants (vendor extension).
+    Variants: 1 - CVV (service code of the card), 2 - CVV2 (service code 000), 3 - iCVV (service code 999)
+    """
+    def __init__(self, data):
+        self.data = data
+        self.command_code = b'XV'
+        self.description = 'Generate Card Verification Values'
+        self.fields = Fields(data)
+        offset = 0
+
+        # CVK
+        if data[offset:offset + 1] in [b'U', b'T', b'S']:
+            field_size = 33
+            self.fields.define('CVK', offset, offset + field_size, Key)
+            offset += field_size
+
+        # Primary Account Number
+        delimiter_index = data.find(b';', offset)
+        if delimiter_index == -1:
+            delimiter_index = len(data)
+        self.fields.define('Primary Account Number', offset, delimiter_index)
+        offset = delimiter_index + 1
+
+        # Expiration Date
+        field_size = 4
+        self.fields.define('Expiration Date', offset, offset + field_size)
+        offset += field_size
+
+        # Service Code
+        field_size = 3
+        self.fields.define('Service Code', offset, offset + field_size)
+        offset += field_size
+
+        # Variants
+        self.fields.define('Variants', offset, len(data))
+
+
+class OutgoingMessage(DummyMessage):
+    def __init__(self, data=None, header=None):
+        self.header = header
+        self.description = None
+        self.fields = OrderedDict()
+
+
+    def set_response_code(self, response_code):
+        """
+        """
+        self.command_code = response_code
+        self.fields['Response Code'] = str2bytes(response_code)
+
+
+    def set_error_code(self, error_code):
+        """
+        """
+        self.fields['Error Code'] = str2bytes(error_code)
+
+
+    def build(self):
+        """
+        Build the outgoing message
+        """
+        data = b''.join(self.fields.values())
+
+        if self.header:
+            return b''.join((struct.pack("!H", len(self.header) + len(data)), self.header, data))
+        return struct.pack("!H", len(data)) + data
+
+
+class StaticMessage(OutgoingMessage):
+    """
+    Precompiled outgoing message. The message is built only once and must not be modified afterwards
+    """
+    def __init__(self, header=None, response_code=None, error_code=None, fields=None):
+        super().__init__(header=header)
+        self.set_response_code(response_code)
+        self.set_error_code(error_code)
+        if fields:
+            for key, value in fields:
+                self.fields[key] = value
+        self.data = super().build()
+
+
+    def set(self, field, value):
+        """
+        """
+        raise TypeError('Static message cannot be modified')
+
+
+    def build(self):
+        """
+        Return the prebuilt outgoing message
+        """
+        return self.data
+
+
+class ResponseTemplate():
+    """
+    Precompiled successful response with the variable fields of fixed length. The length, the header, the response code
+    and the error code are formatted once, the variable fields are filled into the copy of the preformatted buffer
+    """
+    def __init__(self, header=None, response_code=None, fields=None):
+        self.header = header
+        self.response_code = str2bytes(response_code)
+        self.names = [name for name, length in fields]
+
+        prefix = (header or b'') + self.response_code + b'00'
+        length = len(prefix) + sum(length for name, length in fields)
+        self.buffer = bytearray(struct.pack('!H', length) + prefix + bytes(length - len(prefix)))
+        self.slots = []
+        offset = 2 + len(prefix)
+        for name, length in fields:
+            self.slots.append((offset, offset + length))
+            offset += length
+
+
+    def fill(self, *values):
+        """
+        Get the response with the variable fields filled in. Raises ValueError if the value does not fit its field
+        """
+        data = bytearray(self.buffer)
+        for (start, end), value in zip(self.slots, values):
+            if len(value) != end - start:
+                raise ValueError('Value of length {} does not fit the field of length {}'.format(len(value), end - start))
+            data[start:end] = value
+        return TemplateMessage(self, values, bytes(data))
+
+
+class TemplateMessage(DummyMessage):
+    """
+    Response filled in from the template. The fields are only built when they are requested, e.g. for tracing
+    """
+    def __init__(self, template, values, data):
+        self.template = template
+        self.values = values
+        self.data = data
+        self.header = template.header
+        self.command_code = template.response_code.decode('utf-8')
+        self.description = None
+
+
+    @property
+    def fields(self):
+        """
+        """
+        fields = OrderedDict([('Response Code', self.template.response_code), ('Error Code', b'00')])
+        fields.update(zip(self.template.names, self.values))
+        return fields
+
+
+    def get(self, field):
+        """
+        """
+        if field == 'Error Code':
+            return b'00'
+        return self.fields.get(field)
+
+
+    def set(self, field, value):
+        """
+        """
+        raise TypeError('Template message cannot be modified')
+
+
+    def build(self):
+        """
+        Return the message filled in from the template
+        """
+        return self.data
+
+
+def parse_message(data=None, header=None):
+    """
+    Parse the incoming message, check the header and return tuple (command code, command data)
+    """
+    if not data:
+        return None
+    
+    length = struct.unpack_from("!H", data[:2])[0]
+    if(length != len(data) - 2):
+        raise ValueError('Expected message of length {0} but actual received message length is {1}'.format(length, len(data) - 2))
+    
+    if header:
+        for h, d in zip(header, data[2:]):
+            if h != d:
+                raise ValueError('Invalid header')
+        header = header 
+
+    data = data[2 + len(header) : ] if header else data[2:]
+    return (data[:2], data[2:])
+
+
+def parse_request(command_code, command_data):
+    """
+    Get the request object for the command code. Unsupported commands are returned as DummyMessage with no command code
+    """
+    if command_code == b'A0':
+        return A0(command_data)
+    elif command_code == b'BU':
+        return BU(command_data)
+    elif command_code == b'CA':
+        return CA(command_data)
+    elif command_code == b'CW':
+        return CW(command_data)
+    elif command_code == b'CY':
+        return CY(command_data)
+    elif command_code == b'DA':
+        return DA(command_data)
+    elif command_code == b'DC':
+        return DC(command_data)
+    elif command_code == b'DE':
+        return DE(command_data)
+    elif command_code == b'EA':
+        return EA(command_data)
+    elif command_code == b'EC':
+        return EC(command_data)
+    elif command_code == b'EE':
+        return EE(command_data)
+    elif command_code == b'FA':
+        return FA(command_data)
+    elif command_code == b'G0':
+        return G0(command_data)
+    elif command_code == b'GQ':
+        return GQ(command_data)
+    elif command_code == b'HC':
+        return HC(command_data)
+    elif command_code == b'J2':
+        return J2(command_data)
+    elif command_code == b'J4':
+        return J4(command_data)
+    elif command_code == b'J8':
+        return J8(command_data)
+    elif command_code == b'KQ':
+        return KQ(command_data)
+    elif command_code == b'M0':
+        return M0(command_data)
+    elif command_code == b'M2':
+        return M2(command_data)
+    elif command_code == b'M6':
+        return M6(command_data)
+    elif command_code == b'M8':
+        return M8(command_data)
+    elif command_code == b'NC':
+        return NC(command_data)
+    elif command_code == b'XB':
+        return XB(command_data)
+    elif command_code == b'XV':
+        return XV(command_data)
+    else:
+        return DummyMessage(command_data)
+
+
+# Commands decrypting the PIN block under the TPK or ZPK, {command code: (key field, PIN block field)}
+PIN_BLOCK_FIELDS = {
+    b'CA': ('TPK', 'Source PIN block'),
+    b'DA': ('TPK', 'PIN block'),
+    b'DC': ('TPK', 'PIN block'),
+    b'EA': ('ZPK', 'PIN block'),
+    b'EC': ('ZPK', 'PIN block'),
+}
+
+
+# Maximum number of the responses to the pipelined requests sent by a single sendmsg call
+MAX_PENDING_RESPONSES = 64
+
+
+# Successful responses with the variable fields of fixed length, {response code: [(field, length)]}
+RESPONSE_TEMPLATES = {
+    'BV': [('Key Check Value', 16)],
+    'CB': [('PIN Length', 2), ('Destination PIN Block', 16), ('Destination PIN Block format', 2)],
+    'CX': [('CVV', 3)],
+    'FB': [('ZPK under LMK', 33), ('Key Check Value', 6)],
+}
+
+
+# Responses with no variable fields, (response code, error code)
+STATIC_RESPONSES = [
+    ('CB', '10'), ('CB', '11'),
+    ('CX', '00'), ('CX', '10'),
+    ('CZ', '00'), ('CZ', '01'), ('CZ', '10'),
+    ('DB', '00'), ('DB', '01'), ('DB', '10'), ('DB', '11'), ('DB', '15'), ('DB', '20'), ('DB', '23'),
+    ('DD', '00'), ('DD', '01'), ('DD', '10'), ('DD', '11'), ('DD', '27'),
+    ('DF', '10'), ('DF', '15'),
+    ('EB', '00'), ('EB', '01'), ('EB', '10'), ('EB', '11'), ('EB', '15'), ('EB', '20'), ('EB', '23'),
+    ('ED', '00'), ('ED', '01'), ('ED', '10'), ('ED', '11'), ('ED', '27'),
+    ('EF', '10'), ('EF', '15'),
+    ('FB', '01'),
+    ('G1', '10'), ('G1', '11'), ('G1', '15'), ('G1', '23'),
+    ('GR', '00'), ('GR', '01'), ('GR', '10'), ('GR', '11'), ('GR', '15'), ('GR', '27'),
+    ('KR', '00'), ('KR', '01'), ('KR', '10'), ('KR', '15'),
+    ('M1', '10'), ('M1', '15'),
+    ('M3', '10'), ('M3', '15'),
+    ('M7', '10'), ('M7', '15'),
+    ('M9', '00'), ('M9', '01'), ('M9', '10'), ('M9', '15'),
+    ('XC', '15'),
+    ('XW', '10'), ('XW', '15'),
+    ('ZZ', '00'),
+]
+
+
+class DatagramServer(asyncio.DatagramProtocol):
+    """
+    UDP listener of the concurrent server: each datagram carries one request, the response is sent back to the sender
+    """
+    def __init__(self, hsm):
+        self.hsm = hsm
+        self.transport = None
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def datagram_received(self, data, address):
+        asyncio.ensure_future(self.hsm._process_datagram_async(data, self.transport, address))
+
+
+class HSM():
+    def __init__(self, header=None, key=None, debug=None, skip_parity=None, port=None, approve_all=None, batch_workers=None, profiler=None, dispatcher=None, model=None, scheduler=None, batcher=None, unix_path=None, udp=None, memo=None, listener=None, control_path=None):
+        self.firmware_version = '0007-E000'        
+        self.header = str2bytes(header) if header else b''
+        self.LMK = unhexlify(key) if key else unhexlify('deafbeedeafbeedeafbeedeafbeedeaf')
+        self.cipher = DES3.new(self.LMK, DES3.MODE_ECB)
+        self.debug = debug
+        self.skip_parity_check = skip_parity
+        self.port = port if port is not None else 1500
+        self.unix_path = unix_path
+        self.udp = udp
+        self.approve_all = approve_all
+        self.batch_workers = batch_workers
+        self.batch_executor = None
+        self.profiler = profiler
+        self.dispatcher = dispatcher
+        self.model = model
+        self.scheduler = scheduler
+        self.batcher = batcher
+        self.memo = memo
+        # The listening socket inherited from the previous server process, and the control socket to hand it over to the next one
+        self.listener = listener
+        self.handoff = ListenerHandoff(control_path) if control_path else None
+        self.draining = False
+        self.clients = {}
+        self.dukpt = DUKPT()
+        self.emv = EMV()
+        self.cvks = LRUCache(1024)
+        self.keys = KeyStore(self.cipher)
+        self.stats = Stats()
+        self.static_responses = {}
+        for response_code, error_code in STATIC_RESPONSES:
+            self._get_static_response(response_code, error_code)
+        self.templates = {response_code: ResponseTemplate(header=self.header, response_code=response_code, fields=fields)
+            for response_code, fields in RESPONSE_TEMPLATES.items()}
+        # Receive buffer fitting the message of the maximum length
+        self.recv_buffer = bytearray(2 + 0xFFFF)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.recv_start = 0
+        self.received = 0
+        # Responses to the pipelined requests, sent together once no complete request is left in the buffer
+        self.pending_responses = []
+
+        self.diagnostics_response = StaticMessage(header=self.header, response_code='ND', error_code='00', fields=[
+            ('LMK Check Value', key_CV(raw2B(self.LMK), 16)),
+            ('Firmware Version', str2bytes(self.firmware_version)),
+        ])
+        if self.approve_all:
+            print('\n\n\tHSM is forced to approve all the requests!\n')
+
+
+    def init_connection(self):
+        try:
+            if self.listener:
+                self.sock = self.listener
+                print('Took over the listening socket')
+            else:
+                self.sock = self._bind()
+            print('Listening on {}'.format(self.get_address()))
+            if self.handoff:
+                self.handoff.listen()
+        except OSError as msg:
+            print('Error starting server: {}'.format(msg))
+            sys.exit()
+
+
+    def _bind(self):
+        """
+        Get the socket bound to the address the server listens on
+        """
+        if self.udp:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('', self.port))
+        elif self.unix_path:
+            self._remove_unix_socket()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.unix_path)
+            sock.listen(5)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('', self.port))
+            sock.listen(5)
+        return sock
+
+
+    def get_address(self):
+        """
+        Get the description of the address the server listens on
+        """
+        if self.udp:
+            return 'UDP port {}'.format(self.port)
+        elif self.unix_path:
+            return 'unix socket {}'.format(self.unix_path)
+        return 'port {}'.format(self.port)
+
+
+    def _remove_unix_socket(self):
+        """
+        Remove the unix socket file left by the previous run
+        """
+        try:
+            os.unlink(self.unix_path)
+        except FileNotFoundError:
+            pass
+
+
+    def _get_client_name(self, address):
+        """
+        Get the client name from its address (the unix socket clients are usually unnamed)
+        """
+        if isinstance(address, tuple):
+            return '{}:{}'.format(*address[:2])
+        return address if address else str(self.unix_path)
+
+
+    def has_message(self):
+        """
+        Check whether the complete message is already in the receive buffer
+        """
+        available = self.received - self.recv_start
+        return available >= 2 and available >= 2 + struct.unpack_from('!H', self.recv_buffer, self.recv_start)[0]
+
+
+    def recv(self, client_name=None):
+        """
+        Receive the complete message (the 2-byte length followed by the message data).
+        The data is read into the preallocated buffer, the data received past the end of the message
+        is kept in the buffer for the next call.
+        """
+        buf = self.recv_view
+        while True:
+            available = self.received - self.recv_start
+            if available >= 2:
+                start = self.recv_start
+                length = 2 + struct.unpack_from('!H', buf, start)[0]
+                if available >= length:
+                    data = bytes(buf[start:start + length])
+                    self.recv_start += length
+                    trace(data, title='<< {} bytes received from {}: '.format(len(data), client_name))
+                    return data
+
+            if self.recv_start:
+                # Move the incomplete message to the start of the buffer
+                buf[:available] = buf[self.recv_start:self.received]
+                self.recv_start = 0
+                self.received = available
+
+            if self.draining or not self._wait_readable(self.conn):
+                # The requests received before the hand-over are answered, the client reconnects to the new server process
+                self.conn.shutdown(socket.SHUT_RDWR)
+                print ('Client disconnected (draining): {}'.format(client_name))
+                raise IOError
+
+            received = self.conn.recv_into(buf[self.received:])
+            if not received:
+                self.conn.shutdown(socket.SHUT_RDWR)
+                print ('Client disconnected: {}'.format(client_name))
+                raise IOError
+            self.received += received
+
+
+    def send(self, response, client_name=None):
+        """
+        Send the response. While more pipelined requests are already received, the response is kept pending
+        and sent later together with the responses to those requests
+        """
+        profiler = self.profiler
+        if profiler:
+            started = profiler.start()
+
+        response_data = response.build()
+        if profiler:
+            started = profiler.record('build', started)
+
+        self.send_data(response_data)
+        if profiler:
+            started = profiler.record('send', started)
+
+        trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+        print(response.trace())
+        if profiler:
+            profiler.record('trace', started)
+        return response_data
+
+
+    def send_data(self, response_data):
+        """
+        Queue the response data, flush the pending responses if there is no complete request in the receive buffer
+        """
+        pending = self.pending_responses
+        pending.append(response_data)
+        if len(pending) >= MAX_PENDING_RESPONSES or not self.has_message():
+            self.flush()
+
+
+    def flush(self):
+        """
+        Send the pending responses, by a single sendmsg call if there are several of them
+        """
+        pending = self.pending_responses
+        if not pending:
+            return
+        if len(pending) == 1:
+            self.conn.sendall(pending[0])
+        else:
+            sent = self.conn.sendmsg(pending)
+            total = sum(len(response_data) for response_data in pending)
+            if sent < total:
+                self.conn.sendall(b''.join(pending)[sent:])
+        pending.clear()
+
+
+    def _get_memoized(self, data):
+        """
+        Get the memoized response to the request frame (None if it is not cached), recording it in the statistics
+        """
+        response_data = self.memo.get(data)
+        if response_data is not None:
+            offset = 2 + len(self.header)
+            self.stats.record(data[offset:offset + 2], response_data[offset + 2:offset + 4])
+        return response_data
+
+
+    def _memoize(self, data, response_data):
+        """
+        Memoize the response to the request frame. The responses to the unsupported commands
+        and the busy (overload) responses are not memoized
+        """
+        offset = 2 + len(self.header)
+        if response_data and response_data[offset:offset + 2] != b'ZZ' and response_data[offset + 2:offset + 4] != OVERLOAD_ERROR.encode():
+            self.memo.set(data, response_data, data[offset:offset + 2])
+
 
     def run(self):
         self.init_connection()
         print(self.info())
+        if self.udp:
+            return self._run_datagrams()
 
-        while True:
-            (self.conn, (ip, port)) = self.sock.accept()
-            client_name = ip + ':' + str(port)
+        while self._wait_readable(self.sock):
+            (self.conn, address) = self.sock.accept()
+            client_name = self._get_client_name(address)
             print ('Connected client: {}'.format(client_name))
+            self.recv_start = self.received = 0
+            self.pending_responses.clear()
+
+            profiler = self.profiler
+            while True:
+                if profiler:
+                    started = profiler.start()
+
+                try:
+                    data = self.recv(client_name)
+                except IOError:
+                    break
+
+                if profiler:
+                    started = profiler.record('recv', started)
+
+                if self.dispatcher:
+                    # The request (with the pipelined requests already received) is processed by the worker processes
+                    self._dispatch(data, client_name)
+                    if profiler:
+                        profiler.record('dispatch', started)
+                    continue
+
+                if self.memo:
+                    response_data = self._get_memoized(data)
+                    if response_data is not None:
+                        self.send_data(response_data)
+                        trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+                        if profiler:
+                            profiler.record('memo', started)
+                        continue
+
+                command_code, command_data = parse_message(data, header=self.header)
+                if profiler:
+                    started = profiler.record('parse_message', started)
+
+                request = parse_request(command_code, command_data)
+                if profiler:
+                    started = profiler.record('parse_request', started)
+
+                if request.get_command_code() is None:
+                    print('\nUnsupported command: ' + str(command_code, 'utf-8'));
+    
+                print(request.trace())
+                if profiler:
+                    started = profiler.record('trace', started)
+                    response = profiler.runcall(command_code, self.get_response, request)
+                    profiler.record('get_response', started)
+                else:
+                    response = self.get_response(request)
+
+                response_data = self.send(response, client_name)
+                if self.memo:
+                    self._memoize(data, response_data)
+
+
+    def _dispatch(self, data, client_name):
+        """
+        Submit the request and the pipelined requests already received (up to the dispatcher max_in_flight) to the worker
+        processes, so that the workers process them in parallel. The responses are matched to the requests by the tags
+        and sent in the order of the requests
+        """
+        frames = [data]
+        while len(frames) < self.dispatcher.max_in_flight and self.has_message():
+            frames.append(self.recv(client_name))
+
+        responses = [None] * len(frames)
+        submitted = 0
+        for tag, frame in enumerate(frames):
+            if self.memo:
+                responses[tag] = self._get_memoized(frame)
+                if responses[tag] is not None:
+                    continue
+            try:
+                self.dispatcher.submit(tag, frame)
+            except ValueError as err:
+                self._debug_trace(err)
+                responses[tag] = self._get_error_response(self._get_frame_command_code(frame)).build()
+                continue
+            submitted += 1
+
+        for i in range(submitted):
+            tag, response_data = self.dispatcher.collect()
+            responses[tag] = response_data
+            if self.memo and response_data:
+                self._memoize(frames[tag], response_data)
+
+        for response_data in responses:
+            if response_data:
+                self.pending_responses.append(response_data)
+                trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+        self.flush()
+
+
+    def _get_frame_command_code(self, frame):
+        """
+        Get the command code of the request frame, None if the frame is too short
+        """
+        offset = 2 + len(self.header)
+        command_code = bytes(frame[offset:offset + 2])
+        return command_code if len(command_code) == 2 else None
+
+
+    def _run_datagrams(self):
+        """
+        Serve the UDP requests: one request per datagram, there is no connection state.
+        The request that could not be processed is answered with the error response
+        """
+        while self._wait_readable(self.sock):
+            received, address = self.sock.recvfrom_into(self.recv_buffer)
+            client_name = self._get_client_name(address)
+            data = bytes(self.recv_view[:received])
+            trace(data, title='<< {} bytes received from {}: '.format(len(data), client_name))
+
+            response_data = self._get_memoized(data) if self.memo else None
+            if response_data is None:
+                try:
+                    command_code, command_data = parse_message(data, header=self.header)
+                except (ValueError, struct.error) as err:
+                    self._debug_trace(err)
+                    continue
+
+                request = parse_request(command_code, command_data)
+                if request.get_command_code() is None:
+                    print('\nUnsupported command: ' + str(command_code, 'utf-8'));
+                print(request.trace())
+
+                try:
+                    response = self.get_response(request)
+                    response_data = response.build()
+                except Exception as err:
+                    self._debug_trace('ERROR: {}'.format(err))
+                    response_data = self._get_error_response(command_code).build()
+                else:
+                    print(response.trace())
+                    if self.memo:
+                        self._memoize(data, response_data)
+
+            self.sock.sendto(response_data, address)
+            trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+
+
+    def _wait_readable(self, sock):
+        """
+        Wait until the socket is readable. If the new server process connects to the control socket first,
+        the listening socket is handed over to it and False is returned
+        """
+        if not self.handoff:
+            return True
+        if self.draining:
+            return False
+        readable, _, _ = select.select([sock, self.handoff], [], [])
+        if sock in readable:
+            return True
+        self._hand_over()
+        return False
+
+
+    def _hand_over(self):
+        """
+        Hand the listening socket over to the new server process and start draining
+        """
+        self.handoff.hand_over(self.sock)
+        self.sock.close()
+        self.draining = True
+        print('Listening socket handed over to the new server process, draining')
+
+
+    def reload(self, debug=None, approve_all=None):
+        """
+        Change the runtime settings without a restart. The memoized responses are discarded,
+        as they may depend on the settings. The settings are passed on to the worker processes of the dispatcher
+        """
+        if debug is not None:
+            self.debug = debug
+        if approve_all is not None:
+            self.approve_all = approve_all
+        if self.memo:
+            self.memo.clear()
+        if self.dispatcher:
+            self.dispatcher.reload(self.debug, self.approve_all)
+        print('Reloaded: debug {}, approve all {}'.format('on' if self.debug else 'off', 'on' if self.approve_all else 'off'))
+
+
+    def process(self, frame):
+        """
+        Process the request frame in-process, with no socket and no tracing, return the response frame.
+        An empty response is returned for the frame that could not be parsed, the request that could not be processed
+        is answered with the error response
+        """
+        if not frame:
+            return b''
+        if self.memo:
+            response_data = self._get_memoized(frame)
+            if response_data is not None:
+                return response_data
+
+        try:
+            command_code, command_data = parse_message(frame, header=self.header)
+        except (ValueError, struct.error) as err:
+            self._debug_trace(err)
+            return b''
+        try:
+            response_data = self.get_response(parse_request(command_code, command_data)).build()
+        except Exception as err:
+            self._debug_trace('ERROR: {}'.format(err))
+            return self._get_error_response(command_code).build()
+        if self.memo:
+            self._memoize(frame, response_data)
+        return response_data
+
+
+    def process_many(self, frames):
+        """
+        Process the request frames in-process, return the list of the response frames
+        """
+        process = self.process
+        return [process(frame) for frame in frames]
+
+
+    def run_async(self):
+        """
+        Run the concurrent server: the requests of all the clients are processed as asyncio tasks
+        """
+        asyncio.run(self.serve())
+
+
+    async def start_server(self):
+        """
+        Start listening for the clients of the concurrent server.
+        The UDP server is the datagram transport, the stream servers are asyncio servers
+        """
+        loop = asyncio.get_running_loop()
+        # The single listening socket is handed over on the hot restart, so it is bound as in the sequential server
+        listener = self.listener or (self._bind() if self.handoff else None)
+        if self.udp:
+            address = {'sock': listener} if listener else {'local_addr': ('0.0.0.0', self.port)}
+            self.server, _ = await loop.create_datagram_endpoint(lambda: DatagramServer(self), **address)
+        elif listener:
+            self.server = await asyncio.start_server(self._serve_client, sock=listener)
+        elif self.unix_path:
+            self._remove_unix_socket()
+            self.server = await asyncio.start_unix_server(self._serve_client, path=self.unix_path)
+        else:
+            self.server = await asyncio.start_server(self._serve_client, port=self.port)
+
+        if self.handoff:
+            self.handoff.listen()
+            self.drained = loop.create_future()
+            loop.add_reader(self.handoff.fileno(), self._hand_over_async)
+        return self.server
+
+
+    def _hand_over_async(self):
+        """
+        Hand the listening socket over to the new server process and stop accepting the connections.
+        The clients are drained: the requests already received are answered, then the connections are closed
+        """
+        asyncio.get_running_loop().remove_reader(self.handoff.fileno())
+        self.handoff.hand_over(self.server.get_extra_info('socket') if self.udp else self.server.sockets[0])
+        self.draining = True
+        print('Listening socket handed over to the new server process, draining {} clients'.format(len(self.clients)))
+
+        if not self.udp:
+            self.server.close()
+        for writer, reader in self.clients.items():
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        if not self.clients:
+            self.drained.set_result(None)
+
+
+    async def serve(self):
+        """
+        """
+        server = await self.start_server()
+        print(self.info())
+        print('Listening on {}'.format(self.get_address()))
+        if self.udp:
+            try:
+                await (self.drained if self.handoff else asyncio.get_running_loop().create_future())
+            finally:
+                server.close()
+            return
+        async with server:
+            if self.handoff:
+                await self.drained
+            else:
+                await server.serve_forever()
+
+
+    async def _serve_client(self, reader, writer):
+        """
+        Read the requests of the client and process them concurrently.
+        The responses are sent in the order of the requests
+        """
+        client_name = self._get_client_name(writer.get_extra_info('peername'))
+        print ('Connected client: {}'.format(client_name))
+        self.clients[writer] = reader
+
+        previous = None
+        while True:
+            try:
+                length = await reader.readexactly(2)
+                data = length + await reader.readexactly(struct.unpack('!H', length)[0])
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            trace(data, title='<< {} bytes received from {}: '.format(len(data), client_name))
+            previous = asyncio.ensure_future(self._process_async(data, writer, client_name, previous))
+
+        if previous:
+            await previous
+        writer.close()
+        print ('Client disconnected: {}'.format(client_name))
+        del self.clients[writer]
+        if self.draining and not self.clients and not self.drained.done():
+            self.drained.set_result(None)
+
+
+    async def _get_response_data_async(self, data, client_name):
+        """
+        Parse and process the request data, return the response data (None if the request could not be parsed).
+        The request that could not be processed is answered with the error response
+        """
+        if self.memo:
+            response_data = self._get_memoized(data)
+            if response_data is not None:
+                return response_data
+
+        try:
+            command_code, command_data = parse_message(data, header=self.header)
+            request = parse_request(command_code, command_data)
+        except (ValueError, struct.error) as err:
+            self._debug_trace(err)
+            return None
+
+        if request.get_command_code() is None:
+            print('\nUnsupported command: ' + str(command_code, 'utf-8'));
+        print(request.trace())
+        try:
+            response = await self.get_response_async(request)
+        except Exception as err:
+            print('Error processing the request from {}: {}'.format(client_name, err))
+            return self._get_error_response(command_code).build()
+
+        response_data = response.build()
+        print(response.trace())
+        if self.memo:
+            self._memoize(data, response_data)
+        return response_data
+
+
+    async def _process_datagram_async(self, data, transport, address):
+        """
+        Process the request received in the datagram and send the response back to the sender
+        """
+        client_name = self._get_client_name(address)
+        trace(data, title='<< {} bytes received from {}: '.format(len(data), client_name))
+        response_data = await self._get_response_data_async(data, client_name)
+        if not response_data:
+            return
+
+        transport.sendto(response_data, address)
+        trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+
+
+    async def _process_async(self, data, writer, client_name, previous):
+        """
+        Process the request and send the response after the response to the previous request of the client.
+        The request that could not be parsed is answered with the error response too, so that the responses
+        of the pipelined requests stay in order
+        """
+        response_data = await self._get_response_data_async(data, client_name)
+        if not response_data:
+            response_data = self._get_error_response(self._get_frame_command_code(data)).build()
+        if previous:
+            await previous
+        writer.write(response_data)
+        trace(response_data, title='>> {} bytes sent to {}:'.format(len(response_data), client_name))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+    async def get_response_async(self, request):
+        """
+        Get response to the request, scheduled by its priority class (if the scheduler is set).
+        The request shed by the scheduler is rejected with the busy error
+        """
+        scheduler = self.scheduler
+        if not scheduler:
+            return await self._get_modelled_response(request)
+
+        command_code = request.get_command_code()
+        if not await scheduler.acquire(command_code):
+            self._debug_trace('Request shed by the scheduler')
+            return self._get_static_response(get_response_code(command_code) if command_code else 'ZZ', OVERLOAD_ERROR)
+        try:
+            return await self._get_modelled_response(request)
+        finally:
+            scheduler.release()
+
+
+    async def _get_modelled_response(self, request):
+        """
+        Get response to the request, delayed according to the performance model (if set).
+        The request is rejected with the overload error if there are too many requests in flight
+        """
+        if self.batcher:
+            await self._batch_decrypt_pinblock(request)
+
+        model = self.model
+        if not model:
+            return self.get_response(request)
+
+        command_code = request.get_command_code()
+        if not model.admit():
+            self._debug_trace('HSM overloaded: {} requests in flight'.format(model.in_flight))
+            return self._get_static_response(get_response_code(command_code) if command_code else 'ZZ', OVERLOAD_ERROR)
+
+        try:
+            delay = model.get_queue_delay()
+            if delay:
+                await asyncio.sleep(delay)
+            response = self.get_response(request)
+            service_time = model.get_service_time(command_code)
+            if service_time:
+                await asyncio.sleep(service_time)
+            return response
+        finally:
+            model.release()
+
+
+    def info(self):
+        """
+        """
+        dump = ''
+        dump += 'LMK: {}\n'.format(raw2str(self.LMK))
+        dump += 'Firmware version: {}\n'.format(self.firmware_version)
+        if self.header:
+            dump += 'Message header: {}\n'.format(self.header.decode('utf-8'))
+        return dump
+
+
+    def _debug_trace(self, data):
+        """
+        """
+        if self.debug:
+            print('\tDEBUG: {}\n'.format(data))
+
+
+    def _get_error_response(self, command_code):
+        """
+        Get the response to the command that could not be processed: the response code of the command
+        with error 15 (invalid input data), ZZ if the command is not known
+        """
+        if not command_code or not command_code.isalnum():
+            return self._get_static_response('ZZ', '00')
+        return self._get_static_response(get_response_code(command_code), '15')
+
+
+    def _get_static_response(self, response_code, error_code):
+        """
+        Get the precompiled response consisting of the response code and the error code only
+        """
+        try:
+            return self.static_responses[(response_code, error_code)]
+        except KeyError:
+            response = StaticMessage(header=self.header, response_code=response_code, error_code=error_code)
+            self.static_responses[(response_code, error_code)] = response
+            return response
+
+
+    def _get_clear_key(self, key):
+        """
+        Get the clear key of the key encrypted under the LMK from the key store
+        """
+        return self.keys.get(key).clear
+
+
+    def _decrypt_pinblock(self, encrypted_pinblock, encrypted_terminal_key):
+        """
+        Decrypt pin block
+        """
+        if self.profiler:
+            started = self.profiler.start()
+
+        cipher = self.keys.get(encrypted_terminal_key).cipher
+        decrypted_pinblock = cipher.decrypt(as_pinblock(encrypted_pinblock).raw)
+
+        if self.profiler:
+            self.profiler.record('decrypt_pinblock', started)
+        return PinBlock.from_raw(decrypted_pinblock)
+
+
+    def _decrypt_pin_lmk(self, encrypted_pin, account_number):
+        """
+        Decrypt the PIN encrypted under the LMK (ISO 9564 format 0 PIN block)
+        """
+        return get_clear_pin(raw2B(self.cipher.decrypt(as_pinblock(encrypted_pin).raw)), account_number)
+
+
+    def _encrypt_pin_lmk(self, pin, account_number):
+        """
+        Encrypt the PIN under the LMK (ISO 9564 format 0 PIN block)
+        """
+        pinblock = get_pinblock(pin.decode('utf-8'), account_number.decode('utf-8') + '0')
+        return PinBlock.from_raw(self.cipher.encrypt(bytes.fromhex(pinblock)))
+
+
+    def _get_ibm(self, request):
+        """
+        Get the IBM 3624 PIN offset calculator for the PVK and the decimalization table of the request
+        """
+        return IBM3624(self._get_clear_key(request.get('PVK')), request.get('Decimalization Table'))
+
+
+    def _get_decrypted_pinblock(self, request):
+        """
+        Get the decrypted PIN block of the request, unless it has been decrypted by the micro-batching stage already
+        """
+        decrypted_pinblock = getattr(request, 'decrypted_pinblock', None)
+        if decrypted_pinblock:
+            return decrypted_pinblock
+        key_field, pinblock_field = PIN_BLOCK_FIELDS[request.get_command_code()]
+        return self._decrypt_pinblock(request.get(pinblock_field), request.get(key_field))
+
+
+    async def _batch_decrypt_pinblock(self, request):
+        """
+        Decrypt the PIN block of the request in a batch with the other requests using the same key.
+        The requests that can not be batched are left to the command handler
+        """
+        fields = PIN_BLOCK_FIELDS.get(request.get_command_code())
+        if not fields:
+            return
+
+        try:
+            clear_key = self._get_clear_key(request.get(fields[0]))
+            pinblock = request.get(fields[1]).raw
+        except (AttributeError, TypeError, ValueError):
+            return
+        if len(pinblock) != 8:
+            return
+
+        decrypted_pinblock = await self.batcher.decrypt(clear_key, pinblock)
+        if decrypted_pinblock:
+            request.decrypted_pinblock = PinBlock.from_raw(decrypted_pinblock)
+
+
+    def _decrypt_pinblock_dukpt(self, encrypted_pinblock, encrypted_bdk, ksn):
+        """
+        Decrypt DUKPT pin block. The KSN is raw binary data
+        """
+        if self.profiler:
+            started = self.profiler.start()
+
+        clear_bdk = self._get_clear_key(encrypted_bdk)
+        cipher = DES3.new(self.dukpt.get_pin_key(clear_bdk, ksn), DES3.MODE_ECB)
+        decrypted_pinblock = cipher.decrypt(as_pinblock(encrypted_pinblock).raw)
+
+        if self.profiler:
+            self.profiler.record('decrypt_pinblock', started)
+        return PinBlock.from_raw(decrypted_pinblock)
+
+
+    def _get_ksn(self, request):
+        """
+        Get the raw KSN from the request, None if the KSN is invalid
+        """
+        try:
+            ksn = B2raw(request.get('KSN'))
+        except ValueError:
+            return None
+        return ksn if len(ksn) == 10 else None
+
+
+    def _get_cvv(self, cvk):
+        """
+        Get the CVV calculator for the CVK, the calculators are cached per CVK.
+        The CVK is used as is, not decrypted under the LMK
+        """
+        cvk = as_key(cvk)
+        cvv = self.cvks.get(cvk.encoded)
+        if cvv is None:
+            cvv = CVV(cvk.raw)
+            self.cvks.set(cvk.encoded, cvv)
+        return cvv
+
+
+    def generate_cvv(self, request):
+        """
+        Get response to CW command
+        """
+        response_code = 'CX'
+
+        if not self.check_key_parity(request.get('CVK')):
+            self._debug_trace('CVK parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
+
+        if self.profiler:
+            started = self.profiler.start()
+
+        cvv = self._get_cvv(request.get('CVK')).get_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'))
+
+        if self.profiler:
+            self.profiler.record('cvv', started)
+
+        return self.templates[response_code].fill(cvv)
+
+
+    def verify_cvv(self, request):
+        """
+        Get response to CY command
+        """
+        response_code = 'CZ'
+
+        if not self.check_key_parity(request.get('CVK')):
+            self._debug_trace('CVK parity error')
+            return self._get_static_response(response_code, '10')
+
+        if self.profiler:
+            started = self.profiler.start()
+
+        cvv = self._get_cvv(request.get('CVK')).get_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'))
+
+        if self.profiler:
+            self.profiler.record('cvv', started)
+        
+        if cvv == request.get('CVV'):
+            return self._get_static_response(response_code, '00')
+
+        self._debug_trace('CVV mismatch: {} != {}'.format(cvv.decode('utf-8'), request.get('CVV').decode('utf-8')))
+        if self.approve_all:
+            self._debug_trace('Forced approval as --approve-all option set')
+            return self._get_static_response(response_code, '00')
+        return self._get_static_response(response_code, '01')
+
+
+    def generate_cvvs(self, request):
+        """
+        Get response to XV command (Generate Card Verification Values).
+        The values of all the requested variants are calculated in one pass with the shared CVK key schedule
+        """
+        response_code = 'XW'
+
+        if not self.check_key_parity(request.get('CVK')):
+            self._debug_trace('CVK parity error')
+            return self._get_static_response(response_code, '10')
+
+        variants = {
+            ord('1'): ('CVV', request.get('Service Code')),
+            ord('2'): ('CVV2', CVV2_SERVICE_CODE),
+            ord('3'): ('iCVV', ICVV_SERVICE_CODE),
+        }
+        requested = request.get('Variants')
+        if not requested or any(variant not in variants for variant in requested) or len(set(requested)) != len(requested):
+            self._debug_trace('Invalid variants')
+            return self._get_static_response(response_code, '15')
+
+        try:
+            cvvs = self._get_cvv(request.get('CVK')).get_cvvs(request.get('Primary Account Number'), request.get('Expiration Date'),
+                [variants[variant][1] for variant in requested])
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        for variant, cvv in zip(requested, cvvs):
+            response.set(variants[variant][0], cvv)
+        return response
+
+
+    def generate_key(self, request):
+        """
+        Get response to HC command
+        TODO: generating keys for different schemes
+        """
+        response =  OutgoingMessage(data=None, header=self.header)
+        response.set_response_code('HD')
+        response.set_error_code('00')
+
+        new_clear_key = modify_key_parity(bytes(os.urandom(16)))
+        self._debug_trace('Generated key: {}'.format(raw2str(new_clear_key)))
+
+        curr_key_cipher = self.keys.get(request.get('Current Key')).cipher
+
+        new_key_under_current_key = curr_key_cipher.encrypt(new_clear_key)
+        new_key_under_lmk = self.cipher.encrypt(new_clear_key)
+
+        response.set('New key under the current key', Key.from_raw(new_key_under_current_key))
+        response.set('New key under LMK', Key.from_raw(new_key_under_lmk))
+
+        return response
+
+
+    def check_key_parity(self, _key):
+        """
+        """
+        if self.skip_parity_check:
+            return True
+        else:
+            return self.keys.get(_key).parity
+
+
+    def warm_up(self, inventory):
+        """
+        Decrypt the keys of the key inventory (the (line number, key type, key) tuples) under the LMK,
+        check their parity and compute their ciphers and check values, so that the first requests using the keys
+        find them in the key store. The CVV calculators of the CVKs are cached too.
+        Return the list of the invalid keys as (line number, key type, key, reason) tuples
+        """
+        invalid = []
+        for line_number, key_type, key in inventory:
+            if key_type not in KEY_TYPES:
+                invalid.append((line_number, key_type, key, 'Unknown key type'))
+                continue
+
+            try:
+                raw_key = as_key(key).raw
+            except ValueError:
+                invalid.append((line_number, key_type, key, 'Key is not hex-encoded'))
+                continue
+            if len(raw_key) not in (16, 24):
+                invalid.append((line_number, key_type, key, 'Invalid key length'))
+                continue
+
+            entry = self.keys.get(key)
+            if not entry.parity and not self.skip_parity_check:
+                invalid.append((line_number, key_type, key, 'Key parity error'))
+                continue
+
+            try:
+                entry.cipher
+                entry.check_value
+                if key_type == 'CVK':
+                    self._get_cvv(key)
+            except ValueError as err:
+                invalid.append((line_number, key_type, key, str(err)))
+        return invalid
+
+
+    def verify_pin(self, request):
+        """
+        Get response to DC or EC command
+        """
+        command_code = request.get_command_code()
+
+        if command_code == b'DC':
+            response_code = 'DD'
+            key_type = 'TPK'
+        elif command_code == b'EC':
+            response_code = 'ED'
+            key_type = 'ZPK'
+
+        if not self.check_key_parity(request.get(key_type)):
+            self._debug_trace(key_type + ' parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
+
+        if not self.check_key_parity(request.get('PVK Pair')):
+            self._debug_trace('PVK parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '11')
+
+        if len(request.get('PVK Pair')) != 32:
+            self._debug_trace('PVK not double length')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '27')
+
+        decrypted_pinblock = self._get_decrypted_pinblock(request)
+        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
+        
+        try:
+            if self.profiler:
+                started = self.profiler.start()
+
+            pin = get_clear_pin(decrypted_pinblock, request.get('Account Number'))
+            pvv = get_visa_pvv(request.get('Account Number'), request.get('PVKI'), pin[:4], request.get('PVK Pair'))
+
+            if self.profiler:
+                self.profiler.record('pvv', started)
+            if pvv == request.get('PVV'):
+                return self._get_static_response(response_code, '00')
+            else:
+                self._debug_trace('PVV mismatch: {} != {}'.format(pvv.decode('utf-8'), request.get('PVV').decode('utf-8')))
+                if self.approve_all:
+                    self._debug_trace('Forced approval as --approve-all option set')
+                    return self._get_static_response(response_code, '00')
+                return self._get_static_response(response_code, '01')
+
+        except ValueError as err:
+            self._debug_trace(err)
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '01')
+
+
+    def verify_pin_ibm(self, request):
+        """
+        Get response to DA or EA command (Verify PIN using IBM offset method)
+        """
+        if request.get_command_code() == b'DA':
+            response_code = 'DB'
+            key_type = 'TPK'
+        else:
+            response_code = 'EB'
+            key_type = 'ZPK'
+
+        if not self.check_key_parity(request.get(key_type)):
+            self._debug_trace(key_type + ' parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
+
+        if not self.check_key_parity(request.get('PVK')):
+            self._debug_trace('PVK parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '11')
+
+        pinblock_format = request.get('PIN block format code')
+        if pinblock_format != b'01':
+            self._debug_trace('Unsupported PIN block format: {}'.format(pinblock_format.decode('utf-8', 'replace')))
+            return self._get_static_response(response_code, '23')
+
+        try:
+            check_length = int(request.get('Check Length'))
+            ibm = self._get_ibm(request)
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        decrypted_pinblock = self._get_decrypted_pinblock(request)
+        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
+
+        try:
+            pin = get_clear_pin(decrypted_pinblock, request.get('Account Number'))
+        except ValueError as err:
+            self._debug_trace(err)
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '20')
+
+        try:
+            verified = ibm.verify(pin, request.get('Offset'), request.get('PIN Validation Data'), request.get('Account Number'), check_length)
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        if verified:
+            return self._get_static_response(response_code, '00')
+
+        self._debug_trace('PIN does not match the offset {}'.format(request.get('Offset').decode('utf-8', 'replace')))
+        if self.approve_all:
+            self._debug_trace('Forced approval as --approve-all option set')
+            return self._get_static_response(response_code, '00')
+        return self._get_static_response(response_code, '01')
+
+
+    def generate_ibm_offset(self, request):
+        """
+        Get response to DE command (Generate an IBM PIN Offset)
+        """
+        response_code = 'DF'
+
+        if not self.check_key_parity(request.get('PVK')):
+            self._debug_trace('PVK parity error')
+            return self._get_static_response(response_code, '10')
+
+        try:
+            check_length = int(request.get('Check Length'))
+            pin = self._decrypt_pin_lmk(request.get('PIN'), request.get('Account Number'))
+            if len(pin) < check_length:
+                raise ValueError('PIN is shorter than the check length')
+            offset = self._get_ibm(request).get_offset(pin, request.get('PIN Validation Data'), request.get('Account Number'))
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        response.set('Offset', offset)
+        return response
+
+
+    def derive_pin_ibm(self, request):
+        """
+        Get response to EE command (Derive a PIN using the IBM offset method)
+        """
+        response_code = 'EF'
+
+        if not self.check_key_parity(request.get('PVK')):
+            self._debug_trace('PVK parity error')
+            return self._get_static_response(response_code, '10')
+
+        try:
+            offset = request.get('Offset')
+            if len(offset.rstrip(b'F')) < int(request.get('Minimum PIN Length')):
+                raise ValueError('Offset is shorter than the minimum PIN length')
+            pin = self._get_ibm(request).get_pin(offset, request.get('PIN Validation Data'), request.get('Account Number'))
+            encrypted_pin = self._encrypt_pin_lmk(pin, request.get('Account Number'))
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
 
-            while True:
-                try:
-                    data = self.recv(client_name)
-                except IOError:
-                    break
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        response.set('PIN', encrypted_pin)
+        return response
 
-                command_code, command_data = parse_message(data, header=self.header)
-                if command_code == b'A0':
-                    request = A0(command_data)
-                elif command_code == b'BU':
-                    request = BU(command_data)
-                elif command_code == b'CA':
-                    request = CA(command_data)
-                elif command_code == b'CW':
-                    request = CW(command_data)
-                elif command_code == b'CY':
-                    request = CY(command_data)
-                elif command_code == b'DC':
-                    request = DC(command_data)
-                elif command_code == b'EC':
-                    request = EC(command_data)
-                elif command_code == b'FA':
-                    request = FA(command_data)
-                elif command_code == b'HC':
-                    request = HC(command_data)
-                elif command_code == b'NC':
-                    request = NC(command_data)
-                else:
-                    print('\nUnsupported command: ' + str(command_code, 'utf-8'));
-                    request = None
-    
-                print(request.trace())
-                response = self.get_response(request)
-                self.send(response, client_name)
-           
 
-    def info(self):
+    def generate_ibm_offsets(self, pvk, decimalization_table, validation_data, cards):
         """
+        Generate the IBM PIN offsets for the card base, the iterable of (account number, PIN encrypted under the LMK).
+        The PVK is decrypted and the decimalization table is prepared once for all the cards.
         """
-        dump = ''
-        dump += 'LMK: {}\n'.format(raw2str(self.LMK))
-        dump += 'Firmware version: {}\n'.format(self.firmware_version)
-        if self.header:
-            dump += 'Message header: {}\n'.format(self.header.decode('utf-8'))
-        return dump
+        ibm = IBM3624(self._get_clear_key(pvk), decimalization_table)
+        return ibm.get_offsets(((account_number, self._decrypt_pin_lmk(encrypted_pin, account_number)) for account_number, encrypted_pin in cards), validation_data)
 
 
-    def _debug_trace(self, data):
+    def decrypt_pinblocks(self, pinblocks):
         """
+        Decrypt the batch of the PIN blocks, the iterable of (encrypted PIN block, terminal key encrypted under the LMK).
+        The terminal keys are decrypted under the LMK by a single call, the PIN blocks under their terminal keys
+        by the batch DES engine.
         """
-        if self.debug:
-            print('\tDEBUG: {}\n'.format(data))
+        encrypted_keys, encrypted_pinblocks = [], []
+        for encrypted_pinblock, encrypted_terminal_key in pinblocks:
+            encrypted_keys.append(as_key(encrypted_terminal_key).raw)
+            encrypted_pinblocks.append(as_pinblock(encrypted_pinblock).raw)
+        if not encrypted_keys:
+            return []
 
+        clear_keys = self.cipher.decrypt(b''.join(encrypted_keys))
+        terminal_keys = []
+        offset = 0
+        for encrypted_key in encrypted_keys:
+            terminal_keys.append(clear_keys[offset:offset + len(encrypted_key)])
+            offset += len(encrypted_key)
 
-    def _decrypt_pinblock(self, encrypted_pinblock, encrypted_terminal_key):
+        decrypted = decrypt_blocks(terminal_keys, b''.join(encrypted_pinblocks))
+        return [PinBlock.from_raw(decrypted[i:i + 8]) for i in range(0, len(decrypted), 8)]
+
+
+    def generate_visa_cvvs(self, cards):
         """
-        Decrypt pin block
+        Generate the CVVs for the batch of the cards, the iterable of (CVK, PAN, expiry date, service code).
+        The CVKs are used as is, not decrypted under the LMK (as in CW)
         """
-        if encrypted_terminal_key[0:1] in [b'U']:
-            clear_terminal_key = self.cipher.decrypt(B2raw(encrypted_terminal_key[1:]))
-        else:
-            clear_terminal_key = self.cipher.decrypt(B2raw(encrypted_terminal_key))
+        return get_visa_cvvs([(as_key(cvk).raw, pan, expiry_date, service_code) for cvk, pan, expiry_date, service_code in cards])
 
-        cipher = DES3.new(clear_terminal_key, DES3.MODE_ECB)
-        decrypted_pinblock = cipher.decrypt(B2raw(encrypted_pinblock))
-        return raw2B(decrypted_pinblock)
 
+    def generate_visa_pvvs(self, cards):
+        """
+        Generate the Visa PVVs for the batch of the cards, the iterable of (PVK pair, account number, PVKI, PIN)
+        """
+        return get_visa_pvvs(cards)
 
-    def generate_cvv(self, request):
+
+    def translate_pinblock(self, request):
         """
-        Get response to CW command
+        Get response to CA command (Translate PIN from TPK to ZPK)
         """
-        response =  OutgoingMessage(data=None, header=self.header)
-        response.set_response_code('CX')
+        response_code = 'CB'
+        pinblock_format = request.get('Destination PIN block format')
 
-        if not self.check_key_parity(request.get('CVK')):
-            self._debug_trace('CVK parity error')
+        if request.get('Destination PIN block format') != request.get('Source PIN block format'):
+            raise ValueError('Cannot translate PIN block from format {} to format {}'.format(request.get('Source PIN block format').decode('utf-8'), request.get('Destination PIN block format').decode('utf-8')))
+
+        if request.get('Source PIN block format') != b'01':
+            raise ValueError('Unsupported PIN block format: {}'.format(request.get('Source PIN block format').decode('utf-8')))
+
+        # Source key parity check
+        if not self.check_key_parity(request.get('TPK')):
+            self._debug_trace('Source TPK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('10')
-            return response
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
 
-        CVK = request.get('CVK')
-        if CVK[0:1] in [b'U']:
-            CVK = CVK[1:]
-        cvv = get_visa_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'), CVK)
+        # Destination key parity check
+        if not self.check_key_parity(request.get('Destination Key')):
+            self._debug_trace('Destination ZPK parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '11')
 
-        response.set_error_code('00')
-        response.set('CVV', str2bytes(cvv))
-        return response     
+        decrypted_pinblock = self._get_decrypted_pinblock(request)
+        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
+        
+        pin_length = decrypted_pinblock[0:2]
 
+        cipher = DES3.new(request.get('Destination Key').raw, DES3.MODE_ECB)
+        translated_pin_block = cipher.encrypt(as_pinblock(decrypted_pinblock).raw)
 
-    def verify_cvv(self, request):
+        return self.templates[response_code].fill(pin_length, PinBlock.from_raw(translated_pin_block), pinblock_format)
+
+
+    def translate_pinblock_dukpt(self, request):
         """
-        Get response to CY command
+        Get response to G0 command (Translate a PIN from BDK to ZPK encryption, 3DES DUKPT)
         """
-        response =  OutgoingMessage(data=None, header=self.header)
-        response.set_response_code('CZ')
-        
-        if not self.check_key_parity(request.get('CVK')):
-            self._debug_trace('CVK parity error')
-            response.set_error_code('10')
-            return response
+        response_code = 'G1'
 
-        CVK = request.get('CVK')
-        if CVK[0:1] in [b'U']:
-            CVK = CVK[1:]
-        cvv = get_visa_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'), CVK)
-        
-        if str2bytes(cvv) == request.get('CVV'):
-            response.set_error_code('00')
-        else:
-            self._debug_trace('CVV mismatch: {} != {}'.format(cvv, request.get('CVV').decode('utf-8')))
+        if not self.check_key_parity(request.get('BDK')):
+            self._debug_trace('BDK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('01')
-            
-        return response
-
-
-    def generate_key(self, request):
-        """
-        Get response to HC command
-        TODO: generating keys for different schemes
-        """
-        response =  OutgoingMessage(data=None, header=self.header)
-        response.set_response_code('HD')
-        response.set_error_code('00')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
 
-        new_clear_key = modify_key_parity(bytes(os.urandom(16)))
-        self._debug_trace('Generated key: {}'.format(raw2str(new_clear_key)))
+        if not self.check_key_parity(request.get('ZPK')):
+            self._debug_trace('ZPK parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '11')
 
-        current_key = request.get('Current Key')
-        if current_key[0:1] in [b'U']:
-            current_key = current_key[1:]
+        pinblock_format = request.get('Destination PIN block format')
+        if pinblock_format != b'01':
+            self._debug_trace('Unsupported PIN block format: {}'.format(pinblock_format.decode('utf-8')))
+            return self._get_static_response(response_code, '23')
 
-        clear_current_key = self.cipher.decrypt(B2raw(current_key))
-        curr_key_cipher = DES3.new(clear_current_key, DES3.MODE_ECB)
+        ksn = self._get_ksn(request)
+        if not ksn:
+            self._debug_trace('Invalid KSN')
+            return self._get_static_response(response_code, '15')
 
-        new_key_under_current_key = curr_key_cipher.encrypt(new_clear_key)
-        new_key_under_lmk = self.cipher.encrypt(new_clear_key)
+        decrypted_pinblock = self._decrypt_pinblock_dukpt(request.get('Source PIN block'), request.get('BDK'), ksn)
+        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
 
-        response.set('New key under the current key', b'U' + raw2B(new_key_under_current_key))
-        response.set('New key under LMK', b'U' + raw2B(new_key_under_lmk))
+        cipher = self.keys.get(request.get('ZPK')).cipher
+        translated_pin_block = cipher.encrypt(decrypted_pinblock.raw)
 
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        response.set('PIN Length', decrypted_pinblock[0:2])
+        response.set('Destination PIN Block', PinBlock.from_raw(translated_pin_block))
+        response.set('Destination PIN Block format', pinblock_format)
         return response
 
 
-    def check_key_parity(self, _key):
-        """
-        """
-        if self.skip_parity_check:
-            return True
-        else:
-            key = _key[1:] if _key[0:1] in [b'U'] else _key
-            return check_key_parity(self.cipher.decrypt(B2raw(key)))
-
-
-    def verify_pin(self, request):
+    def verify_pin_dukpt(self, request):
         """
-        Get response to DC or EC command
+        Get response to GQ command (Verify a PIN using the ABA PVV method, 3DES DUKPT)
         """
-        response =  OutgoingMessage(data=None, header=self.header)
-        command_code = request.get_command_code()
-
-        if command_code == b'DC':            
-            response.set_response_code('DD')
-            key_type = 'TPK'
-        elif command_code == b'EC':
-            response.set_response_code('ED')
-            key_type = 'ZPK'
+        response_code = 'GR'
 
-        if not self.check_key_parity(request.get(key_type)):
-            self._debug_trace(key_type + ' parity error')
+        if not self.check_key_parity(request.get('BDK')):
+            self._debug_trace('BDK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('10')
-            return response
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
 
         if not self.check_key_parity(request.get('PVK Pair')):
             self._debug_trace('PVK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('11')
-            return response     
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '11')
 
         if len(request.get('PVK Pair')) != 32:
             self._debug_trace('PVK not double length')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('27')
-            return response
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '27')
+
+        ksn = self._get_ksn(request)
+        if not ksn:
+            self._debug_trace('Invalid KSN')
+            return self._get_static_response(response_code, '15')
 
-        decrypted_pinblock = self._decrypt_pinblock(request.get('PIN block'), request.get(key_type))
+        decrypted_pinblock = self._decrypt_pinblock_dukpt(request.get('PIN block'), request.get('BDK'), ksn)
         self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
-        
+
         try:
             pin = get_clear_pin(decrypted_pinblock, request.get('Account Number'))
             pvv = get_visa_pvv(request.get('Account Number'), request.get('PVKI'), pin[:4], request.get('PVK Pair'))
             if pvv == request.get('PVV'):
-                response.set_error_code('00')
+                return self._get_static_response(response_code, '00')
             else:
                 self._debug_trace('PVV mismatch: {} != {}'.format(pvv.decode('utf-8'), request.get('PVV').decode('utf-8')))
                 if self.approve_all:
                     self._debug_trace('Forced approval as --approve-all option set')
-                    response.set_error_code('00')
-                else:
-                    response.set_error_code('01')
-
-            return response
+                    return self._get_static_response(response_code, '00')
+                return self._get_static_response(response_code, '01')
 
         except ValueError as err:
             self._debug_trace(err)
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('01')
-            return response
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '01')
 
 
-    def translate_pinblock(self, request):
+    def verify_pins_dukpt(self, requests):
         """
-        Get response to CA command (Translate PIN from TPK to ZPK)
+        Verify the batch of GQ requests, e.g. the settlement-time re-verification.
+        The requests are processed in the BDK and KSN order, so that the consecutive transactions of the same terminal
+        reuse the cached derived keys. The responses are returned in the original order.
         """
-        response = OutgoingMessage(header=self.header)
-        response.set_response_code('CB')
-        pinblock_format = request.get('Destination PIN block format')
+        responses = [None] * len(requests)
+        for i in sorted(range(len(requests)), key=lambda i: (requests[i].get('BDK'), requests[i].get('KSN'))):
+            responses[i] = self.verify_pin_dukpt(requests[i])
+        return responses
 
-        if request.get('Destination PIN block format') != request.get('Source PIN block format'):
-            raise ValueError('Cannot translate PIN block from format {} to format {}'.format(request.get('Source PIN block format').decode('utf-8'), request.get('Destination PIN block format').decode('utf-8')))
 
-        if request.get('Source PIN block format') != b'01':
-            raise ValueError('Unsupported PIN block format: {}'.format(request.get('Source PIN block format').decode('utf-8')))
+    def verify_arqc(self, request):
+        """
+        Get response to KQ command (ARQC verification and/or ARPC generation)
+        Scheme ID 0: the card master key is used as the cryptogram key, scheme ID 1: EMV common session key derived with the ATC
+        """
+        response_code = 'KR'
 
-        # Source key parity check
-        if not self.check_key_parity(request.get('TPK')):
-            self._debug_trace('Source TPK parity error')
+        mode = request.get('Mode Flag')
+        scheme = request.get('Scheme ID')
+        if mode not in [b'0', b'1', b'2'] or scheme not in [b'0', b'1']:
+            self._debug_trace('Invalid mode flag or scheme ID')
+            return self._get_static_response(response_code, '15')
+
+        if not self.check_key_parity(request.get('MK-AC')):
+            self._debug_trace('MK-AC parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
-            else:
-                response.set_error_code('10')
-            return response
+                return self._get_static_response(response_code, '00')
+            return self._get_static_response(response_code, '10')
 
-        # Destination key parity check
-        if not self.check_key_parity(request.get('Destination Key')):
-            self._debug_trace('Destination ZPK parity error')
-            if self.approve_all:
+        try:
+            pan_psn = request.get('PAN/PSN').decode('utf-8')
+            atc = B2raw(request.get('ATC'))
+            transaction_data = B2raw(request.get('Transaction Data'))
+            arqc = B2raw(request.get('ARQC'))
+            arc = B2raw(request.get('ARC')) if mode != b'0' else None
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        if len(atc) != 2 or len(arqc) != 8 or (arc is not None and len(arc) != 2):
+            self._debug_trace('Invalid ATC, ARQC or ARC length')
+            return self._get_static_response(response_code, '15')
+
+        clear_imk = self._get_clear_key(request.get('MK-AC'))
+
+        if scheme == b'0':
+            key = self.emv.get_card_key(clear_imk, pan_psn)
+        else:
+            key = self.emv.get_session_key(clear_imk, pan_psn, atc)
+
+        if mode in [b'0', b'1']:
+            expected_arqc = get_mac(key, transaction_data)
+            if expected_arqc != arqc:
+                self._debug_trace('ARQC mismatch: {} != {}'.format(raw2str(expected_arqc), raw2str(arqc)))
+                if not self.approve_all:
+                    return self._get_static_response(response_code, '01')
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+
+        if mode == b'0':
+            return self._get_static_response(response_code, '00')
+
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        response.set('ARPC', raw2B(get_arpc(key, arqc, arc)))
+        return response
+
+
+    def verify_arqcs(self, requests):
+        """
+        Process the batch of KQ requests, e.g. replaying a clearing file.
+        Repeated transactions of the same card reuse the cached card master and session keys.
+        """
+        return [self.verify_arqc(request) for request in requests]
+
+
+    def encrypt_data(self, request):
+        """
+        Get response to M0 (Encrypt Data Block) or M2 (Decrypt Data Block) command.
+        The message is processed in chunks into the preallocated output buffer. In CBC mode the IV
+        to continue with the next part of the message is returned.
+        """
+        decrypt = request.get_command_code() == b'M2'
+        response_code = 'M3' if decrypt else 'M1'
+
+        mode = request.get('Mode Flag')
+        if mode not in [b'00', b'01'] or request.get('Input Format Flag') not in [b'0', b'1', b'2'] \
+                or request.get('Output Format Flag') not in [b'0', b'1'] or request.get('Key Type') not in [b'00A', b'00B']:
+            self._debug_trace('Invalid data encryption parameters')
+            return self._get_static_response(response_code, '15')
+
+        if not self.check_key_parity(request.get('Key')):
+            self._debug_trace('Key parity error')
+            return self._get_static_response(response_code, '10')
+
+        hex_output = request.get('Output Format Flag') == b'1'
+        try:
+            iv = B2raw(request.get('IV')) if mode == b'01' else None
+            cipher = DataCipher(self._get_clear_key(request.get('Key')), mode=int(mode), iv=iv, decrypt=decrypt)
+            message = cipher.update(request.fields.view('Message'), hex_input=request.get('Input Format Flag') == b'1', hex_output=hex_output)
+            if len(message) > 0xFFFF:
+                raise ValueError('Output message is too long: {}'.format(len(message)))
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        if mode == b'01':
+            response.set('IV', raw2B(cipher.iv))
+        response.set('Message Length', str2bytes('{:04X}'.format(len(message))))
+        response.set('Message', message)
+        return response
+
+
+    def generate_mac(self, request):
+        """
+        Get response to M6 (Generate MAC) or M8 (Verify MAC) command.
+        The message may be split over several commands: the first and the middle blocks (mode flags 1 and 2)
+        return the IV to be passed with the next block, the last block (mode flag 3) returns or verifies the MAC.
+        """
+        verify = request.get_command_code() == b'M8'
+        response_code = 'M9' if verify else 'M7'
+
+        mode = request.get('Mode Flag')
+        if mode not in [b'0', b'1', b'2', b'3'] or request.get('Input Format Flag') not in [b'0', b'1', b'2'] \
+                or request.get('MAC Size') not in [b'0', b'1'] or request.get('MAC Algorithm') not in [b'1', b'3'] \
+                or request.get('Padding Method') not in [b'0', b'1', b'2'] or request.get('Key Type') not in [b'003', b'008']:
+            self._debug_trace('Invalid MAC parameters')
+            return self._get_static_response(response_code, '15')
+
+        if not self.check_key_parity(request.get('Key')):
+            self._debug_trace('Key parity error')
+            return self._get_static_response(response_code, '10')
+
+        try:
+            iv = B2raw(request.get('IV')) if mode in [b'2', b'3'] else None
+            if request.get('Input Format Flag') == b'1':
+                message = B2raw(request.get('Message'))
             else:
-                response.set_error_code('11')
+                message = request.fields.view('Message')
+
+            mac = CBCMAC(self._get_clear_key(request.get('Key')), algorithm=int(request.get('MAC Algorithm')), padding=int(request.get('Padding Method')), iv=iv)
+            mac.update(message)
+            result = mac.digest() if mode in [b'0', b'3'] else mac.get_iv()
+        except ValueError as err:
+            self._debug_trace(err)
+            return self._get_static_response(response_code, '15')
+
+        if mode in [b'1', b'2']:
+            response = OutgoingMessage(header=self.header)
+            response.set_response_code(response_code)
+            response.set_error_code('00')
+            response.set('IV', raw2B(result))
             return response
 
-        decrypted_pinblock = self._decrypt_pinblock(request.get('Source PIN block'), request.get('TPK'))
-        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
-        
-        pin_length = decrypted_pinblock[0:2]
+        mac = raw2B(result)[:16 if request.get('MAC Size') == b'1' else 8]
+        if not verify:
+            response = OutgoingMessage(header=self.header)
+            response.set_response_code(response_code)
+            response.set_error_code('00')
+            response.set('MAC', mac)
+            return response
+
+        if mac == request.get('MAC'):
+            return self._get_static_response(response_code, '00')
+
+        self._debug_trace('MAC mismatch: {} != {}'.format(mac.decode('utf-8'), request.get('MAC').decode('utf-8', 'replace')))
+        if self.approve_all:
+            self._debug_trace('Forced approval as --approve-all option set')
+            return self._get_static_response(response_code, '00')
+        return self._get_static_response(response_code, '01')
 
-        destination_key = request.get('Destination Key')
-        if destination_key[0:1] in [b'U']:
-            destination_key = destination_key[1:]
-        cipher = DES3.new(B2raw(destination_key), DES3.MODE_ECB)
-        translated_pin_block = cipher.encrypt(B2raw(decrypted_pinblock))
 
+    def get_diagnostics_data(self):
+        """
+        Get response to NC command
+        """
+        return self.diagnostics_response
+
+
+    def get_loading(self):
+        """
+        Get response to J2 command (Get HSM Loading)
+        """
+        stats = self.stats
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code('J3')
         response.set_error_code('00')
-        response.set('PIN Length', decrypted_pinblock[0:2])
-        response.set('Destination PIN Block', raw2B(translated_pin_block))
-        response.set('Destination PIN Block format', pinblock_format)
+        response.set('Start Time', str2bytes(time.strftime('%y%m%d%H%M%S', time.localtime(stats.started))))
+        response.set('Current Time', str2bytes(time.strftime('%y%m%d%H%M%S')))
+        response.set('Elapsed Time', str2bytes('{:010d}'.format(stats.get_elapsed_time() // 1000000000)))
+        response.set('Busy Time', str2bytes('{:010d}'.format(stats.get_busy_time() // 1000000)))
+        response.set('Load', str2bytes('{:03d}'.format(stats.get_load())))
+        return response
+
+
+    def get_command_volumes(self):
+        """
+        Get response to J4 command (Get Host Command Volumes)
+        """
+        commands = self.stats.get_commands()
+        commands.pop(None, None)
 
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code('J5')
+        response.set_error_code('00')
+        response.set('Number of Commands', str2bytes('{:03d}'.format(len(commands))))
+        for command_code in sorted(commands):
+            response.set('Command ' + command_code.decode('utf-8'), command_code + str2bytes('{:010d}'.format(commands[command_code])))
         return response
 
 
-    def get_diagnostics_data(self):
+    def get_health_check_counts(self):
         """
-        Get response to NC command
+        Get response to J8 command (Get Health Check Accumulated Counts)
         """
+        commands = self.stats.get_commands()
         response = OutgoingMessage(header=self.header)
-        response.set_response_code('ND')
+        response.set_response_code('J9')
         response.set_error_code('00')
-        response.set('LMK Check Value', key_CV(raw2B(self.LMK), 16))
-        response.set('Firmware Version', str2bytes(self.firmware_version))
+        response.set('Requests', str2bytes('{:010d}'.format(sum(commands.values()))))
+        response.set('Errors', str2bytes('{:010d}'.format(self.stats.get_errors())))
+        response.set('Unsupported Commands', str2bytes('{:010d}'.format(commands.get(None, 0))))
         return response
 
 
@@ -802,15 +2942,7 @@ class HSM():
         Get response to BU command
         TODO: return different check values (length of 6 or length of 16)
         """
-        response = OutgoingMessage(header=self.header)
-        response.set_response_code('BV')
-        response.set_error_code('00')
-        
-        key = request.get('Key')
-        if key[0:1] in [b'U']:
-            key = key[1:]
-        response.set('Key Check Value', key_CV(key, 16))
-        return response
+        return self.templates['BV'].fill(key_CV(request.get('Key').encoded, 16))
 
     def generate_key_a0(self, request):
         """
@@ -823,16 +2955,15 @@ class HSM():
         new_clear_key = modify_key_parity(bytes(os.urandom(16)))
         self._debug_trace('Generated key: {}'.format(raw2str(new_clear_key)))
         new_key_under_lmk = self.cipher.encrypt(new_clear_key)
-        response.set('Key under LMK', b'U' + raw2B(new_key_under_lmk))
+        response.set('Key under LMK', Key.from_raw(new_key_under_lmk))
 
-        zmk_under_lmk = request.get('ZMK/TMK')[1:33]
+        zmk_under_lmk = request.get('ZMK/TMK')
         if zmk_under_lmk:
-            clear_zmk = self.cipher.decrypt(B2raw(zmk_under_lmk))
-            zmk_key_cipher = DES3.new(clear_zmk, DES3.MODE_ECB)
+            zmk_key_cipher = self.keys.get(zmk_under_lmk).cipher
             new_key_under_zmk = zmk_key_cipher.encrypt(new_clear_key)
 
-            response.set('Key under ZMK', b'U' + raw2B(new_key_under_zmk))
-            response.set('Key Check Value', key_CV(raw2B(new_clear_key), 6))
+            response.set('Key under ZMK', Key.from_raw(new_key_under_zmk))
+            response.set('Key Check Value', get_check_value(new_clear_key, 6))
 
         return response
 
@@ -841,40 +2972,109 @@ class HSM():
         """
         Get response to FA command
         """
+        response_code = 'FB'
+
+        zmk_under_lmk = request.get('ZMK')
+        if not zmk_under_lmk:
+            self._debug_trace('ERROR: Invalid ZMK')
+            return self._get_static_response(response_code, '01')
+
+        zmk = self.keys.get(zmk_under_lmk)
+        self._debug_trace('Clear ZMK: {}'.format(raw2str(zmk.clear)))
+
+        zmk_key_cipher = zmk.cipher
+
+        zpk_under_zmk = request.get('ZPK')
+        if not zpk_under_zmk:
+            self._debug_trace('ERROR: Invalid ZPK')
+            return self._get_static_response(response_code, '01')
+
+        clear_zpk = zmk_key_cipher.decrypt(zpk_under_zmk.raw)
+        self._debug_trace('Clear ZPK: {}'.format(raw2str(clear_zpk)))
+
+        zpk_under_lmk = self.cipher.encrypt(clear_zpk)
+        if len(zpk_under_lmk) == 16:
+            return self.templates[response_code].fill(Key.from_raw(zpk_under_lmk), get_check_value(zpk_under_lmk, 6))
+
         response = OutgoingMessage(header=self.header)
-        response.set_response_code('FB')
+        response.set_response_code(response_code)
         response.set_error_code('00')
+        response.set('ZPK under LMK', Key.from_raw(zpk_under_lmk))
+        response.set('Key Check Value', get_check_value(zpk_under_lmk, 6))
+        return response
 
-        zmk_under_lmk = request.get('ZMK')[1:33]
-        if zmk_under_lmk:
-            clear_zmk = self.cipher.decrypt(B2raw(zmk_under_lmk))
-            self._debug_trace('Clear ZMK: {}'.format(raw2str(clear_zmk)))
 
-            zmk_key_cipher = DES3.new(clear_zmk, DES3.MODE_ECB)
+    def process_batch(self, request):
+        """
+        Get response to XB command (vendor extension).
+        The batched commands are evaluated (in parallel if batch_workers is set) and their responses are returned in the original order
+        """
+        response_code = 'XC'
 
-            zpk_under_zmk = request.get('ZPK')[1:33]
-            if zpk_under_zmk:
-                clear_zpk = zmk_key_cipher.decrypt(B2raw(zpk_under_zmk))
-                self._debug_trace('Clear ZPK: {}'.format(raw2str(clear_zpk)))
-                
-                zpk_under_lmk = self.cipher.encrypt(clear_zpk)
+        try:
+            number_of_commands = int(request.get('Number of Commands'))
+        except (TypeError, ValueError):
+            number_of_commands = -1
+
+        if number_of_commands != len(request.commands) or request.parsed_length != len(request.data):
+            self._debug_trace('ERROR: Invalid batch')
+            return self._get_static_response(response_code, '15')
+
+        requests = []
+        for command in request.commands:
+            if command[0:2] == b'XB':
+                self._debug_trace('ERROR: Nested batches are not supported')
+                return self._get_static_response(response_code, '15')
+            requests.append(parse_request(command[0:2], command[2:]))
+
+        if self.batch_workers and len(requests) > 1:
+            if not self.batch_executor:
+                self.batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers)
+            responses = self.batch_executor.map(self._get_batched_response, requests)
+        else:
+            responses = map(self._get_batched_response, requests)
 
-                response.set('ZPK under LMK', b'U' + raw2B(zpk_under_lmk))
-                response.set('Key Check Value', key_CV(raw2B(zpk_under_lmk), 6))
-                response.set_error_code('00')
+        response = OutgoingMessage(header=self.header)
+        response.set_response_code(response_code)
+        response.set_error_code('00')
+        response.set('Number of Responses', str2bytes('{:03d}'.format(len(requests))))
+        for i, sub_response in enumerate(responses, 1):
+            data = b''.join(sub_response.fields.values())
+            response.set('Response {:03d}'.format(i), str2bytes('{:04X}'.format(len(data))) + data)
 
-            else:
-                self._debug_trace('ERROR: Invalid ZPK')
-                response.set_error_code('01')
+        return response
 
-        else:
-            self._debug_trace('ERROR: Invalid ZMK')
-            response.set_error_code('01')
 
+    def _get_batched_response(self, request):
+        """
+        Get response to the batched command. The command is counted, its processing time is a part of the XB busy time.
+        The command that fails is answered with the error, the other commands of the batch are not affected
+        """
+        try:
+            response = self._get_response(request)
+        except Exception as err:
+            self._debug_trace('ERROR: Batched command failed: {}'.format(err))
+            response = self._get_error_response(request.get_command_code())
+        self.stats.record(request.get_command_code(), response.get('Error Code'))
         return response
 
 
     def get_response(self, request):
+        """
+        Get response to the request, recording the utilization statistics.
+        The request that fails is recorded as the error (it is answered with the error response by the caller)
+        """
+        started = time.perf_counter_ns()
+        try:
+            response = self._get_response(request)
+        except Exception:
+            self.stats.record(request.get_command_code(), b'15', time.perf_counter_ns() - started)
+            raise
+        self.stats.record(request.get_command_code(), response.get('Error Code'), time.perf_counter_ns() - started)
+        return response
+
+
+    def _get_response(self, request):
         """
         """
         rqst_command_code = request.get_command_code()
@@ -884,8 +3084,14 @@ class HSM():
             return self.get_key_check_value(request)
         elif rqst_command_code == b'NC':
             return self.get_diagnostics_data()
+        elif rqst_command_code in [b'DA', b'EA']:
+            return self.verify_pin_ibm(request)
         elif rqst_command_code in [b'DC', b'EC']:
             return self.verify_pin(request)
+        elif rqst_command_code == b'DE':
+            return self.generate_ibm_offset(request)
+        elif rqst_command_code == b'EE':
+            return self.derive_pin_ibm(request)
         elif rqst_command_code == b'CA':
             return self.translate_pinblock(request)
         elif rqst_command_code == b'CW':
@@ -894,10 +3100,27 @@ class HSM():
             return self.verify_cvv(request)
         elif rqst_command_code == b'FA':
             return self.translate_zpk(request)
+        elif rqst_command_code == b'G0':
+            return self.translate_pinblock_dukpt(request)
+        elif rqst_command_code == b'GQ':
+            return self.verify_pin_dukpt(request)
         elif rqst_command_code == b'HC':
             return self.generate_key(request)
+        elif rqst_command_code == b'J2':
+            return self.get_loading()
+        elif rqst_command_code == b'J4':
+            return self.get_command_volumes()
+        elif rqst_command_code == b'J8':
+            return self.get_health_check_counts()
+        elif rqst_command_code == b'KQ':
+            return self.verify_arqc(request)
+        elif rqst_command_code in [b'M0', b'M2']:
+            return self.encrypt_data(request)
+        elif rqst_command_code in [b'M6', b'M8']:
+            return self.generate_mac(request)
+        elif rqst_command_code == b'XB':
+            return self.process_batch(request)
+        elif rqst_command_code == b'XV':
+            return self.generate_cvvs(request)
         else:
-            response = OutgoingMessage(header=self.header)
-            response.set_response_code('ZZ')
-            response.set_error_code('00')
-            return response
+            return self._get_static_response('ZZ', '00')
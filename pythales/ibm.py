@@ -0,0 +1,94 @@
+from binascii import hexlify
+from Crypto.Cipher import DES, DES3
+
+
+HEX_DIGITS = b'0123456789ABCDEF'
+
+
+def get_decimalization_table(table):
+    """
+    Get the translation table for bytes.translate() from the 16-digit decimalization table, e.g. b'0123456789012345'
+    """
+    if len(table) != 16 or not table.isdigit():
+        raise ValueError('Invalid decimalization table')
+    return bytes.maketrans(HEX_DIGITS, table)
+
+
+def get_validation_block(validation_data, account_number):
+    """
+    Get the raw validation block: the character N in the PIN validation data is replaced by the last 5 digits
+    of the account number, the result is padded on the right with F to 16 hex digits
+    """
+    data = validation_data.replace(b'N', account_number[-5:])
+    if len(data) > 16:
+        raise ValueError('Invalid PIN validation data')
+    return bytes.fromhex(data.ljust(16, b'F').decode('utf-8'))
+
+
+def add_digits(digits1, digits2):
+    """
+    Add two strings of decimal digits digit by digit, modulo 10
+    """
+    return bytes(48 + (i + j - 96) % 10 for i, j in zip(digits1, digits2))
+
+
+def subtract_digits(digits1, digits2):
+    """
+    Subtract two strings of decimal digits digit by digit, modulo 10
+    """
+    return bytes(48 + (i - j) % 10 for i, j in zip(digits1, digits2))
+
+
+class IBM3624():
+    """
+    IBM 3624 PIN offset method with the PVK cipher and the decimalization table prepared once and shared
+    by all the PINs calculated with the same PVK and decimalization table.
+    """
+    def __init__(self, pvk, decimalization_table):
+        if len(pvk) == 8:
+            self.cipher = DES.new(pvk, DES.MODE_ECB)
+        else:
+            self.cipher = DES3.new(pvk, DES3.MODE_ECB)
+        self.table = get_decimalization_table(decimalization_table)
+
+
+    def get_natural_pin(self, validation_data, account_number, length):
+        """
+        Get the intermediate (natural) PIN: the encrypted validation block, decimalized
+        """
+        encrypted = self.cipher.encrypt(get_validation_block(validation_data, account_number))
+        return hexlify(encrypted).upper().translate(self.table)[:length]
+
+
+    def get_offset(self, pin, validation_data, account_number):
+        """
+        Get the 12-character PIN offset, padded on the right with F
+        """
+        natural_pin = self.get_natural_pin(validation_data, account_number, len(pin))
+        return subtract_digits(pin, natural_pin).ljust(12, b'F')
+
+
+    def get_pin(self, offset, validation_data, account_number):
+        """
+        Derive the PIN from the offset (the PIN length is the length of the offset without the padding)
+        """
+        offset = offset.rstrip(b'F')
+        natural_pin = self.get_natural_pin(validation_data, account_number, len(offset))
+        return add_digits(natural_pin, offset)
+
+
+    def verify(self, pin, offset, validation_data, account_number, check_length):
+        """
+        Verify the leftmost check_length digits of the PIN
+        """
+        if len(pin) < check_length or len(offset.rstrip(b'F')) < check_length:
+            return False
+        natural_pin = self.get_natural_pin(validation_data, account_number, check_length)
+        return add_digits(natural_pin, offset[:check_length]) == pin[:check_length]
+
+
+    def get_offsets(self, cards, validation_data):
+        """
+        Get the offsets for the iterable of (account number, PIN)
+        """
+        return [self.get_offset(pin, validation_data, account_number) for account_number, pin in cards]
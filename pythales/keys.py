@@ -0,0 +1,89 @@
+from Crypto.Cipher import DES3
+from pynblock.tools import check_key_parity
+
+from pythales.cache import LRUCache
+from pythales.values import as_key, get_check_value
+
+
+# The key types of the key inventory file
+KEY_TYPES = {'BDK', 'CVK', 'KEY', 'MK-AC', 'PVK', 'PVK PAIR', 'TAK', 'TMK', 'TPK', 'ZAK', 'ZEK', 'ZMK', 'ZPK'}
+
+
+class KeyEntry():
+    """
+    Working key decrypted under the LMK: the clear key and its parity, the cipher and the check value
+    are computed once per key
+    """
+    def __init__(self, clear_key):
+        self.clear = clear_key
+        self.parity = bool(check_key_parity(clear_key))
+
+
+    @property
+    def cipher(self):
+        """
+        Get the ECB cipher of the clear key. Raises ValueError if the key can not be used
+        """
+        try:
+            return self._cipher
+        except AttributeError:
+            self._cipher = DES3.new(self.clear, DES3.MODE_ECB)
+            return self._cipher
+
+
+    @property
+    def check_value(self):
+        """
+        Get the check value of the clear key. Raises ValueError if the key can not be used
+        """
+        try:
+            return self._check_value
+        except AttributeError:
+            self._check_value = get_check_value(self.clear, 6)
+            return self._check_value
+
+
+class KeyStore():
+    """
+    Cache of the working keys encrypted under the LMK, keyed by the hex-encoded key (without the key scheme tag)
+    """
+    def __init__(self, cipher, size=4096):
+        self.cipher = cipher
+        self.cache = LRUCache(size)
+
+
+    def get(self, key):
+        """
+        Get the entry of the key encrypted under the LMK, decrypting the key on the first use.
+        Raises ValueError if the key is not hex-encoded
+        """
+        key = as_key(key)
+        entry = self.cache.get(key.encoded)
+        if entry is None:
+            entry = KeyEntry(self.cipher.decrypt(key.raw))
+            self.cache.set(key.encoded, entry)
+        return entry
+
+
+    def clear(self):
+        """
+        Discard all the cached keys
+        """
+        self.cache.clear()
+
+
+def read_key_inventory(path):
+    """
+    Read the key inventory file: one key per line, the key type followed by the key encrypted under the LMK,
+    e.g. 'TPK U7C2902D82733C779680AD18C70F5A27C'. Blank lines and lines starting with # are skipped.
+    Return the list of (line number, key type, key) tuples
+    """
+    inventory = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key_type, _, key = line.rpartition(' ')
+            inventory.append((line_number, key_type.strip().upper(), key.encode('utf-8')))
+    return inventory
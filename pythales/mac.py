@@ -0,0 +1,98 @@
+from Crypto.Cipher import DES, DES3
+
+
+CHUNK_SIZE = 65536
+
+
+class CBCMAC():
+    """
+    Incremental ISO 9797-1 CBC-MAC.
+
+    Algorithm 1: CBC with the (single or double length) key, algorithm 3: single DES CBC with the left half of the
+    double length key and the final block decrypted with the right half and encrypted again with the left half.
+    Padding method 0: none (the data length must be a multiple of 8), 1: zeros, 2: 0x80 followed by zeros.
+
+    The data passed to update() may be any bytes-like object, the complete blocks are encrypted in CBC mode
+    by the block cipher in chunks, only the incomplete trailing block is kept until the next update.
+    """
+    def __init__(self, key, algorithm=1, padding=1, iv=None):
+        if algorithm not in [1, 3]:
+            raise ValueError('Unsupported MAC algorithm: {}'.format(algorithm))
+        if padding not in [0, 1, 2]:
+            raise ValueError('Unsupported padding method: {}'.format(padding))
+        if algorithm == 3 and len(key) != 16:
+            raise ValueError('MAC algorithm 3 requires double length key')
+
+        self.key = key
+        self.algorithm = algorithm
+        self.padding = padding
+        self.iv = iv if iv else b'\x00' * 8
+        self.length = 0
+        self.pending = b''
+
+        if algorithm == 1 and len(key) != 8:
+            self.cipher = DES3.new(key, DES3.MODE_CBC, self.iv)
+        else:
+            self.cipher = DES.new(key[:8], DES.MODE_CBC, self.iv)
+
+
+    def update(self, data):
+        """
+        MAC the next part of the data
+        """
+        data = memoryview(data)
+        self.length += len(data)
+
+        if self.pending:
+            needed = 8 - len(self.pending)
+            self.pending += bytes(data[:needed])
+            data = data[needed:]
+            if len(self.pending) < 8:
+                return
+            self.iv = self.cipher.encrypt(self.pending)
+            self.pending = b''
+
+        complete = len(data) - len(data) % 8
+        for offset in range(0, complete, CHUNK_SIZE):
+            self.iv = self.cipher.encrypt(data[offset:min(offset + CHUNK_SIZE, complete)])[-8:]
+
+        if complete < len(data):
+            self.pending = bytes(data[complete:])
+
+
+    def get_iv(self):
+        """
+        Get the intermediate result (the IV to continue the MAC calculation with). The data processed so far must be a multiple of 8 bytes long
+        """
+        if self.pending:
+            raise ValueError('Data length is not a multiple of 8')
+        return self.iv
+
+
+    def digest(self):
+        """
+        Pad the data and get the MAC
+        """
+        if self.padding == 0:
+            if self.pending or not self.length:
+                raise ValueError('Data length is not a multiple of 8')
+            last_block = None
+        elif self.padding == 1:
+            last_block = self.pending.ljust(8, b'\x00') if self.pending or not self.length else None
+        else:
+            last_block = (self.pending + b'\x80').ljust(8, b'\x00')
+
+        mac = self.cipher.encrypt(last_block) if last_block else self.iv
+
+        if self.algorithm == 3:
+            mac = DES.new(self.key[:8], DES.MODE_ECB).encrypt(DES.new(self.key[8:], DES.MODE_ECB).decrypt(mac))
+        return mac
+
+
+def get_mac(key, data, algorithm=1, padding=1):
+    """
+    Get ISO 9797-1 MAC of the data
+    """
+    mac = CBCMAC(key, algorithm=algorithm, padding=padding)
+    mac.update(data)
+    return mac.digest()
@@ -0,0 +1,65 @@
+import time
+
+from pythales.cache import LRUCache
+
+
+# The commands never memoized: key generation (A0, HC), utilization statistics and the batches
+# (the batch may contain the key generation commands)
+EXCLUDED_COMMANDS = {b'A0', b'HC', b'J2', b'J4', b'J8', b'XB'}
+
+
+class ResponseMemo():
+    """
+    Cache of the response frames to the deterministic commands.
+
+    The response is a function of the request frame (the length, the header and the command) and the LMK,
+    so the finished response frame is cached by the request frame and the repeated request is answered
+    without parsing and processing it. The entries expire ttl seconds after they are cached.
+    """
+    def __init__(self, size=65536, ttl=60, excluded=None):
+        self.cache = LRUCache(size)
+        self.ttl = ttl
+        self.excluded = EXCLUDED_COMMANDS | set(excluded) if excluded else EXCLUDED_COMMANDS
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, frame, now=None):
+        """
+        Get the cached response frame to the request frame, None if it is not cached or has expired
+        """
+        entry = self.cache.get(frame)
+        if entry is not None:
+            expires, response_data = entry
+            if (now if now is not None else time.monotonic()) < expires:
+                self.hits += 1
+                return response_data
+            # The entry cached by another thread meanwhile is kept
+            self.cache.discard(frame, entry)
+        self.misses += 1
+        return None
+
+
+    def set(self, frame, response_data, command_code, now=None):
+        """
+        Cache the response frame to the request frame, unless the command is excluded
+        """
+        if command_code in self.excluded:
+            return
+        self.cache.set(frame, ((now if now is not None else time.monotonic()) + self.ttl, response_data))
+
+
+    def clear(self):
+        """
+        Discard all the cached responses
+        """
+        self.cache.clear()
+
+
+    def report(self):
+        """
+        Get the hit rate as text
+        """
+        requests = self.hits + self.misses
+        return 'Memoized responses: {}, hits: {}, misses: {}, hit rate: {:.1f}%'.format(
+            len(self.cache), self.hits, self.misses, 100 * self.hits / requests if requests else 0)
@@ -0,0 +1,141 @@
+import random
+import time
+
+
+OVERLOAD_ERROR = '41'
+
+
+def get_response_code(command_code):
+    """
+    Get the response code for the command code, e.g. b'CW' -> 'CX', b'A0' -> 'A1'
+    """
+    return chr(command_code[0]) + chr(command_code[1] + 1)
+
+
+class TokenBucket():
+    """
+    Token bucket limiting the rate of the requests to rate per second, allowing bursts of up to burst requests.
+
+    Instead of waiting for a token, the caller reserves the next one and gets the delay (in seconds) after which
+    the token becomes available, so the waiting may be done without blocking, e.g. with asyncio.sleep()
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+
+    def reserve(self, now=None):
+        """
+        Reserve a token, return the delay in seconds until it is available
+        """
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ServiceTime():
+    """
+    Service time distribution, in milliseconds: fixed:T, uniform:A:B, exp:MEAN or normal:MEAN:SD.
+    A bare number is the fixed service time.
+    """
+    def __init__(self, spec, rng=None):
+        params = spec.split(':')
+        if len(params) == 1:
+            params = ['fixed'] + params
+
+        self.distribution = params[0]
+        try:
+            self.params = [float(param) for param in params[1:]]
+        except ValueError:
+            raise ValueError('Invalid service time: {}'.format(spec))
+
+        expected = {'fixed': 1, 'uniform': 2, 'exp': 1, 'normal': 2}
+        if expected.get(self.distribution) != len(self.params) or any(param < 0 for param in self.params):
+            raise ValueError('Invalid service time: {}'.format(spec))
+        self.rng = rng if rng else random.Random()
+
+
+    def sample(self):
+        """
+        Get the random service time, in seconds
+        """
+        if self.distribution == 'fixed':
+            value = self.params[0]
+        elif self.distribution == 'uniform':
+            value = self.rng.uniform(*self.params)
+        elif self.distribution == 'exp':
+            value = self.rng.expovariate(1 / self.params[0]) if self.params[0] else 0
+        else:
+            value = max(0, self.rng.gauss(*self.params))
+        return value / 1000
+
+
+def parse_service_times(spec, rng=None):
+    """
+    Parse the per-command service times, e.g. 'NC=0.1,CW=uniform:2:4,*=exp:1' (* is any other command)
+    """
+    rng = rng if rng else random.Random()
+    service_times = {}
+    for item in spec.split(','):
+        try:
+            command_code, service_time = item.split('=')
+        except ValueError:
+            raise ValueError('Invalid service time: {}'.format(item))
+        command_code = command_code.strip()
+        key = None if command_code == '*' else bytes(command_code, 'utf-8')
+        service_times[key] = ServiceTime(service_time.strip(), rng)
+    return service_times
+
+
+class PerformanceModel():
+    """
+    Capacity and latency model of a licence-limited HSM: the requests are admitted up to max_in_flight
+    (the rest are rejected with the overload error), paced to the licensed number of calls per second
+    by the token bucket, and answered after the service time of the command.
+
+    The model only calculates the delays, so the server applies them without blocking, with asyncio.sleep().
+    """
+    def __init__(self, cps=None, burst=1, service_times=None, max_in_flight=None):
+        self.bucket = TokenBucket(cps, burst) if cps else None
+        self.service_times = service_times if service_times else {}
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+
+
+    def admit(self):
+        """
+        Admit the request, return False if there are too many requests in flight
+        """
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+
+    def release(self):
+        """
+        Complete the admitted request
+        """
+        self.in_flight -= 1
+
+
+    def get_queue_delay(self):
+        """
+        Get the delay (in seconds) until the request may be processed under the calls per second licence
+        """
+        return self.bucket.reserve() if self.bucket else 0
+
+
+    def get_service_time(self, command_code):
+        """
+        Get the random service time (in seconds) of the command
+        """
+        service_time = self.service_times.get(command_code, self.service_times.get(None))
+        return service_time.sample() if service_time else 0
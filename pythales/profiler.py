@@ -0,0 +1,78 @@
+import cProfile
+import math
+import time
+
+
+class Profiler():
+    """
+    Collect per-stage timings of the HSM request processing pipeline (recv, parse_message, parse_request, get_response, build, send, trace)
+    and of the handler internals (key decryption, PIN/CVV calculation).
+
+    Optionally the get_response() calls for the given command code are run under cProfile.
+    """
+    def __init__(self, command_code=None):
+        self.timings = {}
+        self.command_code = command_code
+        self.cprofile = cProfile.Profile() if command_code else None
+
+
+    def start(self):
+        """
+        Get the monotonic timestamp (in nanoseconds) to start measuring a stage
+        """
+        return time.perf_counter_ns()
+
+
+    def record(self, stage, started):
+        """
+        Record the time passed since started and return the current timestamp, so that the stages could be chained
+        """
+        now = time.perf_counter_ns()
+        try:
+            self.timings[stage].append(now - started)
+        except KeyError:
+            self.timings[stage] = [now - started]
+        return now
+
+
+    def runcall(self, command_code, func, *args):
+        """
+        Call func, profiling it with cProfile if the command code is the one being profiled
+        """
+        if self.cprofile and command_code == self.command_code:
+            return self.cprofile.runcall(func, *args)
+        return func(*args)
+
+
+    def percentile(self, stage, percent):
+        """
+        Get the nearest-rank percentile of the stage timings, in nanoseconds
+        """
+        timings = sorted(self.timings.get(stage, []))
+        if not timings:
+            return None
+        rank = max(int(math.ceil(percent / 100.0 * len(timings))), 1)
+        return timings[rank - 1]
+
+
+    def report(self, percentiles=(50, 90, 99)):
+        """
+        Get the per-stage timings breakdown
+        """
+        if not self.timings:
+            return ''
+
+        width = max(len(stage) for stage in self.timings)
+        dump = '\t[' + 'Stage'.ljust(width, ' ') + ']: count ' + ' '.join('p{}(us)'.format(p).rjust(10, ' ') for p in percentiles) + '\n'
+        for stage in self.timings:
+            dump += '\t[' + stage.ljust(width, ' ') + ']: {} '.format(str(len(self.timings[stage])).rjust(5, ' '))
+            dump += ' '.join('{:.1f}'.format(self.percentile(stage, p) / 1000.0).rjust(10, ' ') for p in percentiles) + '\n'
+        return dump
+
+
+    def dump_stats(self, filename):
+        """
+        Write the cProfile statistics of the profiled command to the file (readable with pstats)
+        """
+        if self.cprofile:
+            self.cprofile.dump_stats(filename)
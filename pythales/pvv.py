@@ -0,0 +1,25 @@
+from binascii import hexlify
+
+from pythales.cvv import get_digits
+from pythales.des import decrypt_blocks, encrypt_blocks
+
+
+def get_visa_pvvs(cards):
+    """
+    Get the Visa PVVs of the batch of the cards, the list of (PVK pair, account number, PVKI, PIN).
+    The PVVs are the same as calculated by pynblock get_visa_pvv(): the halves of the PVK pair are the keys
+    of the transformed security parameter (TSP) encryption
+    """
+    left_keys, right_keys, tsps = [], [], []
+    for pvk, account_number, key_index, pin in cards:
+        if len(pvk) != 32:
+            raise ValueError('Incorrect key length')
+        left_keys.append(pvk[:16])
+        right_keys.append(pvk[16:])
+        tsps.append(bytes.fromhex((account_number[-12:-1] + key_index + pin[:4]).decode('utf-8')))
+    if not tsps:
+        return []
+
+    encrypted = encrypt_blocks(left_keys, decrypt_blocks(right_keys, encrypt_blocks(left_keys, b''.join(tsps))))
+    encrypted = hexlify(encrypted).upper()
+    return [get_digits(encrypted[i:i + 16], 4) for i in range(0, len(encrypted), 16)]
@@ -0,0 +1,462 @@
+import bisect
+import struct
+import zlib
+
+from multiprocessing import Array, Lock, Semaphore, Process
+from multiprocessing.shared_memory import SharedMemory
+
+from pythales.hsm import HSM
+from pythales.values import KEY_SCHEMES, as_key
+from pynblock.tools import str2bytes
+
+
+STOP_TAG = 0xFFFFFFFF
+
+# The slot fits the frame of the maximum length: the 2-byte length and up to 0xFFFF bytes of the message
+MAX_FRAME_SIZE = 2 + 0xFFFF
+
+# The routing key of the affinity dispatch is the first key of the request (the key used to decrypt the PIN block or
+# the data): the request field of the key, the offset of the key in the command data and the length of the key without
+# the key scheme tag. The key is taken from the frame without parsing the request, the offsets follow the request classes
+ROUTING_KEYS = {
+    b'BU': ('Key', 3, None),
+    b'CA': ('TPK', 0, None),
+    b'CW': ('CVK', 0, None),
+    b'CY': ('CVK', 0, None),
+    b'DA': ('TPK', 0, 16),
+    b'DC': ('TPK', 0, None),
+    b'DE': ('PVK', 0, 16),
+    b'EA': ('ZPK', 0, 16),
+    b'EC': ('ZPK', 0, None),
+    b'EE': ('PVK', 0, 16),
+    b'FA': ('ZMK', 0, None),
+    b'G0': ('BDK', 0, 32),
+    b'GQ': ('BDK', 0, 32),
+    b'KQ': ('MK-AC', 2, 32),
+    b'M0': ('Key', 7, 16),
+    b'M2': ('Key', 7, 16),
+    b'M6': ('Key', 8, 16),
+    b'M8': ('Key', 8, 16),
+    b'XV': ('CVK', 0, None),
+}
+
+# The key types of the key inventory routed by the key. The keys of the other types are also used as the second key
+# of the requests (the ZPK of CA and G0, the PVK pair of DC, EC and GQ, the ZMK of FA) and are warmed up by all the workers
+ROUTED_KEY_TYPES = {'TPK', 'CVK', 'BDK', 'MK-AC', 'KEY'}
+
+
+class FrameRing():
+    """
+    Ring of fixed-size slots in shared memory, carrying raw frames between processes without serialization.
+
+    The ring starts with the head and tail counters, followed by the slots. Each slot holds the frame tag (used
+    to correlate requests and responses), the frame length and the frame itself. Free and used slots are signalled
+    with semaphores, the producers and the consumers are serialized by their own locks.
+    """
+    counters = struct.Struct('!II')
+    slot_header = struct.Struct('!II')
+
+    def __init__(self, slots=64, slot_size=MAX_FRAME_SIZE):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.slot_length = self.slot_header.size + slot_size
+        self.shm = SharedMemory(create=True, size=self.counters.size + slots * self.slot_length)
+        self.counters.pack_into(self.shm.buf, 0, 0, 0)
+
+        self.free = Semaphore(slots)
+        self.used = Semaphore(0)
+        self.put_lock = Lock()
+        self.get_lock = Lock()
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = SharedMemory(name=state['shm'])
+
+
+    def put(self, tag, frame):
+        """
+        Copy the frame to the next free slot, waiting for one if the ring is full
+        """
+        length = len(frame)
+        if length > self.slot_size:
+            raise ValueError('Frame of length {} does not fit the slot of size {}'.format(length, self.slot_size))
+
+        self.free.acquire()
+        with self.put_lock:
+            buf = self.shm.buf
+            head = self.counters.unpack_from(buf, 0)[0]
+            offset = self.counters.size + (head % self.slots) * self.slot_length
+            self.slot_header.pack_into(buf, offset, tag, length)
+            offset += self.slot_header.size
+            buf[offset:offset + length] = frame
+            struct.pack_into('!I', buf, 0, (head + 1) & 0xFFFFFFFF)
+        self.used.release()
+
+
+    def get(self):
+        """
+        Get (tag, frame) from the oldest used slot, waiting for one if the ring is empty
+        """
+        self.used.acquire()
+        with self.get_lock:
+            buf = self.shm.buf
+            tail = self.counters.unpack_from(buf, 0)[1]
+            offset = self.counters.size + (tail % self.slots) * self.slot_length
+            tag, length = self.slot_header.unpack_from(buf, offset)
+            offset += self.slot_header.size
+            frame = bytes(buf[offset:offset + length])
+            struct.pack_into('!I', buf, 4, (tail + 1) & 0xFFFFFFFF)
+        self.free.release()
+        return tag, frame
+
+
+    def close(self):
+        """
+        """
+        self.shm.close()
+
+
+    def unlink(self):
+        """
+        """
+        self.shm.close()
+        self.shm.unlink()
+
+
+class WorkerSettings():
+    """
+    Runtime settings of the worker processes in shared memory (the settings generation, the debug mode and approving
+    all the requests), so that the settings reloaded in the front end are applied by all the workers
+    """
+    def __init__(self, debug=False, approve_all=False):
+        self.values = Array('i', [0, int(bool(debug)), int(bool(approve_all))])
+
+
+    def set(self, debug, approve_all):
+        """
+        Change the settings, starting a new generation
+        """
+        with self.values.get_lock():
+            self.values[0] += 1
+            self.values[1] = int(bool(debug))
+            self.values[2] = int(bool(approve_all))
+
+
+    def get(self):
+        """
+        Get the (generation, debug, approve all) tuple
+        """
+        with self.values.get_lock():
+            generation, debug, approve_all = self.values[:]
+        return generation, bool(debug), bool(approve_all)
+
+
+def run_worker(requests, responses, hsm_args, inventory=None, settings=None, ready=None):
+    """
+    Crypto worker process: get the request frames from the requests ring and put the response frames to the responses ring.
+    An empty response is returned for the frame that could not be parsed, the error response for the request that could not
+    be processed, so that every request is answered and the worker survives. The keys of the key inventory are warmed up
+    before the first request is taken, then the worker signals the ready semaphore. The settings changed since the previous
+    request are applied before the request is processed.
+    """
+    hsm = HSM(**hsm_args)
+    if inventory:
+        hsm.warm_up(inventory)
+    if ready:
+        ready.release()
+    generation = 0
+    while True:
+        tag, frame = requests.get()
+        if tag == STOP_TAG:
+            break
+
+        if settings:
+            current, debug, approve_all = settings.get()
+            if current != generation:
+                generation = current
+                hsm.reload(debug=debug, approve_all=approve_all)
+
+        try:
+            response_data = hsm.process(frame)
+            if len(response_data) > responses.slot_size:
+                raise ValueError('Response of length {} does not fit the slot'.format(len(response_data)))
+        except Exception:
+            response_data = hsm._get_error_response(hsm._get_frame_command_code(frame)).build()
+        responses.put(tag, response_data)
+
+    requests.close()
+    responses.close()
+
+
+class RingDispatcher():
+    """
+    Dispatch the raw request frames from the network front end to the crypto worker processes through the shared memory rings.
+    The number of requests in flight should not exceed the number of slots (max_in_flight), otherwise the workers block
+    on the full responses ring.
+    """
+    def __init__(self, workers=2, slots=64, slot_size=MAX_FRAME_SIZE, inventory=None, **hsm_args):
+        self.workers = workers
+        self.max_in_flight = slots
+        self.inventory = inventory
+        self.requests = FrameRing(slots, slot_size)
+        self.responses = FrameRing(slots, slot_size)
+        self.hsm_args = hsm_args
+        self.settings = WorkerSettings(hsm_args.get('debug'), hsm_args.get('approve_all'))
+        self.ready = Semaphore(0)
+        self.processes = []
+
+
+    def start(self):
+        """
+        Start the workers and wait until they have warmed up their key stores
+        """
+        for i in range(self.workers):
+            process = Process(target=run_worker, args=(self.requests, self.responses, self.hsm_args, self.inventory, self.settings, self.ready), daemon=True)
+            process.start()
+            self.processes.append(process)
+        for process in self.processes:
+            self.ready.acquire()
+
+
+    def submit(self, tag, frame):
+        """
+        Send the request frame to the workers
+        """
+        self.requests.put(tag, frame)
+
+
+    def collect(self):
+        """
+        Get the next completed (tag, response frame)
+        """
+        return self.responses.get()
+
+
+    def reload(self, debug, approve_all):
+        """
+        Change the runtime settings of the workers, applied by each worker before its next request
+        """
+        self.settings.set(debug, approve_all)
+
+
+    def stop(self):
+        """
+        Stop the workers and release the shared memory
+        """
+        for process in self.processes:
+            self.requests.put(STOP_TAG, b'')
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+        self.requests.unlink()
+        self.responses.unlink()
+
+
+class HashRing():
+    """
+    Consistent hash ring of the workers. Each worker is placed on the ring at a number of points and owns the keys
+    hashed between its point and the previous one, so adding or removing a worker moves only the keys
+    of the arcs it gains or loses.
+    """
+    def __init__(self, workers=(), points=64):
+        self.points = points
+        self.hashes = []
+        self.owners = []
+        for worker in workers:
+            self.add(worker)
+
+
+    def add(self, worker):
+        """
+        Place the worker on the ring
+        """
+        for i in range(self.points):
+            point = zlib.crc32('{}-{}'.format(worker, i).encode('utf-8'))
+            index = bisect.bisect(self.hashes, point)
+            self.hashes.insert(index, point)
+            self.owners.insert(index, worker)
+
+
+    def remove(self, worker):
+        """
+        Remove the worker from the ring
+        """
+        points = [(point, owner) for point, owner in zip(self.hashes, self.owners) if owner != worker]
+        self.hashes = [point for point, owner in points]
+        self.owners = [owner for point, owner in points]
+
+
+    def get(self, key):
+        """
+        Get the worker owning the key (bytes), None if the ring is empty
+        """
+        if not self.owners:
+            return None
+        index = bisect.bisect(self.hashes, zlib.crc32(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+class AffinityDispatcher():
+    """
+    Dispatch the raw request frames to the crypto worker processes by the key the request uses.
+
+    The requests are routed by the consistent hash of the first key of the request (the TPK, ZPK, CVK, BDK, etc.,
+    see ROUTING_KEYS), taken from the frame without parsing the request, so the requests using the same key are processed
+    by the same worker, and each worker keeps only its share of the routed keys in its key store. Each worker has its own requests ring,
+    the responses are collected from the shared responses ring. The requests without a key are distributed round robin.
+    """
+    def __init__(self, workers=2, slots=64, slot_size=MAX_FRAME_SIZE, points=64, inventory=None, **hsm_args):
+        self.workers = workers
+        self.max_in_flight = slots
+        self.slots = slots
+        self.slot_size = slot_size
+        self.inventory = inventory
+        self.hsm_args = hsm_args
+        self.settings = WorkerSettings(hsm_args.get('debug'), hsm_args.get('approve_all'))
+        self.ready = Semaphore(0)
+        header = hsm_args.get('header')
+        self.header = str2bytes(header) if header else b''
+        self.ring = HashRing(points=points)
+        self.responses = FrameRing(slots, slot_size)
+        self.requests = {}
+        self.processes = {}
+        self.routed = {}
+        self.next_worker = 0
+        self.round_robin = 0
+
+
+    def start(self):
+        """
+        Start the workers and wait until they have warmed up their key stores
+        """
+        for i in range(self.workers):
+            self._start_worker()
+        for i in range(self.workers):
+            self.ready.acquire()
+
+
+    def _get_inventory(self, worker):
+        """
+        Get the part of the key inventory warmed up by the worker: its share of the routed keys and all the other keys
+        """
+        if not self.inventory:
+            return None
+        return [(line_number, key_type, key) for line_number, key_type, key in self.inventory
+            if key_type not in ROUTED_KEY_TYPES or self.ring.get(as_key(key).encoded) == worker]
+
+
+    def _start_worker(self):
+        """
+        Start a new worker process placed on the hash ring. Return the worker id
+        """
+        worker = self.next_worker
+        self.next_worker += 1
+        self.ring.add(worker)
+        self.requests[worker] = FrameRing(self.slots, self.slot_size)
+        self.routed[worker] = 0
+        process = Process(target=run_worker, args=(self.requests[worker], self.responses, self.hsm_args, self._get_inventory(worker), self.settings, self.ready), daemon=True)
+        process.start()
+        self.processes[worker] = process
+        return worker
+
+
+    def add_worker(self):
+        """
+        Start a new worker process placed on the hash ring and wait until it has warmed up its key store. Return the worker id
+        """
+        worker = self._start_worker()
+        self.ready.acquire()
+        return worker
+
+
+    def remove_worker(self, worker):
+        """
+        Remove the worker from the hash ring and stop it once it has processed the requests already submitted to it
+        """
+        self.ring.remove(worker)
+        requests = self.requests.pop(worker)
+        requests.put(STOP_TAG, b'')
+        self.processes.pop(worker).join()
+        requests.unlink()
+        del self.routed[worker]
+
+
+    def get_routing_key(self, frame):
+        """
+        Get the key the request frame is routed by, None if the request has no key or the frame is invalid
+        """
+        offset = 2 + len(self.header)
+        if frame[2:offset] != self.header:
+            return None
+        routing_key = ROUTING_KEYS.get(bytes(frame[offset:offset + 2]))
+        if routing_key is None:
+            return None
+
+        field, key_offset, key_length = routing_key
+        offset += 2 + key_offset
+        if frame[offset:offset + 1] in KEY_SCHEMES:
+            offset += 1
+            key_length = 32
+        if key_length is None or len(frame) < offset + key_length:
+            return None
+        return bytes(frame[offset:offset + key_length])
+
+
+    def get_worker(self, frame):
+        """
+        Get the worker the request frame is routed to
+        """
+        key = self.get_routing_key(frame)
+        if key is not None:
+            return self.ring.get(key)
+
+        workers = list(self.requests)
+        self.round_robin = (self.round_robin + 1) % len(workers)
+        return workers[self.round_robin]
+
+
+    def submit(self, tag, frame):
+        """
+        Send the request frame to the worker it is routed to
+        """
+        worker = self.get_worker(frame)
+        self.routed[worker] += 1
+        self.requests[worker].put(tag, frame)
+
+
+    def collect(self):
+        """
+        Get the next completed (tag, response frame)
+        """
+        return self.responses.get()
+
+
+    def reload(self, debug, approve_all):
+        """
+        Change the runtime settings of the workers, applied by each worker before its next request
+        """
+        self.settings.set(debug, approve_all)
+
+
+    def report(self):
+        """
+        Get the number of the requests routed to each worker as text
+        """
+        return 'Requests routed to the workers: {}'.format(', '.join('{}: {}'.format(worker, routed) for worker, routed in self.routed.items()))
+
+
+    def stop(self):
+        """
+        Stop the workers and release the shared memory
+        """
+        for worker in list(self.processes):
+            self.remove_worker(worker)
+        self.responses.unlink()
@@ -0,0 +1,119 @@
+import asyncio
+
+from collections import deque
+
+
+# Priority classes, from the highest priority to the lowest
+HEALTH = 0
+AUTHORIZATION = 1
+BULK = 2
+
+CLASS_NAMES = {'health': HEALTH, 'auth': AUTHORIZATION, 'bulk': BULK}
+
+COMMAND_CLASSES = {
+    b'NC': HEALTH, b'J2': HEALTH, b'J4': HEALTH, b'J8': HEALTH,
+    b'CA': AUTHORIZATION, b'CY': AUTHORIZATION, b'DA': AUTHORIZATION, b'DC': AUTHORIZATION, b'EA': AUTHORIZATION,
+    b'EC': AUTHORIZATION, b'G0': AUTHORIZATION, b'GQ': AUTHORIZATION, b'KQ': AUTHORIZATION, b'M8': AUTHORIZATION,
+}
+
+
+def parse_class_limits(spec):
+    """
+    Parse the per-class limits, e.g. 'health:100,auth:1000,bulk:50', to the dictionary {class: limit}
+    """
+    limits = {}
+    for item in spec.split(','):
+        try:
+            name, limit = item.split(':')
+            limits[CLASS_NAMES[name.strip()]] = int(limit)
+        except (KeyError, ValueError):
+            raise ValueError('Invalid class limit: {}'.format(item))
+    return limits
+
+
+class Scheduler():
+    """
+    Priority scheduler of the requests of the concurrent server.
+
+    Up to concurrency requests are processed at once, the rest wait in the queue of their priority class
+    (health/diagnostics, authorization, bulk/key generation). A free slot is given to the oldest request
+    of the highest priority class. The request is shed (rejected with the busy error) if the queue of its class
+    is full, or if it waits longer than the deadline of its class.
+    """
+    def __init__(self, concurrency=1, queue_limits=None, deadlines=None):
+        self.concurrency = concurrency
+        self.queue_limits = queue_limits if queue_limits else {}
+        self.deadlines = deadlines if deadlines else {}
+        self.queues = [deque() for i in range(len(CLASS_NAMES))]
+        self.running = 0
+        self.shed = [0] * len(CLASS_NAMES)
+
+
+    def get_class(self, command_code):
+        """
+        Get the priority class of the command
+        """
+        return COMMAND_CLASSES.get(command_code, BULK)
+
+
+    async def acquire(self, command_code):
+        """
+        Wait for the processing slot. Return False if the request is shed
+        """
+        for queue in self.queues:
+            # The waiters shed or cancelled are not waiting for the slot any more
+            while queue and queue[0].done():
+                queue.popleft()
+        if self.running < self.concurrency and not any(self.queues):
+            self.running += 1
+            return True
+
+        priority = self.get_class(command_code)
+        queue = self.queues[priority]
+        limit = self.queue_limits.get(priority)
+        if limit is not None and len(queue) >= limit:
+            self.shed[priority] += 1
+            return False
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue.append(future)
+
+        deadline = self.deadlines.get(priority)
+        timer = loop.call_later(deadline, self._expire, priority, future) if deadline is not None else None
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                queue.remove(future)
+            elif future.result():
+                # The slot was given to the request cancelled before it resumed
+                self.release()
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+
+
+    def release(self):
+        """
+        Free the processing slot and pass it to the next queued request
+        """
+        self.running -= 1
+        for queue in self.queues:
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    self.running += 1
+                    future.set_result(True)
+                    return
+
+
+    def _expire(self, priority, future):
+        """
+        Shed the request that has not got the processing slot before the deadline
+        """
+        if not future.done():
+            self.queues[priority].remove(future)
+            self.shed[priority] += 1
+            future.set_result(False)
@@ -0,0 +1,124 @@
+import threading
+import time
+
+
+class Counters():
+    """
+    Counters of a single thread. Only the owning thread updates them, so no locking is needed
+    """
+    def __init__(self):
+        self.commands = {}
+        self.errors = 0
+        self.busy_time = 0
+
+
+class Stats():
+    """
+    HSM utilization statistics: per-command transaction counts, error count and busy time.
+
+    Each thread processing the requests updates its own counters, the counters of all the threads are aggregated
+    only when the statistics are requested. Resetting the statistics takes a snapshot of the aggregated counters
+    to subtract it later, so the counters themselves are never modified by other threads.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.counters = []
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def _get_counters(self):
+        """
+        Get the counters of the current thread
+        """
+        try:
+            return self.local.counters
+        except AttributeError:
+            counters = self.local.counters = Counters()
+            with self.lock:
+                self.counters.append(counters)
+            return counters
+
+
+    def record(self, command_code, error_code, busy_time=0):
+        """
+        Record the processed request, busy_time is the processing time in nanoseconds
+        """
+        counters = self._get_counters()
+        counters.commands[command_code] = counters.commands.get(command_code, 0) + 1
+        if error_code != b'00':
+            counters.errors += 1
+        counters.busy_time += busy_time
+
+
+    def _aggregate(self):
+        """
+        Get (per-command counts, errors, busy time) summed over all the threads
+        """
+        commands = {}
+        errors = busy_time = 0
+        with self.lock:
+            counters = list(self.counters)
+        for thread_counters in counters:
+            for command_code, count in list(thread_counters.commands.items()):
+                commands[command_code] = commands.get(command_code, 0) + count
+            errors += thread_counters.errors
+            busy_time += thread_counters.busy_time
+        return commands, errors, busy_time
+
+
+    def reset(self):
+        """
+        Start collecting the statistics from now on
+        """
+        self.started = time.time()
+        self.started_ns = time.perf_counter_ns()
+        self.baseline = self._aggregate()
+
+
+    def get_commands(self):
+        """
+        Get the dictionary of the transaction counts per command code (None for the unsupported commands)
+        """
+        commands, _, _ = self._aggregate()
+        baseline = self.baseline[0]
+        counts = {command_code: count - baseline.get(command_code, 0) for command_code, count in commands.items()}
+        return {command_code: count for command_code, count in counts.items() if count}
+
+
+    def get_requests(self):
+        """
+        Get the total number of the processed requests
+        """
+        return sum(self.get_commands().values())
+
+
+    def get_errors(self):
+        """
+        Get the number of the responses with an error code other than 00
+        """
+        return self._aggregate()[1] - self.baseline[1]
+
+
+    def get_busy_time(self):
+        """
+        Get the time spent processing the requests, in nanoseconds
+        """
+        return self._aggregate()[2] - self.baseline[2]
+
+
+    def get_elapsed_time(self):
+        """
+        Get the time passed since the statistics were reset, in nanoseconds
+        """
+        return time.perf_counter_ns() - self.started_ns
+
+
+    def get_load(self):
+        """
+        Get the load percentage: the share of the elapsed time the HSM was busy processing the requests
+        """
+        elapsed = self.get_elapsed_time()
+        if not elapsed:
+            return 0
+        return min(100, 100 * self.get_busy_time() // elapsed)
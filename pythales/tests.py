@@ -1,8 +1,37 @@
 #!/usr/bin/env python
 
+import asyncio
+import os
+import socket
+import tempfile
+import threading
 import unittest
 
-from pythales.hsm import HSM, OutgoingMessage, DummyMessage, A0, BU, CA, CW, CY, DC, EC, HC, NC, parse_message
+from Crypto.Cipher import DES, DES3
+
+from pythales.dukpt import DUKPT, derive_ipek, derive_key, get_pin_key
+from pythales.batcher import PinBlockBatcher
+from pythales.client import AsyncClient, Client, FrameWriter, build_a0, build_bu, build_ca, build_cw, build_cy, build_da, build_dc, build_de, build_ea, build_ec, build_ee, build_fa, build_g0, build_gq, build_hc, build_j2, build_j4, build_j8, build_kq, build_m0, build_m2, build_m6, build_m8, build_nc, build_xb, build_xv
+from pythales.cache import LRUCache
+from pythales.cvv import CVV, get_digits, get_visa_cvvs
+from pythales.data import DataCipher, MODE_CBC
+from pythales import des
+from pythales.des import decrypt_blocks, encrypt_blocks
+from pythales.handoff import ListenerHandoff, take_over
+from pythales.ibm import IBM3624, get_decimalization_table, get_validation_block
+from pythales.keys import KeyStore, read_key_inventory
+from pythales.emv import EMV, derive_card_master_key, derive_session_key, get_mac, get_arpc
+from pythales.memo import ResponseMemo
+from pythales.mac import CBCMAC, get_mac as get_iso9797_mac
+from pythales.model import PerformanceModel, ServiceTime, TokenBucket, get_response_code, parse_service_times
+from pythales.profiler import Profiler
+from pythales.pvv import get_visa_pvvs
+from pynblock.tools import get_visa_pvv, key_CV
+from pythales.stats import Stats
+from pythales.scheduler import Scheduler, HEALTH, AUTHORIZATION, BULK, parse_class_limits
+from pythales.ring import ROUTING_KEYS, AffinityDispatcher, FrameRing, HashRing, RingDispatcher
+from pythales.values import Key, PinBlock, as_key, get_check_value
+from pythales.hsm import HSM, OutgoingMessage, ResponseTemplate, StaticMessage, DummyMessage, Fields, A0, BU, CA, CW, CY, DA, DC, DE, EA, EC, EE, G0, GQ, HC, J2, J4, J8, KQ, M0, M2, M6, M8, NC, XB, XV, parse_message, parse_request
 
 
 class TestDummyMessage(unittest.TestCase):
@@ -25,6 +54,45 @@ class TestDummyMessage(unittest.TestCase):
         self.message.set('IDDQD', b'00')
         self.assertEqual(self.message.trace(), '\t[IDDQD]: [00]\n')
 
+class TestFields(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.fields = Fields(b'IDDQDIDKFA')
+        self.fields.define('God Mode', 0, 5)
+        self.fields.define('All Weapons', 5, 10)
+
+    def test_fields_not_materialized(self):
+        self.assertEqual(self.fields.values, {})
+
+    def test_fields_get(self):
+        self.assertEqual(self.fields['All Weapons'], b'IDKFA')
+        self.assertEqual(self.fields.values, {'All Weapons': b'IDKFA'})
+
+    def test_fields_get_non_existent(self):
+        with self.assertRaises(KeyError):
+            self.fields['IDCLIP']
+
+    def test_fields_order(self):
+        self.fields['IDCLIP'] = b'1'
+        self.assertEqual(list(self.fields.items()), [('God Mode', b'IDDQD'), ('All Weapons', b'IDKFA'), ('IDCLIP', b'1')])
+
+    def test_fields_len(self):
+        self.assertEqual(len(self.fields), 2)
+
+    def test_fields_delete(self):
+        del self.fields['God Mode']
+        self.assertEqual(list(self.fields), ['All Weapons'])
+
+    def test_request_trace_shows_all_fields(self):
+        request = BU(b'021UA97831862E31CCC36E854FE184EE6453')
+        self.assertEqual(request.trace(), 
+            '\t[Command Description]: [Generate a Key check value]\n'
+            '\t[Key Type Code  ]: [02]\n'
+            '\t[Key Length Flag]: [1]\n'
+            '\t[Key            ]: [UA97831862E31CCC36E854FE184EE6453]\n')
+
+
 class TestParseMessage(unittest.TestCase):
     """
     """
@@ -66,6 +134,49 @@ class TestOutgoingMessageClass(unittest.TestCase):
         self.assertEqual(m.build(), b'\x00\x0BNG007444321')
 
 
+class TestStaticMessageClass(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        self.m = StaticMessage(header=b'XXXX', response_code='NG', error_code='00', fields=[('Data', b'7444321')])
+
+    def test_static_message_build(self):
+        self.assertEqual(self.m.build(), b'\x00\x0FXXXXNG007444321')
+
+    def test_static_message_get(self):
+        self.assertEqual(self.m.get('Error Code'), b'00')
+
+    def test_static_message_set(self):
+        with self.assertRaises(TypeError):
+            self.m.set('Data', b'IDDQD')
+
+
+class TestResponseTemplate(unittest.TestCase):
+    def setUp(self):
+        self.template = ResponseTemplate(header=b'XXXX', response_code='CX', fields=[('CVV', 3)])
+
+    def test_fill(self):
+        self.assertEqual(self.template.fill(b'611').build(), b'\x00\x0bXXXXCX00611')
+
+    def test_fill_does_not_modify_template(self):
+        self.template.fill(b'611')
+        self.assertEqual(self.template.fill(b'007').build(), b'\x00\x0bXXXXCX00007')
+
+    def test_fields(self):
+        response = self.template.fill(b'611')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('CVV'), b'611')
+        self.assertEqual(list(response.fields), ['Response Code', 'Error Code', 'CVV'])
+
+    def test_value_does_not_fit(self):
+        with self.assertRaisesRegex(ValueError, 'Value of length 4 does not fit the field of length 3'):
+            self.template.fill(b'6111')
+
+    def test_set(self):
+        with self.assertRaises(TypeError):
+            self.template.fill(b'611').set('CVV', b'007')
+
+
 class TestMessageGet(unittest.TestCase):
     def setUp(self):
         self.m = OutgoingMessage(header=None)
@@ -149,6 +260,9 @@ class TestDC(unittest.TestCase):
     def test_DC_desciprion(self):
         self.assertEqual(self.dc.description, 'Verify PIN')
 
+    def test_DC_fields_deferred(self):
+        self.assertEqual(self.dc.fields.values, {})
+
 
 class TestCA(unittest.TestCase):
     """
@@ -343,6 +457,198 @@ class TestBU(unittest.TestCase):
 
 
 
+class TestXB(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'0020002NC0026BU021UA97831862E31CCC36E854FE184EE6453'
+        self.xb = XB(data)
+
+    def test_number_of_commands_parsed(self):
+        self.assertEqual(self.xb.fields['Number of Commands'], b'002')
+
+    def test_commands_parsed(self):
+        self.assertEqual(self.xb.commands, [b'NC', b'BU021UA97831862E31CCC36E854FE184EE6453'])
+
+    def test_command_fields_parsed(self):
+        self.assertEqual(self.xb.fields['Command 002'], b'BU021UA97831862E31CCC36E854FE184EE6453')
+
+    def test_no_data_left(self):
+        self.assertEqual(self.xb.parsed_length, len(self.xb.data))
+
+    def test_command_sliced_on_access(self):
+        self.assertNotIn('Command 001', self.xb.fields.values)
+        self.assertEqual(self.xb.fields.offsets['Command 001'], (7, 9))
+
+    def test_truncated_batch(self):
+        xb = XB(b'0020002NC00FFBU')
+        self.assertEqual(xb.commands, [b'NC'])
+
+
+class TestParseRequest(unittest.TestCase):
+    def test_parse_request_supported(self):
+        self.assertEqual(parse_request(b'NC', b'').get_command_code(), b'NC')
+
+    def test_parse_request_unsupported(self):
+        self.assertEqual(parse_request(b'IDDQD', b'').get_command_code(), None)
+
+
+class TestG0(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'U827E67B59A1D6B8F1E17D0BEA17FD101U7C2902D82733C779680AD18C70F5A27CA05FFFF9876543210E000011B9C1845EB993A7A01401234567890'
+        self.g0 = G0(data)
+
+    def test_bdk_parsed(self):
+        self.assertEqual(self.g0.fields['BDK'], b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+
+    def test_zpk_parsed(self):
+        self.assertEqual(self.g0.fields['ZPK'], b'U7C2902D82733C779680AD18C70F5A27C')
+
+    def test_ksn_descriptor_parsed(self):
+        self.assertEqual(self.g0.fields['KSN Descriptor'], b'A05')
+
+    def test_ksn_parsed(self):
+        self.assertEqual(self.g0.fields['KSN'], b'FFFF9876543210E00001')
+
+    def test_source_pin_block_parsed(self):
+        self.assertEqual(self.g0.fields['Source PIN block'], b'1B9C1845EB993A7A')
+
+    def test_destination_pin_block_format_parsed(self):
+        self.assertEqual(self.g0.fields['Destination PIN block format'], b'01')
+
+    def test_account_number_parsed(self):
+        self.assertEqual(self.g0.fields['Account Number'], b'401234567890')
+
+
+class TestGQ(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'U827E67B59A1D6B8F1E17D0BEA17FD1017336D50C47128D710DF450BCB2C6461BA05FFFF9876543210E000011B9C1845EB993A7A40123456789011734'
+        self.gq = GQ(data)
+
+    def test_bdk_parsed(self):
+        self.assertEqual(self.gq.fields['BDK'], b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+
+    def test_pvk_pair_parsed(self):
+        self.assertEqual(self.gq.fields['PVK Pair'], b'7336D50C47128D710DF450BCB2C6461B')
+
+    def test_ksn_parsed(self):
+        self.assertEqual(self.gq.fields['KSN'], b'FFFF9876543210E00001')
+
+    def test_pin_block_parsed(self):
+        self.assertEqual(self.gq.fields['PIN block'], b'1B9C1845EB993A7A')
+
+    def test_account_number_parsed(self):
+        self.assertEqual(self.gq.fields['Account Number'], b'401234567890')
+
+    def test_pvki_parsed(self):
+        self.assertEqual(self.gq.fields['PVKI'], b'1')
+
+    def test_pvv_parsed(self):
+        self.assertEqual(self.gq.fields['PVV'], b'1734')
+
+
+class TestKQ(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'11U827E67B59A1D6B8F1E17D0BEA17FD101617390010101190000011234567825' + \
+            b'00000000100000000000000008260000000000082617010100123456785800000103A0A010;A6DEE59A885EA0563030'
+        self.kq = KQ(data)
+
+    def test_mode_flag_parsed(self):
+        self.assertEqual(self.kq.fields['Mode Flag'], b'1')
+
+    def test_scheme_id_parsed(self):
+        self.assertEqual(self.kq.fields['Scheme ID'], b'1')
+
+    def test_mk_ac_parsed(self):
+        self.assertEqual(self.kq.fields['MK-AC'], b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+
+    def test_pan_psn_parsed(self):
+        self.assertEqual(self.kq.fields['PAN/PSN'], b'6173900101011900')
+
+    def test_atc_parsed(self):
+        self.assertEqual(self.kq.fields['ATC'], b'0001')
+
+    def test_unpredictable_number_parsed(self):
+        self.assertEqual(self.kq.fields['Unpredictable Number'], b'12345678')
+
+    def test_transaction_data_parsed(self):
+        self.assertEqual(self.kq.fields['Transaction Data'], b'00000000100000000000000008260000000000082617010100123456785800000103A0A010')
+
+    def test_arqc_parsed(self):
+        self.assertEqual(self.kq.fields['ARQC'], b'A6DEE59A885EA056')
+
+    def test_arc_parsed(self):
+        self.assertEqual(self.kq.fields['ARC'], b'3030')
+
+    def test_no_arc_in_mode_0(self):
+        kq = KQ(b'01U827E67B59A1D6B8F1E17D0BEA17FD1016173900101011900000112345678010A;A6DEE59A885EA056')
+        self.assertEqual(kq.get('ARC'), None)
+
+
+class TestM6(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'02132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP'
+        self.m6 = M6(data)
+
+    def test_mode_flag_parsed(self):
+        self.assertEqual(self.m6.fields['Mode Flag'], b'0')
+
+    def test_input_format_flag_parsed(self):
+        self.assertEqual(self.m6.fields['Input Format Flag'], b'2')
+
+    def test_mac_size_parsed(self):
+        self.assertEqual(self.m6.fields['MAC Size'], b'1')
+
+    def test_mac_algorithm_parsed(self):
+        self.assertEqual(self.m6.fields['MAC Algorithm'], b'3')
+
+    def test_padding_method_parsed(self):
+        self.assertEqual(self.m6.fields['Padding Method'], b'2')
+
+    def test_key_type_parsed(self):
+        self.assertEqual(self.m6.fields['Key Type'], b'008')
+
+    def test_key_parsed(self):
+        self.assertEqual(self.m6.fields['Key'], b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+
+    def test_message_parsed(self):
+        self.assertEqual(self.m6.fields['Message'], b'IDDQD IDKFA IDCLIP')
+
+    def test_message_view(self):
+        self.assertEqual(self.m6.fields.view('Message').tobytes(), b'IDDQD IDKFA IDCLIP')
+
+    def test_iv_parsed(self):
+        m6 = M6(b'32132008U827E67B59A1D6B8F1E17D0BEA17FD101AD3EFB24324A664D000AKFA IDCLIP')
+        self.assertEqual(m6.fields['IV'], b'AD3EFB24324A664D')
+        self.assertEqual(m6.fields['Message'], b'KFA IDCLIP')
+
+
+class TestM8(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        data = b'02132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP00979C4A1D1DA70C'
+        self.m8 = M8(data)
+
+    def test_message_parsed(self):
+        self.assertEqual(self.m8.fields['Message'], b'IDDQD IDKFA IDCLIP')
+
+    def test_mac_parsed(self):
+        self.assertEqual(self.m8.fields['MAC'], b'00979C4A1D1DA70C')
+
+    def test_no_mac_in_middle_block(self):
+        m8 = M8(b'12132008U827E67B59A1D6B8F1E17D0BEA17FD1010008IDDQD ID')
+        self.assertEqual(m8.get('MAC'), None)
+
+
 class TestHSMThread(unittest.TestCase):
     def setUp(self):
         self.hsm = HSM(header='SSSS', skip_parity=True)
@@ -526,5 +832,2042 @@ class TestHSMResponsesMapping(unittest.TestCase):
         self.assertEqual(response.get('Response Code'), b'ND')
         self.assertEqual(response.get('Error Code'), b'00')
 
+class TestHSMStaticResponses(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_static_response_precompiled(self):
+        self.assertIs(self.hsm._get_static_response('ZZ', '00'), self.hsm.static_responses[('ZZ', '00')])
+
+    def test_static_response_build(self):
+        self.assertEqual(self.hsm._get_static_response('CZ', '01').build(), b'\x00\x08SSSSCZ01')
+
+    def test_static_response_not_precompiled(self):
+        response = self.hsm._get_static_response('A1', '15')
+        self.assertIs(self.hsm._get_static_response('A1', '15'), response)
+        self.assertEqual(response.build(), b'\x00\x08SSSSA115')
+
+    def test_unsupported_command_response(self):
+        self.assertEqual(self.hsm.get_response(DummyMessage(b'')).build(), b'\x00\x08SSSSZZ00')
+
+    def test_diagnostics_response(self):
+        self.assertEqual(self.hsm.get_response(NC(b'')).build(), b'\x00\x21SSSSND00F4EDC8DEB67F6E280007-E000')
+
+
+class TestHSMBatch(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+        self.data = b'0030002NC0026BU021UA97831862E31CCC36E854FE184EE64530002ZX'
+
+    def test_batch_response_code(self):
+        response = self.hsm.get_response(XB(self.data))
+        self.assertEqual(response.get('Response Code'), b'XC')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('Number of Responses'), b'003')
+
+    def test_batch_responses_in_order(self):
+        response = self.hsm.get_response(XB(self.data))
+        nc = self.hsm.get_diagnostics_data()
+        self.assertEqual(response.get('Response 001'), b'001D' + b''.join(nc.fields.values()))
+        self.assertEqual(response.get('Response 002')[4:8], b'BV00')
+        self.assertEqual(response.get('Response 003'), b'0004ZZ00')
+
+    def test_batch_parallel(self):
+        hsm = HSM(header='SSSS', skip_parity=True, batch_workers=4)
+        self.assertEqual(hsm.get_response(XB(self.data)).build(), self.hsm.get_response(XB(self.data)).build())
+
+    def test_batch_invalid_number_of_commands(self):
+        response = self.hsm.get_response(XB(b'0050002NC'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_batch_nested(self):
+        response = self.hsm.get_response(XB(b'0010005XB000'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_batch_failed_command(self):
+        ca = b'CAU7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0103000123456789'
+        data = b'0030002NC' + '{:04X}'.format(len(ca)).encode('utf-8') + ca + b'0002NC'
+        for hsm in [self.hsm, HSM(header='SSSS', skip_parity=True, batch_workers=4)]:
+            response = hsm.get_response(XB(data))
+            self.assertEqual(response.get('Error Code'), b'00')
+            self.assertEqual(response.get('Response 001')[4:8], b'ND00')
+            self.assertEqual(response.get('Response 002'), b'0004CB15')
+            self.assertEqual(response.get('Response 003')[4:8], b'ND00')
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_discarded(self):
+        cache = LRUCache(2)
+        cache.set(1, 'A')
+        cache.set(2, 'B')
+        cache.get(1)
+        cache.set(3, 'C')
+        self.assertEqual(list(cache), [1, 3])
+
+    def test_discard(self):
+        cache = LRUCache(2)
+        cache.set(1, 'A')
+        cache.discard(1, 'B')
+        self.assertEqual(cache.get(1), 'A')
+        cache.discard(1)
+        cache.discard(2)
+        self.assertEqual(len(cache), 0)
+
+    def test_shared_by_threads(self):
+        cache = LRUCache(8)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(5000):
+                    cache.get((i + offset) % 16)
+                    cache.set((i + offset) % 16, i)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 8)
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler()
+
+    def test_record_returns_timestamp(self):
+        started = self.profiler.start()
+        self.assertGreaterEqual(self.profiler.record('recv', started), started)
+
+    def test_percentile(self):
+        self.profiler.timings['recv'] = [5, 1, 4, 2, 3]
+        self.assertEqual(self.profiler.percentile('recv', 50), 3)
+        self.assertEqual(self.profiler.percentile('recv', 100), 5)
+
+    def test_percentile_no_timings(self):
+        self.assertEqual(self.profiler.percentile('recv', 50), None)
+
+    def test_report_empty(self):
+        self.assertEqual(self.profiler.report(), '')
+
+    def test_report(self):
+        self.profiler.timings['get_response'] = [1000, 2000]
+        self.assertIn('[get_response]:     2 ', self.profiler.report())
+
+    def test_runcall_not_profiled_command(self):
+        self.assertEqual(self.profiler.runcall(b'CW', len, b'IDDQD'), 5)
+
+    def test_runcall_profiled_command(self):
+        profiler = Profiler(command_code=b'CW')
+        self.assertEqual(profiler.runcall(b'CW', len, b'IDDQD'), 5)
+
+    def test_hsm_decrypt_pinblock_profiled(self):
+        hsm = HSM(skip_parity=True, profiler=self.profiler)
+        hsm._decrypt_pinblock(b'2B687AEFC34B1A89', b'U0123456789ABCDEFFEDCBA9876543210')
+        self.assertEqual(len(self.profiler.timings['decrypt_pinblock']), 1)
+
+
+class TestFrameRing(unittest.TestCase):
+    def setUp(self):
+        self.ring = FrameRing(slots=2, slot_size=16)
+
+    def tearDown(self):
+        self.ring.unlink()
+
+    def test_put_get(self):
+        self.ring.put(7, b'\x00\x02NC')
+        self.assertEqual(self.ring.get(), (7, b'\x00\x02NC'))
+
+    def test_wrap_around(self):
+        for i in range(5):
+            self.ring.put(i, b'IDDQD' * (i % 3))
+            self.assertEqual(self.ring.get(), (i, b'IDDQD' * (i % 3)))
+
+    def test_frame_too_large(self):
+        with self.assertRaisesRegex(ValueError, 'Frame of length 17 does not fit the slot of size 16'):
+            self.ring.put(1, b'X' * 17)
+
+
+class TestRingDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = RingDispatcher(workers=2, slots=4, header='SSSS')
+        self.dispatcher.start()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_dispatch(self):
+        hsm = HSM(header='SSSS')
+        self.dispatcher.submit(1, b'\x00\x06SSSSNC')
+        self.assertEqual(self.dispatcher.collect(), (1, hsm.get_diagnostics_data().build()))
+
+    def test_dispatch_invalid_frame(self):
+        self.dispatcher.submit(2, b'\x00\x06XXXXNC')
+        self.assertEqual(self.dispatcher.collect(), (2, b''))
+
+    def test_reload(self):
+        command = b'SSSS' + build_cy('U613D213826396ED1C184D7DC81E484F7', '000', '4999988887777', '2512', '101')
+        frame = len(command).to_bytes(2, 'big') + command
+        hsm = HSM(header='SSSS', dispatcher=self.dispatcher)
+        hsm.reload(approve_all=True)
+        for tag in range(4):
+            self.dispatcher.submit(tag, frame)
+        self.assertEqual(sorted(self.dispatcher.collect()[1][6:10] for tag in range(4)), [b'CZ00'] * 4)
+        hsm.reload(approve_all=False)
+        self.dispatcher.submit(4, frame)
+        self.assertEqual(self.dispatcher.collect()[1][6:10], b'CZ01')
+
+    def test_dispatch_failed_request(self):
+        command = b'CAU7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0103000123456789'
+        self.dispatcher.submit(3, (4 + len(command)).to_bytes(2, 'big') + b'SSSS' + command)
+        self.assertEqual(self.dispatcher.collect(), (3, b'\x00\x08SSSSCB15'))
+        # The worker is still alive
+        self.dispatcher.submit(4, b'\x00\x06SSSSNC')
+        self.assertEqual(self.dispatcher.collect()[1][2:8], b'SSSSND')
+
+    def test_dispatch_large_frame(self):
+        command = b'M0000000AU827E67B59A1D6B8F1E17D0BEA17FD1011F40' + b'IDDQD IDKFA IDCL' * 500
+        frame = (4 + len(command)).to_bytes(2, 'big') + b'SSSS' + command
+        self.dispatcher.submit(5, frame)
+        self.assertEqual(self.dispatcher.collect(), (5, HSM(header='SSSS').process(frame)))
+
+
+class TestHSMDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = RingDispatcher(workers=2, slots=4, header='SSSS')
+        self.dispatcher.start()
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.hsm = HSM(header='SSSS', listener=self.listener, dispatcher=self.dispatcher)
+        threading.Thread(target=self.hsm.run, daemon=True).start()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_pipelined_requests(self):
+        client = Client(port=self.listener.getsockname()[1], header=b'SSSS')
+        commands = [build_nc(), build_bu('02', '1', 'UA97831862E31CCC36E854FE184EE6453')] * 5 + [b'XX']
+        responses = client.call_many(commands)
+        client.close()
+        self.assertEqual(len(responses), 11)
+        for i in range(0, 10, 2):
+            self.assertEqual(responses[i][:4], b'ND00')
+            self.assertEqual(responses[i + 1][:4], b'BV00')
+        self.assertEqual(responses[10], b'ZZ00')
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.keys = [('{:032X}'.format(i * 7919)).encode('utf-8') for i in range(1000)]
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing().get(b'0123456789ABCDEF'))
+
+    def test_same_key_same_worker(self):
+        ring = HashRing([0, 1, 2])
+        self.assertEqual(ring.get(b'0123456789ABCDEF'), ring.get(b'0123456789ABCDEF'))
+
+    def test_all_workers_used(self):
+        ring = HashRing([0, 1, 2])
+        self.assertEqual({ring.get(key) for key in self.keys}, {0, 1, 2})
+
+    def test_add_worker_moves_keys_to_it_only(self):
+        ring = HashRing([0, 1, 2])
+        before = {key: ring.get(key) for key in self.keys}
+        ring.add(3)
+        moved = [key for key in self.keys if ring.get(key) != before[key]]
+        self.assertTrue(moved)
+        self.assertLess(len(moved), len(self.keys) / 2)
+        self.assertEqual({ring.get(key) for key in moved}, {3})
+
+    def test_remove_worker_moves_its_keys_only(self):
+        ring = HashRing([0, 1, 2])
+        before = {key: ring.get(key) for key in self.keys}
+        ring.remove(1)
+        for key in self.keys:
+            if before[key] != 1:
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertIn(ring.get(key), (0, 2))
+
+
+class TestAffinityDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = AffinityDispatcher(workers=2, slots=4, header='SSSS')
+        self.dispatcher.start()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_routing_key(self):
+        frame = b'\x00\x3cSSSSCWU613D213826396ED1C184D7DC81E484F74999988887777;2512101'
+        self.assertEqual(self.dispatcher.get_routing_key(frame), b'613D213826396ED1C184D7DC81E484F7')
+
+    def test_routing_key_after_flags(self):
+        frame = b'\x00\x45SSSS' + build_m6('0', '2', '1', '3', '2', '008', 'U827E67B59A1D6B8F1E17D0BEA17FD101', 'IDDQD IDKFA IDCLIP')
+        self.assertEqual(self.dispatcher.get_routing_key(frame), b'827E67B59A1D6B8F1E17D0BEA17FD101')
+
+    def test_routing_key_first_key(self):
+        frame = b'\x00\x7dSSSS' + build_g0('U0123456789ABCDEFFEDCBA9876543210', 'U7C2902D82733C779680AD18C70F5A27C', '906', 'FFFF9876543210E00001',
+            '1B8C0F0D9AD4E1C1', '01', '401234567890')
+        self.assertEqual(self.dispatcher.get_routing_key(frame), b'0123456789ABCDEFFEDCBA9876543210')
+
+    def test_routing_keys_follow_request_classes(self):
+        key, pvk, cvk = 'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '1234567890ABCDEF1234567890ABCDEF', 'U613D213826396ED1C184D7DC81E484F7'
+        tdata = '00000000100000000000000008260000000000082617010100123456785800000103A0A010'
+        commands = [
+            build_bu('02', '1', key),
+            build_ca(key, key, '12', '7DF366B86AE2D9A7', '01', '01', '552000000012'),
+            build_ca('0123456789ABCDEF', key, '12', '7DF366B86AE2D9A7', '01', '01', '552000000012'),
+            build_cw(cvk, '4999988887777', '2512', '101'),
+            build_cy(cvk, '000', '4999988887777', '2512', '101'),
+            build_da(key, key, '12', '2AD242FD8D0DA1BA', '01', '04', '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'),
+            build_da('0123456789ABCDEF', key, '12', '2AD242FD8D0DA1BA', '01', '04', '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'),
+            build_dc(key, pvk, '2AD242FD8D0DA1BA', '01', '881123456789', '1', '1234'),
+            build_de(key, '0412345FFFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'),
+            build_ea(key, key, '12', '2AD242FD8D0DA1BA', '01', '04', '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'),
+            build_ec(key, pvk, '2AD242FD8D0DA1BA', '01', '881123456789', '1', '1234'),
+            build_ee(key, '6068FFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'),
+            build_fa(key, 'X7C2902D82733C779680AD18C70F5A27C'),
+            build_g0(key, key, '906', 'FFFF9876543210E00001', '1B8C0F0D9AD4E1C1', '01', '401234567890'),
+            build_g0(pvk, key, '906', 'FFFF9876543210E00001', '1B8C0F0D9AD4E1C1', '01', '401234567890'),
+            build_gq(key, pvk, '906', 'FFFF9876543210E00001', '1B8C0F0D9AD4E1C1', '401234567890', '1', '1234'),
+            build_kq('1', '1', key, '6173900101011900', '0001', '12345678', tdata, 'A6DEE59A885EA056', arc='3030'),
+            build_kq('0', '1', pvk, '6173900101011900', '0001', '12345678', tdata, 'A6DEE59A885EA056'),
+            build_m0('01', '1', '1', '00A', key, '0123456789ABCDEF', iv='0000000000000000'),
+            build_m0('00', '1', '1', '00A', '0123456789ABCDEF', '0123456789ABCDEF'),
+            build_m2('00', '1', '1', '00A', key, '0123456789ABCDEF'),
+            build_m6('0', '2', '1', '3', '2', '008', key, 'IDDQD IDKFA IDCLIP'),
+            build_m8('3', '2', '1', '3', '2', '008', key, 'IDDQD IDKFA IDCLIP', '0123456789ABCDEF', iv='0000000000000000'),
+            build_xv(cvk, '4575272222567122', '2010', '000', '123'),
+        ]
+        # The keys without the key scheme tag
+        plain, double = '0123456789ABCDEF', '0123456789ABCDEFFEDCBA9876543210'
+        commands += [
+            build_bu('02', '0', plain),
+            build_dc(plain, pvk, '2AD242FD8D0DA1BA', '01', '881123456789', '1', '1234'),
+            build_de(plain, '0412345FFFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'),
+            build_ea(plain, key, '12', '2AD242FD8D0DA1BA', '01', '04', '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'),
+            build_ee(plain, '6068FFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'),
+            build_fa(plain, 'X7C2902D82733C779680AD18C70F5A27C'),
+            build_gq(double, pvk, '906', 'FFFF9876543210E00001', '1B8C0F0D9AD4E1C1', '401234567890', '1', '1234'),
+            build_m2('00', '1', '1', '00A', plain, '0123456789ABCDEF'),
+            build_m6('0', '2', '1', '3', '2', '008', plain, 'IDDQD IDKFA IDCLIP'),
+            build_m8('0', '2', '1', '3', '2', '008', plain, 'IDDQD IDKFA IDCLIP', '0123456789ABCDEF'),
+            build_cw(double, '4999988887777', '2512', '101'),
+        ]
+        self.assertEqual({command[:2] for command in commands}, set(ROUTING_KEYS))
+        for command in commands:
+            frame = (len(command) + 4).to_bytes(2, 'big') + b'SSSS' + command
+            request = parse_request(command[:2], command[2:])
+            key = request.get(ROUTING_KEYS[command[:2]][0])
+            self.assertEqual(self.dispatcher.get_routing_key(frame), as_key(key).encoded if key else None, command)
+
+    def test_no_routing_key(self):
+        self.assertIsNone(self.dispatcher.get_routing_key(b'\x00\x06SSSSNC'))
+        self.assertIsNone(self.dispatcher.get_routing_key(b'\x00\x06XXXXNC'))
+        self.assertIsNone(self.dispatcher.get_routing_key(b'\x00\x0aSSSSCWU613'))
+
+    def test_inventory(self):
+        self.dispatcher.inventory = [(1, 'TPK', b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF'), (2, 'ZPK', b'U7C2902D82733C779680AD18C70F5A27C'),
+            (3, 'PVK PAIR', b'U1234567890ABCDEF1234567890ABCDEF')]
+        inventories = [self.dispatcher._get_inventory(worker) for worker in self.dispatcher.processes]
+        self.assertEqual(sum(1 for inventory in inventories for entry in inventory if entry[1] == 'TPK'), 1)
+        for inventory in inventories:
+            self.assertEqual([key_type for line_number, key_type, key in inventory if key_type != 'TPK'], ['ZPK', 'PVK PAIR'])
+
+    def test_same_key_same_worker(self):
+        frame = b'\x00\x3cSSSSCWU613D213826396ED1C184D7DC81E484F74999988887777;2512101'
+        self.assertEqual(self.dispatcher.get_worker(frame), self.dispatcher.get_worker(frame.replace(b'4999988887777', b'4999988886666')))
+
+    def test_dispatch(self):
+        hsm = HSM(header='SSSS')
+        frame = b'\x00\x3cSSSSCWU613D213826396ED1C184D7DC81E484F74999988887777;2512101'
+        self.dispatcher.submit(1, frame)
+        self.assertEqual(self.dispatcher.collect(), (1, hsm.process(frame)))
+        self.dispatcher.submit(2, b'\x00\x06SSSSNC')
+        self.assertEqual(self.dispatcher.collect(), (2, hsm.get_diagnostics_data().build()))
+
+    def test_add_remove_worker(self):
+        worker = self.dispatcher.add_worker()
+        self.assertEqual(len(self.dispatcher.processes), 3)
+        self.dispatcher.remove_worker(worker)
+        self.assertEqual(len(self.dispatcher.processes), 2)
+        self.dispatcher.submit(3, b'\x00\x06SSSSNC')
+        self.assertEqual(self.dispatcher.collect()[0], 3)
+
+
+class TestDUKPT(unittest.TestCase):
+    """
+    ANSI X9.24-1 test vectors
+    """
+    def setUp(self):
+        self.bdk = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.dukpt = DUKPT(cache_size=4)
+
+    def test_derive_ipek(self):
+        self.assertEqual(derive_ipek(self.bdk, bytes.fromhex('FFFF9876543210E00000')).hex().upper(), '6AC292FAA1315B4D858AB3A3D7D5933A')
+
+    def test_derive_ipek_ignores_counter(self):
+        self.assertEqual(derive_ipek(self.bdk, bytes.fromhex('FFFF9876543210E00003')), derive_ipek(self.bdk, bytes.fromhex('FFFF9876543210E00000')))
+
+    def test_pin_key(self):
+        ksn = bytes.fromhex('FFFF9876543210E00001')
+        pin_key = get_pin_key(derive_key(derive_ipek(self.bdk, ksn), ksn))
+        self.assertEqual(DES3.new(pin_key, DES3.MODE_ECB).encrypt(bytes.fromhex('041274EDCBA9876F')).hex().upper(), '1B9C1845EB993A7A')
+
+    def test_cached_key_derivation(self):
+        for counter in [1, 2, 3, 9, 4095, 2, 4094]:
+            ksn = bytes.fromhex('FFFF9876543210E00000')[:7] + counter.to_bytes(3, 'big')
+            self.assertEqual(self.dukpt.get_key(self.bdk, ksn), derive_key(derive_ipek(self.bdk, ksn), ksn))
+
+    def test_cache_bounded(self):
+        for counter in range(1, 64):
+            self.dukpt.get_key(self.bdk, bytes.fromhex('FFFF9876543210E00000')[:7] + counter.to_bytes(3, 'big'))
+        self.assertEqual(len(self.dukpt.keys), 4)
+        self.assertEqual(len(self.dukpt.ipeks), 1)
+
+
+class TestHSMDUKPT(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+        self.gq_data = b'U827E67B59A1D6B8F1E17D0BEA17FD1017336D50C47128D710DF450BCB2C6461BA05FFFF9876543210E000011B9C1845EB993A7A40123456789011734'
+
+    def test_translate_pinblock_dukpt(self):
+        data = b'U827E67B59A1D6B8F1E17D0BEA17FD101U7C2902D82733C779680AD18C70F5A27CA05FFFF9876543210E000011B9C1845EB993A7A01401234567890'
+        response = self.hsm.get_response(G0(data))
+        self.assertEqual(response.get('Response Code'), b'G1')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('PIN Length'), b'04')
+
+        cipher = DES3.new(bytes.fromhex('1C1EB1090681CC9E6003E05217C7077E'), DES3.MODE_ECB)
+        self.assertEqual(cipher.decrypt(bytes.fromhex(response.get('Destination PIN Block').decode('utf-8'))).hex().upper(), '041274EDCBA9876F')
+
+    def test_translate_pinblock_dukpt_unsupported_format(self):
+        data = b'U827E67B59A1D6B8F1E17D0BEA17FD101U7C2902D82733C779680AD18C70F5A27CA05FFFF9876543210E000011B9C1845EB993A7A03401234567890'
+        self.assertEqual(self.hsm.get_response(G0(data)).get('Error Code'), b'23')
+
+    def test_verify_pin_dukpt(self):
+        response = self.hsm.get_response(GQ(self.gq_data))
+        self.assertEqual(response.get('Response Code'), b'GR')
+        self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_verify_pin_dukpt_pvv_mismatch(self):
+        response = self.hsm.get_response(GQ(self.gq_data[:-4] + b'1735'))
+        self.assertEqual(response.get('Error Code'), b'01')
+
+    def test_verify_pin_dukpt_invalid_ksn(self):
+        response = self.hsm.get_response(GQ(self.gq_data.replace(b'FFFF9876543210E00001', b'XXXX9876543210E00001')))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_verify_pins_dukpt(self):
+        requests = [GQ(self.gq_data), GQ(self.gq_data[:-4] + b'1735'), GQ(self.gq_data)]
+        responses = self.hsm.verify_pins_dukpt(requests)
+        self.assertEqual([response.get('Error Code') for response in responses], [b'00', b'01', b'00'])
+
+
+class TestEMV(unittest.TestCase):
+    def setUp(self):
+        self.imk = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.emv = EMV(cache_size=2)
+
+    def test_derive_card_master_key(self):
+        cipher = DES3.new(self.imk, DES3.MODE_ECB)
+        self.assertEqual(derive_card_master_key(self.imk, '476173900101011900'), 
+            cipher.encrypt(bytes.fromhex('6173900101011900')) + cipher.encrypt(bytes.fromhex('9E8C6FFEFEFEE6FF')))
+
+    def test_derive_card_master_key_padded(self):
+        self.assertEqual(derive_card_master_key(self.imk, '1234567890'), derive_card_master_key(self.imk, '0000001234567890'))
+
+    def test_mac_single_block(self):
+        cipher = DES3.new(self.imk, DES3.MODE_ECB)
+        self.assertEqual(get_mac(self.imk, b'IDDQD'), cipher.encrypt(b'IDDQD\x80\x00\x00'))
+
+    def test_arpc(self):
+        cipher = DES3.new(self.imk, DES3.MODE_ECB)
+        self.assertEqual(get_arpc(self.imk, bytes.fromhex('A6DEE59A885EA056'), b'00'), cipher.encrypt(bytes.fromhex('96EEE59A885EA056')))
+
+    def test_session_key_cached(self):
+        session_key = self.emv.get_session_key(self.imk, '6173900101011900', b'\x00\x01')
+        mk = self.emv.card_keys[(self.imk, '6173900101011900')]
+        self.assertEqual(session_key, derive_session_key(mk, b'\x00\x01'))
+        self.assertIs(self.emv.get_session_key(self.imk, '6173900101011900', b'\x00\x01'), session_key)
+
+
+class TestHSMEMV(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+        self.data = b'U827E67B59A1D6B8F1E17D0BEA17FD101617390010101190000011234567825' + \
+            b'00000000100000000000000008260000000000082617010100123456785800000103A0A010;'
+
+    def test_verify_arqc(self):
+        response = self.hsm.get_response(KQ(b'01' + self.data + b'A6DEE59A885EA056'))
+        self.assertEqual(response.get('Response Code'), b'KR')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('ARPC'), None)
+
+    def test_verify_arqc_mismatch(self):
+        response = self.hsm.get_response(KQ(b'01' + self.data + b'A6DEE59A885EA057'))
+        self.assertEqual(response.get('Error Code'), b'01')
+
+    def test_verify_arqc_generate_arpc(self):
+        response = self.hsm.get_response(KQ(b'11' + self.data + b'A6DEE59A885EA0563030'))
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('ARPC'), b'C12A4DF068AC1B54')
+
+    def test_verify_arqc_card_master_key_scheme(self):
+        response = self.hsm.get_response(KQ(b'00' + self.data + b'149C41CD51D9E7A6'))
+        self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_generate_arpc_only(self):
+        response = self.hsm.get_response(KQ(b'21' + self.data + b'A6DEE59A885EA0563030'))
+        self.assertEqual(response.get('ARPC'), b'C12A4DF068AC1B54')
+
+    def test_invalid_mode(self):
+        response = self.hsm.get_response(KQ(b'31' + self.data + b'A6DEE59A885EA0563030'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_verify_arqcs(self):
+        requests = [KQ(b'01' + self.data + b'A6DEE59A885EA056'), KQ(b'01' + self.data + b'A6DEE59A885EA057')]
+        self.assertEqual([response.get('Error Code') for response in self.hsm.verify_arqcs(requests)], [b'00', b'01'])
+
+
+class TestCBCMAC(unittest.TestCase):
+    def setUp(self):
+        self.key = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.data = bytes(range(256)) * 5 + b'IDDQD'
+
+    def test_algorithm_1_padding_1(self):
+        expected = DES3.new(self.key, DES3.MODE_CBC, b'\x00' * 8).encrypt(self.data + b'\x00' * 3)[-8:]
+        self.assertEqual(get_iso9797_mac(self.key, self.data, algorithm=1, padding=1), expected)
+
+    def test_algorithm_3_padding_2(self):
+        mac = DES.new(self.key[:8], DES.MODE_CBC, b'\x00' * 8).encrypt(self.data + b'\x80\x00\x00')[-8:]
+        expected = DES.new(self.key[:8], DES.MODE_ECB).encrypt(DES.new(self.key[8:], DES.MODE_ECB).decrypt(mac))
+        self.assertEqual(get_iso9797_mac(self.key, self.data, algorithm=3, padding=2), expected)
+
+    def test_padding_2_aligned_data(self):
+        expected = DES3.new(self.key, DES3.MODE_CBC, b'\x00' * 8).encrypt(b'IDDQDIDK\x80' + b'\x00' * 7)[-8:]
+        self.assertEqual(get_iso9797_mac(self.key, b'IDDQDIDK', algorithm=1, padding=2), expected)
+
+    def test_single_length_key(self):
+        expected = DES.new(self.key[:8], DES.MODE_CBC, b'\x00' * 8).encrypt(b'IDDQDIDK')[-8:]
+        self.assertEqual(get_iso9797_mac(self.key[:8], b'IDDQDIDK', algorithm=1, padding=0), expected)
+
+    def test_no_padding_unaligned_data(self):
+        with self.assertRaisesRegex(ValueError, 'Data length is not a multiple of 8'):
+            get_iso9797_mac(self.key, b'IDDQD', padding=0)
+
+    def test_streaming(self):
+        mac = CBCMAC(self.key, algorithm=3, padding=2)
+        for offset in range(0, len(self.data), 7):
+            mac.update(memoryview(self.data)[offset:offset + 7])
+        self.assertEqual(mac.digest(), get_iso9797_mac(self.key, self.data, algorithm=3, padding=2))
+
+    def test_continue_with_iv(self):
+        first = CBCMAC(self.key, algorithm=3, padding=2)
+        first.update(self.data[:1024])
+        last = CBCMAC(self.key, algorithm=3, padding=2, iv=first.get_iv())
+        last.update(self.data[1024:])
+        self.assertEqual(last.digest(), get_iso9797_mac(self.key, self.data, algorithm=3, padding=2))
+
+    def test_unsupported_algorithm(self):
+        with self.assertRaisesRegex(ValueError, 'Unsupported MAC algorithm: 2'):
+            CBCMAC(self.key, algorithm=2)
+
+
+class TestHSMMAC(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_generate_mac(self):
+        response = self.hsm.get_response(M6(b'02132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP'))
+        self.assertEqual(response.get('Response Code'), b'M7')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('MAC'), b'00979C4A1D1DA70C')
+
+    def test_generate_mac_short_hex_input(self):
+        response = self.hsm.get_response(M6(b'01011003U827E67B59A1D6B8F1E17D0BEA17FD101002449444451442049444B4641204944434C4950'))
+        self.assertEqual(response.get('MAC'), b'B47E035E')
+
+    def test_generate_mac_multiple_blocks(self):
+        response = self.hsm.get_response(M6(b'12132008U827E67B59A1D6B8F1E17D0BEA17FD1010008IDDQD ID'))
+        self.assertEqual(response.get('IV'), b'AD3EFB24324A664D')
+        response = self.hsm.get_response(M6(b'32132008U827E67B59A1D6B8F1E17D0BEA17FD101AD3EFB24324A664D000AKFA IDCLIP'))
+        self.assertEqual(response.get('MAC'), b'00979C4A1D1DA70C')
+
+    def test_generate_mac_first_block_unaligned(self):
+        response = self.hsm.get_response(M6(b'12132008U827E67B59A1D6B8F1E17D0BEA17FD1010005IDDQD'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_generate_mac_invalid_key_type(self):
+        response = self.hsm.get_response(M6(b'02132001U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_verify_mac(self):
+        response = self.hsm.get_response(M8(b'02132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP00979C4A1D1DA70C'))
+        self.assertEqual(response.get('Response Code'), b'M9')
+        self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_verify_mac_mismatch(self):
+        response = self.hsm.get_response(M8(b'02132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP00979C4A1D1DA70D'))
+        self.assertEqual(response.get('Error Code'), b'01')
+
+
+class TestM0(unittest.TestCase):
+    def test_m0_parsing_ecb(self):
+        m0 = M0(b'000000AU827E67B59A1D6B8F1E17D0BEA17FD1010010IDDQD IDKFA IDCL')
+        self.assertEqual(m0.get_command_code(), b'M0')
+        self.assertEqual(m0.get('Mode Flag'), b'00')
+        self.assertEqual(m0.get('Input Format Flag'), b'0')
+        self.assertEqual(m0.get('Output Format Flag'), b'0')
+        self.assertEqual(m0.get('Key Type'), b'00A')
+        self.assertEqual(m0.get('Key'), b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+        self.assertEqual(m0.get('IV'), None)
+        self.assertEqual(m0.get('Message Length'), b'0010')
+        self.assertEqual(m0.get('Message'), b'IDDQD IDKFA IDCL')
+
+    def test_m0_parsing_cbc(self):
+        m0 = M0(b'012100BU827E67B59A1D6B8F1E17D0BEA17FD10100112233445566770010IDDQD IDKFA IDCL')
+        self.assertEqual(m0.get('Mode Flag'), b'01')
+        self.assertEqual(m0.get('Key Type'), b'00B')
+        self.assertEqual(m0.get('IV'), b'0011223344556677')
+        self.assertEqual(m0.get('Message'), b'IDDQD IDKFA IDCL')
+
+    def test_m2_parsing(self):
+        m2 = M2(b'011000BU827E67B59A1D6B8F1E17D0BEA17FD1010011223344556677002058CFEDADFB48D23965E717CD4B673A2E')
+        self.assertEqual(m2.get_command_code(), b'M2')
+        self.assertEqual(m2.get('Message Length'), b'0020')
+        self.assertEqual(m2.get('Message'), b'58CFEDADFB48D23965E717CD4B673A2E')
+
+
+class TestDataCipher(unittest.TestCase):
+    def setUp(self):
+        self.key = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.iv = bytes.fromhex('0011223344556677')
+        self.data = bytes(range(256)) * 64
+
+    def test_encrypt_cbc_in_parts(self):
+        cipher = DataCipher(self.key, mode=MODE_CBC, iv=self.iv)
+        encrypted = cipher.update(self.data[:40]) + cipher.update(self.data[40:])
+        self.assertEqual(encrypted, DES3.new(self.key, DES3.MODE_CBC, self.iv).encrypt(self.data))
+        self.assertEqual(cipher.iv, encrypted[-8:])
+
+    def test_decrypt_hex_input(self):
+        encrypted = DES3.new(self.key, DES3.MODE_CBC, self.iv).encrypt(self.data)
+        cipher = DataCipher(self.key, mode=MODE_CBC, iv=self.iv, decrypt=True)
+        self.assertEqual(cipher.update(encrypted.hex().upper().encode(), hex_input=True), self.data)
+        self.assertEqual(cipher.iv, encrypted[-8:])
+
+    def test_encrypt_hex_output(self):
+        cipher = DataCipher(self.key)
+        self.assertEqual(cipher.update(self.data, hex_output=True), DES3.new(self.key, DES3.MODE_ECB).encrypt(self.data).hex().upper().encode())
+
+    def test_encrypt_cbc_chunks_hex_output(self):
+        data = self.data * 5
+        cipher = DataCipher(self.key, mode=MODE_CBC, iv=self.iv)
+        encrypted = DES3.new(self.key, DES3.MODE_CBC, self.iv).encrypt(data)
+        self.assertEqual(cipher.update(data, hex_output=True), encrypted.hex().upper().encode())
+        self.assertEqual(cipher.iv, encrypted[-8:])
+
+    def test_invalid_length(self):
+        with self.assertRaisesRegex(ValueError, 'Data length is not a multiple of 8'):
+            DataCipher(self.key).update(self.data[:7])
+
+
+class TestHSMData(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+        self.key = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+
+    def test_encrypt_data_ecb(self):
+        response = self.hsm.get_response(M0(b'000000AU827E67B59A1D6B8F1E17D0BEA17FD1010010IDDQD IDKFA IDCL'))
+        self.assertEqual(response.get('Response Code'), b'M1')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('IV'), None)
+        self.assertEqual(response.get('Message Length'), b'0010')
+        self.assertEqual(response.get('Message'), DES3.new(self.key, DES3.MODE_ECB).encrypt(b'IDDQD IDKFA IDCL'))
+
+    def test_encrypt_data_cbc_hex_output(self):
+        response = self.hsm.get_response(M0(b'012100BU827E67B59A1D6B8F1E17D0BEA17FD10100112233445566770010IDDQD IDKFA IDCL'))
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('IV'), b'65E717CD4B673A2E')
+        self.assertEqual(response.get('Message Length'), b'0020')
+        self.assertEqual(response.get('Message'), b'58CFEDADFB48D23965E717CD4B673A2E')
+
+    def test_encrypt_data_cbc_multiple_blocks(self):
+        response = self.hsm.get_response(M0(b'010100BU827E67B59A1D6B8F1E17D0BEA17FD10100112233445566770008IDDQD ID'))
+        self.assertEqual(response.get('IV'), b'58CFEDADFB48D239')
+        response = self.hsm.get_response(M0(b'010100BU827E67B59A1D6B8F1E17D0BEA17FD10158CFEDADFB48D2390008KFA IDCL'))
+        self.assertEqual(response.get('Message'), b'65E717CD4B673A2E')
+
+    def test_decrypt_data(self):
+        response = self.hsm.get_response(M2(b'011000BU827E67B59A1D6B8F1E17D0BEA17FD1010011223344556677002058CFEDADFB48D23965E717CD4B673A2E'))
+        self.assertEqual(response.get('Response Code'), b'M3')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('Message Length'), b'0010')
+        self.assertEqual(response.get('Message'), b'IDDQD IDKFA IDCL')
+
+    def test_encrypt_data_large_message(self):
+        data = bytes(range(256)) * 255
+        response = self.hsm.get_response(M0(b'000000AU827E67B59A1D6B8F1E17D0BEA17FD101FF00' + data))
+        self.assertEqual(response.get('Message Length'), b'FF00')
+        self.assertEqual(response.get('Message'), DES3.new(self.key, DES3.MODE_ECB).encrypt(data))
+
+    def test_encrypt_data_output_too_long(self):
+        data = bytes(range(256)) * 255
+        response = self.hsm.get_response(M0(b'000100AU827E67B59A1D6B8F1E17D0BEA17FD101FF00' + data))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_encrypt_data_invalid_length(self):
+        response = self.hsm.get_response(M0(b'000000AU827E67B59A1D6B8F1E17D0BEA17FD1010005IDDQD'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_encrypt_data_invalid_key_type(self):
+        response = self.hsm.get_response(M0(b'000000008U827E67B59A1D6B8F1E17D0BEA17FD1010010IDDQD IDKFA IDCL'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+
+class TestHSMRecv(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS')
+        self.hsm.conn, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.hsm.conn.close()
+        self.client.close()
+
+    def test_recv_split_message(self):
+        self.client.sendall(b'\x00\x06SS')
+        self.client.sendall(b'SSNC')
+        self.assertEqual(self.hsm.recv(), b'\x00\x06SSSSNC')
+
+    def test_recv_pipelined_messages(self):
+        self.client.sendall(b'\x00\x06SSSSNC\x00\x06SSSSXX\x00')
+        self.assertEqual(self.hsm.recv(), b'\x00\x06SSSSNC')
+        self.assertEqual(self.hsm.recv(), b'\x00\x06SSSSXX')
+        self.client.sendall(b'\x06SSSSNC')
+        self.assertEqual(self.hsm.recv(), b'\x00\x06SSSSNC')
+
+    def test_recv_large_message(self):
+        data = b'\xff\xfbSSSS' + b'X' * 0xFFF7
+        self.client.sendall(data)
+        self.assertEqual(self.hsm.recv(), data)
+
+    def test_has_message(self):
+        self.assertFalse(self.hsm.has_message())
+        self.client.sendall(b'\x00\x06SSSSNC\x00\x06SS')
+        self.hsm.recv()
+        self.assertFalse(self.hsm.has_message())
+        self.client.sendall(b'SSNC\x00\x06SSSSNC')
+        self.hsm.recv()
+        self.assertTrue(self.hsm.has_message())
+
+    def test_pipelined_responses_sent_together(self):
+        self.client.sendall(b'\x00\x06SSSSNC\x00\x06SSSSXX')
+        self.hsm.recv()
+        self.hsm.send(self.hsm.get_diagnostics_data())
+        self.assertEqual(len(self.hsm.pending_responses), 1)
+        self.hsm.recv()
+        self.hsm.send(self.hsm._get_static_response('ZZ', '00'))
+        self.assertEqual(self.hsm.pending_responses, [])
+        self.assertEqual(self.client.recv(1024), self.hsm.get_diagnostics_data().build() + b'\x00\x08SSSSZZ00')
+
+    def test_recv_client_disconnected(self):
+        self.client.sendall(b'\x00\x06SS')
+        self.client.shutdown(socket.SHUT_WR)
+        with self.assertRaises(IOError):
+            self.hsm.recv()
+
+
+class TestDA(unittest.TestCase):
+    def test_da_parsing(self):
+        da = DA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N6068FFFFFFFF')
+        self.assertEqual(da.get_command_code(), b'DA')
+        self.assertEqual(da.get('TPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+        self.assertEqual(da.get('PVK'), b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+        self.assertEqual(da.get('Maximum PIN Length'), b'12')
+        self.assertEqual(da.get('PIN block'), b'FE12241291F0208E')
+        self.assertEqual(da.get('PIN block format code'), b'01')
+        self.assertEqual(da.get('Check Length'), b'04')
+        self.assertEqual(da.get('Account Number'), b'000123456789')
+        self.assertEqual(da.get('Decimalization Table'), b'0123456789012345')
+        self.assertEqual(da.get('PIN Validation Data'), b'12345678901N')
+        self.assertEqual(da.get('Offset'), b'6068FFFFFFFF')
+
+    def test_ea_parsing(self):
+        ea = EA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N6068FFFFFFFF')
+        self.assertEqual(ea.get_command_code(), b'EA')
+        self.assertEqual(ea.get('ZPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+        self.assertEqual(ea.get('Offset'), b'6068FFFFFFFF')
+
+    def test_de_parsing(self):
+        de = DE(b'U827E67B59A1D6B8F1E17D0BEA17FD1013DA3E058663A8DDF04000123456789012345678901234512345678901N')
+        self.assertEqual(de.get_command_code(), b'DE')
+        self.assertEqual(de.get('PVK'), b'U827E67B59A1D6B8F1E17D0BEA17FD101')
+        self.assertEqual(de.get('PIN'), b'3DA3E058663A8DDF')
+        self.assertEqual(de.get('Check Length'), b'04')
+        self.assertEqual(de.get('PIN Validation Data'), b'12345678901N')
+
+    def test_ee_parsing(self):
+        ee = EE(b'U827E67B59A1D6B8F1E17D0BEA17FD1016068FFFFFFFF04000123456789012345678901234512345678901N')
+        self.assertEqual(ee.get_command_code(), b'EE')
+        self.assertEqual(ee.get('Offset'), b'6068FFFFFFFF')
+        self.assertEqual(ee.get('Minimum PIN Length'), b'04')
+        self.assertEqual(ee.get('Account Number'), b'000123456789')
+
+
+class TestIBM3624(unittest.TestCase):
+    def setUp(self):
+        self.ibm = IBM3624(bytes.fromhex('0123456789ABCDEFFEDCBA9876543210'), b'0123456789012345')
+
+    def test_decimalization_table(self):
+        self.assertEqual(b'FC767C22E2CE6F21'.translate(get_decimalization_table(b'0123456789012345')), b'5276722242246521')
+
+    def test_decimalization_table_invalid(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid decimalization table'):
+            get_decimalization_table(b'0123456789ABCDEF')
+
+    def test_validation_block(self):
+        self.assertEqual(get_validation_block(b'4000001N', b'000123456789'), bytes.fromhex('400000156789FFFF'))
+
+    def test_natural_pin(self):
+        self.assertEqual(self.ibm.get_natural_pin(b'12345678901N', b'000123456789', 6), b'527672')
+
+    def test_get_offset(self):
+        self.assertEqual(self.ibm.get_offset(b'1234', b'12345678901N', b'000123456789'), b'6068FFFFFFFF')
+
+    def test_get_pin(self):
+        self.assertEqual(self.ibm.get_pin(b'6068FFFFFFFF', b'12345678901N', b'000123456789'), b'1234')
+
+    def test_verify(self):
+        self.assertTrue(self.ibm.verify(b'1234', b'6068FFFFFFFF', b'12345678901N', b'000123456789', 4))
+        self.assertFalse(self.ibm.verify(b'1235', b'6068FFFFFFFF', b'12345678901N', b'000123456789', 4))
+
+    def test_get_offsets(self):
+        self.assertEqual(self.ibm.get_offsets([(b'000123456789', b'1234'), (b'000123456789', b'527672')], b'12345678901N'), [b'6068FFFFFFFF', b'000000FFFFFF'])
+
+
+class TestHSMIBM(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_verify_pin_da(self):
+        response = self.hsm.get_response(DA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N6068FFFFFFFF'))
+        self.assertEqual(response.get('Response Code'), b'DB')
+        self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_verify_pin_da_mismatch(self):
+        response = self.hsm.get_response(DA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N6069FFFFFFFF'))
+        self.assertEqual(response.get('Error Code'), b'01')
+
+    def test_verify_pin_ea(self):
+        response = self.hsm.get_response(EA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N6068FFFFFFFF'))
+        self.assertEqual(response.get('Response Code'), b'EB')
+        self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_verify_pin_ea_invalid_decimalization_table(self):
+        response = self.hsm.get_response(EA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E010400012345678901234567890ABCDEF12345678901N6068FFFFFFFF'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_generate_offset(self):
+        response = self.hsm.get_response(DE(b'U827E67B59A1D6B8F1E17D0BEA17FD1013DA3E058663A8DDF04000123456789012345678901234512345678901N'))
+        self.assertEqual(response.get('Response Code'), b'DF')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('Offset'), b'6068FFFFFFFF')
+
+    def test_derive_pin(self):
+        response = self.hsm.get_response(EE(b'U827E67B59A1D6B8F1E17D0BEA17FD1016068FFFFFFFF04000123456789012345678901234512345678901N'))
+        self.assertEqual(response.get('Response Code'), b'EF')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('PIN'), b'3DA3E058663A8DDF')
+
+    def test_derive_pin_offset_too_short(self):
+        response = self.hsm.get_response(EE(b'U827E67B59A1D6B8F1E17D0BEA17FD101606FFFFFFFFF04000123456789012345678901234512345678901N'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_generate_offsets(self):
+        cards = [(b'000123456789', b'3DA3E058663A8DDF'), (b'000123456789', b'3DA3E058663A8DDF')]
+        self.assertEqual(self.hsm.generate_ibm_offsets(b'U827E67B59A1D6B8F1E17D0BEA17FD101', b'0123456789012345', b'12345678901N', cards), [b'6068FFFFFFFF', b'6068FFFFFFFF'])
+
+
+class TestXV(unittest.TestCase):
+    def setUp(self):
+        self.xv = XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010101123')
+
+    def test_cvk_parsed(self):
+        self.assertEqual(self.xv.get('CVK'), b'U0123456789ABCDEFFEDCBA9876543210')
+
+    def test_account_number_parsed(self):
+        self.assertEqual(self.xv.get('Primary Account Number'), b'4575272222567122')
+
+    def test_expiry_date_parsed(self):
+        self.assertEqual(self.xv.get('Expiration Date'), b'2010')
+
+    def test_service_code_parsed(self):
+        self.assertEqual(self.xv.get('Service Code'), b'101')
+
+    def test_variants_parsed(self):
+        self.assertEqual(self.xv.get('Variants'), b'123')
+
+
+class TestCVV(unittest.TestCase):
+    def setUp(self):
+        self.cvv = CVV(bytes.fromhex('0123456789ABCDEFFEDCBA9876543210'))
+
+    def test_get_digits(self):
+        self.assertEqual(get_digits(b'A1B2C3D4'), b'123')
+
+    def test_get_digits_hex_letters(self):
+        self.assertEqual(get_digits(b'ABCDEF12'), b'120')
+
+    def test_get_cvv(self):
+        self.assertEqual(self.cvv.get_cvv(b'4575272222567122', b'2010', b'101'), b'734')
+
+    def test_get_cvvs(self):
+        self.assertEqual(self.cvv.get_cvvs(b'4575272222567122', b'2010', [b'101', b'000', b'999']), [b'734', b'752', b'073'])
+
+    def test_invalid_key_length(self):
+        with self.assertRaisesRegex(ValueError, 'Incorrect key length'):
+            CVV(bytes.fromhex('0123456789ABCDEF'))
+
+
+class TestHSMCVV(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_generate_cvvs(self):
+        response = self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010101123'))
+        self.assertEqual(response.get('Response Code'), b'XW')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('CVV'), b'734')
+        self.assertEqual(response.get('CVV2'), b'752')
+        self.assertEqual(response.get('iCVV'), b'073')
+
+    def test_generate_cvvs_same_as_cw(self):
+        for service_code, variant in ((b'101', b'1'), (b'000', b'2'), (b'999', b'3')):
+            cw = self.hsm.get_response(CW(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010' + service_code))
+            xv = self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010101' + variant))
+            self.assertEqual(list(xv.fields.values())[-1], cw.get('CVV'))
+
+    def test_generate_cvvs_requested_order(self):
+        response = self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;201010131'))
+        self.assertEqual(list(response.fields.keys()), ['Response Code', 'Error Code', 'iCVV', 'CVV'])
+
+    def test_generate_cvvs_invalid_variant(self):
+        response = self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;20101014'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_generate_cvvs_duplicate_variant(self):
+        response = self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;201010111'))
+        self.assertEqual(response.get('Error Code'), b'15')
+
+    def test_cvk_key_schedule_cached(self):
+        self.hsm.get_response(XV(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010101123'))
+        self.hsm.get_response(CW(b'U0123456789ABCDEFFEDCBA98765432104575272222567122;2010101'))
+        self.assertEqual(len(self.hsm.cvks), 1)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = Stats()
+
+    def test_record(self):
+        self.stats.record(b'NC', b'00', 1000)
+        self.stats.record(b'NC', b'00', 2000)
+        self.stats.record(b'CY', b'01', 3000)
+        self.assertEqual(self.stats.get_commands(), {b'NC': 2, b'CY': 1})
+        self.assertEqual(self.stats.get_requests(), 3)
+        self.assertEqual(self.stats.get_errors(), 1)
+        self.assertEqual(self.stats.get_busy_time(), 6000)
+
+    def test_per_thread_counters_aggregated(self):
+        def record():
+            for i in range(100):
+                self.stats.record(b'CW', b'00', 10)
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.stats.counters), 4)
+        self.assertEqual(self.stats.get_commands(), {b'CW': 400})
+        self.assertEqual(self.stats.get_busy_time(), 4000)
+
+    def test_reset(self):
+        self.stats.record(b'NC', b'00', 1000)
+        self.stats.record(b'CY', b'01', 1000)
+        self.stats.reset()
+        self.stats.record(b'NC', b'00', 500)
+        self.assertEqual(self.stats.get_commands(), {b'NC': 1})
+        self.assertEqual(self.stats.get_errors(), 0)
+        self.assertEqual(self.stats.get_busy_time(), 500)
+
+    def test_load(self):
+        self.assertEqual(self.stats.get_load(), 0)
+        self.stats.record(b'NC', b'00', 10 ** 12)
+        self.assertEqual(self.stats.get_load(), 100)
+
+
+class TestHSMStats(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_get_loading(self):
+        self.hsm.get_response(NC(b''))
+        response = self.hsm.get_response(J2(b''))
+        self.assertEqual(response.get('Response Code'), b'J3')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(len(response.get('Start Time')), 12)
+        self.assertEqual(len(response.get('Current Time')), 12)
+        self.assertEqual(response.get('Elapsed Time'), b'0000000000')
+        self.assertEqual(len(response.get('Busy Time')), 10)
+        self.assertEqual(len(response.get('Load')), 3)
+
+    def test_get_command_volumes(self):
+        self.hsm.get_response(NC(b''))
+        self.hsm.get_response(NC(b''))
+        self.hsm.get_response(BU(b'021UA97831862E31CCC36E854FE184EE6453'))
+        self.hsm.get_response(DummyMessage(b''))
+        response = self.hsm.get_response(J4(b''))
+        self.assertEqual(response.get('Response Code'), b'J5')
+        self.assertEqual(response.get('Number of Commands'), b'002')
+        self.assertEqual(response.get('Command BU'), b'BU0000000001')
+        self.assertEqual(response.get('Command NC'), b'NC0000000002')
+
+    def test_get_command_volumes_batch(self):
+        self.hsm.get_response(XB(b'0030002NC0026BU021UA97831862E31CCC36E854FE184EE64530002NC'))
+        response = self.hsm.get_response(J4(b''))
+        self.assertEqual(response.get('Number of Commands'), b'003')
+        self.assertEqual(response.get('Command NC'), b'NC0000000002')
+        self.assertEqual(response.get('Command XB'), b'XB0000000001')
+
+    def test_get_health_check_counts(self):
+        self.hsm.get_response(NC(b''))
+        self.hsm.get_response(DummyMessage(b''))
+        self.hsm.get_response(XB(b'0050002NC'))
+        response = self.hsm.get_response(J8(b''))
+        self.assertEqual(response.get('Response Code'), b'J9')
+        self.assertEqual(response.get('Requests'), b'0000000003')
+        self.assertEqual(response.get('Errors'), b'0000000001')
+        self.assertEqual(response.get('Unsupported Commands'), b'0000000001')
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket.updated
+        self.assertEqual(bucket.reserve(now), 0)
+        self.assertEqual(bucket.reserve(now), 0)
+        self.assertAlmostEqual(bucket.reserve(now), 0.1)
+        self.assertAlmostEqual(bucket.reserve(now), 0.2)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=10)
+        now = bucket.updated
+        bucket.reserve(now)
+        self.assertAlmostEqual(bucket.reserve(now + 0.05), 0.05)
+        self.assertEqual(bucket.reserve(now + 10), 0)
+
+
+class TestServiceTime(unittest.TestCase):
+    def test_fixed(self):
+        self.assertEqual(ServiceTime('2').sample(), 0.002)
+        self.assertEqual(ServiceTime('fixed:4').sample(), 0.004)
+
+    def test_uniform(self):
+        sample = ServiceTime('uniform:1:2').sample()
+        self.assertTrue(0.001 <= sample <= 0.002)
+
+    def test_normal_not_negative(self):
+        service_time = ServiceTime('normal:0:10')
+        self.assertTrue(all(service_time.sample() >= 0 for i in range(100)))
+
+    def test_invalid(self):
+        for spec in ['uniform:1', 'gamma:1', 'fixed:x', 'exp:-1']:
+            with self.assertRaisesRegex(ValueError, 'Invalid service time'):
+                ServiceTime(spec)
+
+    def test_parse_service_times(self):
+        service_times = parse_service_times('NC=0.5, CW=uniform:2:4,*=exp:1')
+        self.assertEqual(sorted(service_times, key=str), [None, b'CW', b'NC'])
+        self.assertEqual(service_times[b'NC'].sample(), 0.0005)
+        self.assertEqual(service_times[b'CW'].distribution, 'uniform')
+
+
+class TestPerformanceModel(unittest.TestCase):
+    def test_get_response_code(self):
+        self.assertEqual(get_response_code(b'CW'), 'CX')
+        self.assertEqual(get_response_code(b'A0'), 'A1')
+
+    def test_admit(self):
+        model = PerformanceModel(max_in_flight=2)
+        self.assertTrue(model.admit())
+        self.assertTrue(model.admit())
+        self.assertFalse(model.admit())
+        model.release()
+        self.assertTrue(model.admit())
+        self.assertEqual(model.rejected, 1)
+
+    def test_service_time_default(self):
+        model = PerformanceModel(service_times=parse_service_times('NC=1,*=3'))
+        self.assertEqual(model.get_service_time(b'NC'), 0.001)
+        self.assertEqual(model.get_service_time(b'CW'), 0.003)
+        self.assertEqual(PerformanceModel().get_service_time(b'CW'), 0)
+
+    def test_no_licence_limit(self):
+        self.assertEqual(PerformanceModel().get_queue_delay(), 0)
+
+
+class TestHSMAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.model = PerformanceModel(service_times=parse_service_times('NC=50,*=0'), max_in_flight=2)
+        self.hsm = HSM(header='SSSS', port=0, model=self.model)
+        self.server = await self.hsm.start_server()
+        port = [sock for sock in self.server.sockets if sock.family == socket.AF_INET][0].getsockname()[1]
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def read_response(self):
+        length = await self.reader.readexactly(2)
+        return await self.reader.readexactly(int.from_bytes(length, 'big'))
+
+    async def test_responses_in_request_order(self):
+        self.writer.write(b'\x00\x06SSSSNC\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453')
+        self.assertEqual((await self.read_response())[:8], b'SSSSND00')
+        self.assertEqual((await self.read_response())[:8], b'SSSSBV00')
+
+    async def test_failed_requests_answered_in_order(self):
+        ca = b'CAU7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0103000123456789'
+        self.writer.write((4 + len(ca)).to_bytes(2, 'big') + b'SSSS' + ca + b'\x00\x06XXXXNC' + b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453')
+        self.assertEqual(await self.read_response(), b'SSSSCB15')
+        self.assertEqual(await self.read_response(), b'SSSSND15')
+        self.assertEqual((await self.read_response())[:8], b'SSSSBV00')
+
+    async def test_overload(self):
+        self.writer.write(b'\x00\x06SSSSNC' * 3)
+        self.assertEqual((await self.read_response())[:8], b'SSSSND00')
+        self.assertEqual((await self.read_response())[:8], b'SSSSND00')
+        self.assertEqual(await self.read_response(), b'SSSSND41')
+        self.assertEqual(self.model.rejected, 1)
+
+    async def test_licence_limit(self):
+        self.model.bucket = TokenBucket(rate=20)
+        self.model.service_times = {}
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.writer.write(b'\x00\x06SSSSNC' * 2)
+        await self.read_response()
+        await self.read_response()
+        self.assertGreaterEqual(loop.time() - started, 0.04)
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    def test_parse_class_limits(self):
+        self.assertEqual(parse_class_limits('health:10, auth:100,bulk:5'), {HEALTH: 10, AUTHORIZATION: 100, BULK: 5})
+        with self.assertRaisesRegex(ValueError, 'Invalid class limit'):
+            parse_class_limits('urgent:10')
+
+    def test_get_class(self):
+        scheduler = Scheduler()
+        self.assertEqual(scheduler.get_class(b'NC'), HEALTH)
+        self.assertEqual(scheduler.get_class(b'CY'), AUTHORIZATION)
+        self.assertEqual(scheduler.get_class(b'CW'), BULK)
+        self.assertEqual(scheduler.get_class(None), BULK)
+
+    async def test_priority_order(self):
+        scheduler = Scheduler(concurrency=1)
+        order = []
+
+        async def run(command_code):
+            self.assertTrue(await scheduler.acquire(command_code))
+            order.append(command_code)
+            await asyncio.sleep(0)
+            scheduler.release()
+
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        tasks = [asyncio.ensure_future(run(command_code)) for command_code in [b'CW', b'CY', b'NC']]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [b'NC', b'CY', b'CW'])
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_queue_limit(self):
+        scheduler = Scheduler(concurrency=1, queue_limits={BULK: 1})
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        queued = asyncio.ensure_future(scheduler.acquire(b'CW'))
+        await asyncio.sleep(0)
+        self.assertFalse(await scheduler.acquire(b'CW'))
+        self.assertEqual(scheduler.shed, [0, 0, 1])
+        scheduler.release()
+        self.assertTrue(await queued)
+
+    async def test_deadline(self):
+        scheduler = Scheduler(concurrency=1, deadlines={AUTHORIZATION: 0.01})
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        self.assertFalse(await scheduler.acquire(b'CY'))
+        self.assertEqual(scheduler.shed, [0, 1, 0])
+        self.assertEqual(len(scheduler.queues[AUTHORIZATION]), 0)
+        scheduler.release()
+        self.assertEqual(scheduler.running, 0)
+
+    async def test_deadline_expired_idle(self):
+        scheduler = Scheduler(concurrency=1, deadlines={AUTHORIZATION: 0.01})
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        queued = asyncio.ensure_future(scheduler.acquire(b'CY'))
+        await asyncio.sleep(0.05)
+        scheduler.release()
+        self.assertFalse(await queued)
+        self.assertTrue(await asyncio.wait_for(scheduler.acquire(b'CY'), 1))
+        self.assertEqual(scheduler.running, 1)
+
+    async def test_cancelled_waiter(self):
+        scheduler = Scheduler(concurrency=1)
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        queued = asyncio.ensure_future(scheduler.acquire(b'CY'))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(len(scheduler.queues[AUTHORIZATION]), 0)
+        scheduler.release()
+        self.assertTrue(await asyncio.wait_for(scheduler.acquire(b'CY'), 1))
+        self.assertEqual(scheduler.running, 1)
+
+    async def test_cancelled_after_slot_given(self):
+        scheduler = Scheduler(concurrency=1)
+        self.assertTrue(await scheduler.acquire(b'CW'))
+        queued = asyncio.ensure_future(scheduler.acquire(b'CY'))
+        await asyncio.sleep(0)
+        scheduler.release()
+        queued.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        self.assertEqual(scheduler.running, 0)
+
+
+class TestHSMScheduler(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        model = PerformanceModel(service_times=parse_service_times('*=20'))
+        self.scheduler = Scheduler(concurrency=1, queue_limits={BULK: 1})
+        self.hsm = HSM(header='SSSS', skip_parity=True, model=model, scheduler=self.scheduler)
+
+    async def test_health_check_first(self):
+        completed = []
+
+        async def get_response(request):
+            response = await self.hsm.get_response_async(request)
+            completed.append(response.get('Response Code'))
+            return response
+
+        tasks = [asyncio.ensure_future(get_response(request)) for request in [
+            BU(b'021UA97831862E31CCC36E854FE184EE6453'),
+            BU(b'021UA97831862E31CCC36E854FE184EE6453'),
+            NC(b''),
+        ]]
+        await asyncio.gather(*tasks)
+        self.assertEqual(completed, [b'BV', b'ND', b'BV'])
+
+    async def test_busy_error(self):
+        requests = [BU(b'021UA97831862E31CCC36E854FE184EE6453') for i in range(3)]
+        responses = await asyncio.gather(*[self.hsm.get_response_async(request) for request in requests])
+        self.assertEqual([response.get('Error Code') for response in responses], [b'00', b'00', b'41'])
+
+
+class TestPinBlockBatcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.key = bytes.fromhex('1C1EB1090681CC9E6003E05217C7077E')
+        self.other_key = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.pinblocks = [bytes([i]) * 8 for i in range(4)]
+
+    async def test_same_key_batched(self):
+        batcher = PinBlockBatcher(window=10000)
+        decrypted = await asyncio.gather(*[batcher.decrypt(self.key, pinblock) for pinblock in self.pinblocks])
+        cipher = DES3.new(self.key, DES3.MODE_ECB)
+        self.assertEqual(decrypted, [cipher.decrypt(pinblock) for pinblock in self.pinblocks])
+        self.assertEqual(batcher.batches, 1)
+        self.assertEqual(batcher.get_metrics()['mean_batch_size'], 4)
+
+    async def test_different_keys(self):
+        batcher = PinBlockBatcher(window=100)
+        decrypted = await asyncio.gather(batcher.decrypt(self.key, self.pinblocks[0]), batcher.decrypt(self.other_key, self.pinblocks[0]))
+        self.assertEqual(decrypted[1], DES3.new(self.other_key, DES3.MODE_ECB).decrypt(self.pinblocks[0]))
+        self.assertEqual(batcher.batches, 2)
+
+    async def test_max_batch_size(self):
+        batcher = PinBlockBatcher(window=10000000, max_batch_size=2)
+        await asyncio.wait_for(asyncio.gather(*[batcher.decrypt(self.key, pinblock) for pinblock in self.pinblocks]), 1)
+        metrics = batcher.get_metrics()
+        self.assertEqual(metrics['batches'], 2)
+        self.assertEqual(metrics['max_batch_size'], 2)
+        self.assertLess(metrics['max_wait_time'], 1000000)
+
+    async def test_invalid_key(self):
+        batcher = PinBlockBatcher(window=100)
+        self.assertEqual(await batcher.decrypt(bytes.fromhex('0123456789ABCDEF0123456789ABCDEF'), self.pinblocks[0]), None)
+
+
+class TestHSMPinBlockBatching(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.batcher = PinBlockBatcher(window=10000)
+        self.hsm = HSM(header='SSSS', skip_parity=True, batcher=self.batcher)
+
+    async def test_batched_responses(self):
+        data = b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0104000123456789012345678901234512345678901N'
+        requests = [DA(data + b'6068FFFFFFFF'), EA(data + b'6068FFFFFFFF'), DA(data + b'6069FFFFFFFF')]
+        responses = await asyncio.gather(*[self.hsm.get_response_async(request) for request in requests])
+        self.assertEqual([response.get('Error Code') for response in responses], [b'00', b'00', b'01'])
+        self.assertEqual(self.batcher.get_metrics()['batches'], 1)
+        self.assertEqual(requests[0].decrypted_pinblock, b'041234FEDCBA9876')
+
+    async def test_not_batched_command(self):
+        response = await self.hsm.get_response_async(NC(b''))
+        self.assertEqual(response.get('Response Code'), b'ND')
+        self.assertEqual(self.batcher.batches, 0)
+
+
+class TestClientBuilders(unittest.TestCase):
+    def parse(self, command):
+        return parse_request(command[:2], command[2:])
+
+    def test_build_a0(self):
+        request = self.parse(build_a0('1', '002', 'U', zmk='U1C1EB1090681CC9E6003E05217C7077E', zmk_flag='0'))
+        self.assertEqual(request.get('Mode'), b'1')
+        self.assertEqual(request.get('Key Type'), b'002')
+        self.assertEqual(request.get('ZMK/TMK Flag'), b'0')
+        self.assertEqual(request.get('ZMK/TMK'), b'U1C1EB1090681CC9E6003E05217C7077E')
+
+    def test_build_bu(self):
+        request = self.parse(build_bu('02', '1', 'UA97831862E31CCC36E854FE184EE6453'))
+        self.assertEqual(request.get('Key'), b'UA97831862E31CCC36E854FE184EE6453')
+
+    def test_build_ca(self):
+        request = self.parse(build_ca('UED4A35D52C9063A1ED4A35D52C9063A1', 'UD39D39EB7C932CF367C97C5B10B2C195', '12', '7DF366B86AE2D9A7', '01', '01', '552000000012'))
+        self.assertEqual(request.get('Source PIN block'), b'7DF366B86AE2D9A7')
+        self.assertEqual(request.get('Account Number'), b'552000000012')
+
+    def test_build_cw(self):
+        self.assertEqual(build_cw('U1C1EB1090681CC9E6003E05217C7077E', '4575272222567122', '2010', '000'), b'CWU1C1EB1090681CC9E6003E05217C7077E4575272222567122;2010000')
+
+    def test_build_cy(self):
+        request = self.parse(build_cy(b'U449DF1679F4A4E0695E99D921A253DCB', b'000', b'8990011234567890', b'1809', b'201'))
+        self.assertEqual(request.get('CVV'), b'000')
+        self.assertEqual(request.get('Primary Account Number'), b'8990011234567890')
+        self.assertEqual(request.get('Service Code'), b'201')
+
+    def test_build_dc(self):
+        request = self.parse(build_dc('UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '1234567890ABCDEF1234567890ABCDEF', '2AD242FD8D0DA1BA', '01', '881123456789', '1', '1234'))
+        self.assertEqual(request.get('TPK'), b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF')
+        self.assertEqual(request.get('PVV'), b'1234')
+
+    def test_build_ec(self):
+        request = self.parse(build_ec('U7C2902D82733C779680AD18C70F5A27C', '1234567890ABCDEF1234567890ABCDEF', '2AD242FD8D0DA1BA', '01', '881123456789', '1', '1234'))
+        self.assertEqual(request.get('ZPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+        self.assertEqual(request.get('Account Number'), b'881123456789')
+
+    def test_build_fa(self):
+        request = self.parse(build_fa('U1C1EB1090681CC9E6003E05217C7077E', 'X7C2902D82733C779680AD18C70F5A27C'))
+        self.assertEqual(request.get('ZPK'), b'X7C2902D82733C779680AD18C70F5A27C')
+
+    def test_build_hc(self):
+        request = self.parse(build_hc('U1234567890ABCDEF1234567890ABCDEF'))
+        self.assertEqual(request.get('Current Key'), b'U1234567890ABCDEF1234567890ABCDEF')
+        self.assertEqual(request.get('Key Scheme (LMK)'), b'U')
+
+    def test_build_nc(self):
+        self.assertEqual(self.parse(build_nc()).get_command_code(), b'NC')
+
+    def test_build_da(self):
+        request = self.parse(build_da('UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', 'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '12', '2AD242FD8D0DA1BA', '01', '04',
+            '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'))
+        self.assertEqual(request.get('TPK'), b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF')
+        self.assertEqual(request.get('PIN Validation Data'), b'8811234N6789')
+        self.assertEqual(request.get('Offset'), b'6068FFFFFFFF')
+
+    def test_build_de(self):
+        request = self.parse(build_de('UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '0412345FFFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'))
+        self.assertEqual(request.get('PIN'), b'0412345FFFFFFFFF')
+        self.assertEqual(request.get('PIN Validation Data'), b'8811234N6789')
+
+    def test_build_ea(self):
+        request = self.parse(build_ea('U7C2902D82733C779680AD18C70F5A27C', 'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '12', '2AD242FD8D0DA1BA', '01', '04',
+            '881123456789', '0123456789012345', '8811234N6789', '6068FFFFFFFF'))
+        self.assertEqual(request.get('ZPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+        self.assertEqual(request.get('Offset'), b'6068FFFFFFFF')
+
+    def test_build_ee(self):
+        request = self.parse(build_ee('UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '6068FFFFFFFF', '04', '881123456789', '0123456789012345', '8811234N6789'))
+        self.assertEqual(request.get('Offset'), b'6068FFFFFFFF')
+        self.assertEqual(request.get('Minimum PIN Length'), b'04')
+
+    def test_build_g0(self):
+        request = self.parse(build_g0('U0123456789ABCDEFFEDCBA9876543210', 'U7C2902D82733C779680AD18C70F5A27C', '906', 'FFFF9876543210E00001',
+            '1B8C0F0D9AD4E1C1', '01', '401234567890'))
+        self.assertEqual(request.get('ZPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+        self.assertEqual(request.get('KSN'), b'FFFF9876543210E00001')
+        self.assertEqual(request.get('Account Number'), b'401234567890')
+
+    def test_build_gq(self):
+        request = self.parse(build_gq('U0123456789ABCDEFFEDCBA9876543210', 'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF', '906', 'FFFF9876543210E00001',
+            '1B8C0F0D9AD4E1C1', '401234567890', '1', '1234'))
+        self.assertEqual(request.get('PVK Pair'), b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF')
+        self.assertEqual(request.get('PVV'), b'1234')
+
+    def test_build_j2_j4_j8(self):
+        self.assertEqual([build_j2(), build_j4(), build_j8()], [b'J2', b'J4', b'J8'])
+
+    def test_build_kq(self):
+        transaction_data = '00000000100000000000000008260000000000082617010100123456785800000103A0A010'
+        self.assertEqual(build_kq('1', '1', 'U827E67B59A1D6B8F1E17D0BEA17FD101', '6173900101011900', '0001', '12345678', transaction_data,
+            'A6DEE59A885EA056', arc='3030'), b'KQ11U827E67B59A1D6B8F1E17D0BEA17FD101617390010101190000011234567825' + \
+            transaction_data.encode('utf-8') + b';A6DEE59A885EA0563030')
+
+    def test_build_m0(self):
+        request = self.parse(build_m0('01', '1', '1', '00A', 'U7C2902D82733C779680AD18C70F5A27C', '0123456789ABCDEF', iv='0000000000000000'))
+        self.assertEqual(request.get('IV'), b'0000000000000000')
+        self.assertEqual(request.get('Message Length'), b'0010')
+        self.assertEqual(request.get('Message'), b'0123456789ABCDEF')
+
+    def test_build_m2(self):
+        request = self.parse(build_m2('00', '1', '1', '00A', 'U7C2902D82733C779680AD18C70F5A27C', '0123456789ABCDEF'))
+        self.assertEqual(request.get_command_code(), b'M2')
+        self.assertEqual(request.get('Message'), b'0123456789ABCDEF')
+
+    def test_build_m6(self):
+        self.assertEqual(build_m6('0', '2', '1', '3', '2', '008', 'U827E67B59A1D6B8F1E17D0BEA17FD101', 'IDDQD IDKFA IDCLIP'),
+            b'M602132008U827E67B59A1D6B8F1E17D0BEA17FD1010012IDDQD IDKFA IDCLIP')
+
+    def test_build_m8(self):
+        request = self.parse(build_m8('3', '2', '1', '3', '2', '008', 'U827E67B59A1D6B8F1E17D0BEA17FD101', 'IDDQD IDKFA IDCLIP',
+            '0123456789ABCDEF', iv='0000000000000000'))
+        self.assertEqual(request.get('IV'), b'0000000000000000')
+        self.assertEqual(request.get('Message'), b'IDDQD IDKFA IDCLIP')
+        self.assertEqual(request.get('MAC'), b'0123456789ABCDEF')
+
+    def test_build_xb(self):
+        command = build_xb([build_nc(), build_j2()])
+        self.assertEqual(command, b'XB0020002NC0002J2')
+        self.assertEqual(self.parse(command).get('Number of Commands'), b'002')
+
+    def test_build_xb_no_commands(self):
+        with self.assertRaises(ValueError):
+            build_xb([])
+
+    def test_build_xv(self):
+        request = self.parse(build_xv('U1C1EB1090681CC9E6003E05217C7077E', '4575272222567122', '2010', '000', '123'))
+        self.assertEqual(request.get('Primary Account Number'), b'4575272222567122')
+        self.assertEqual(request.get('Variants'), b'123')
+
+
+class TestFrameWriter(unittest.TestCase):
+    def test_add(self):
+        writer = FrameWriter(header=b'SSSS')
+        self.assertTrue(writer.add(b'NC'))
+        self.assertTrue(writer.add(b'J2'))
+        self.assertEqual(writer.getvalue(), b'\x00\x06SSSSNC\x00\x06SSSSJ2')
+        writer.clear()
+        self.assertEqual(writer.getvalue(), b'')
+
+    def test_buffer_full(self):
+        writer = FrameWriter()
+        self.assertTrue(writer.add(b'M0' + b'X' * 0xFFF0))
+        self.assertFalse(writer.add(b'M0' + b'X' * 0xFFF0))
+
+    def test_command_too_long(self):
+        with self.assertRaises(ValueError):
+            FrameWriter(header=b'SSSS').add(b'X' * 0xFFFF)
+
+
+class TestClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.hsm = HSM(header='SSSS', port=0)
+        server = cls.loop.run_until_complete(cls.hsm.start_server())
+        cls.port = [sock for sock in server.sockets if sock.family == socket.AF_INET][0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+
+    def test_call(self):
+        client = Client(port=self.port, header='SSSS')
+        self.assertEqual(client.call(build_nc())[:4], b'ND00')
+        self.assertEqual(len(client.connections), 1)
+        client.close()
+
+    def test_call_many(self):
+        client = Client(port=self.port, header='SSSS')
+        commands = [build_nc(), build_bu('02', '1', 'UA97831862E31CCC36E854FE184EE6453')] * 100
+        responses = client.call_many(commands, depth=16)
+        self.assertEqual([response[:2] for response in responses], [b'ND', b'BV'] * 100)
+        client.close()
+
+    def test_async_call_many(self):
+        async def call_many():
+            client = AsyncClient(port=self.port, header='SSSS', pool_size=2)
+            responses = await client.call_many([build_nc(), build_bu('02', '1', 'UA97831862E31CCC36E854FE184EE6453')] * 50)
+            connections = len(client.connections)
+            await client.close()
+            return responses, connections
+
+        responses, connections = asyncio.run(call_many())
+        self.assertEqual([response[:2] for response in responses], [b'ND', b'BV'] * 50)
+        self.assertEqual(connections, 2)
+
+
+class TestAsyncClientClosedConnection(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # The server answers NC and closes the connection, the other commands are not answered
+        async def serve_client(reader, writer):
+            length = await reader.readexactly(2)
+            data = await reader.readexactly(int.from_bytes(length, 'big'))
+            if data[4:6] == b'NC':
+                writer.write(b'\x00\x08SSSSND00')
+                await writer.drain()
+            writer.close()
+
+        self.server = await asyncio.start_server(serve_client, '127.0.0.1', 0)
+        self.client = AsyncClient(port=self.server.sockets[0].getsockname()[1], header='SSSS', pool_size=1)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.server.close()
+
+    async def test_reconnect(self):
+        self.assertEqual(await asyncio.wait_for(self.client.call(build_nc()), 5), b'ND00')
+        self.assertEqual(await asyncio.wait_for(self.client.call(build_nc()), 5), b'ND00')
+
+    async def test_pending_call_failed(self):
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(self.client.call(build_j2()), 5)
+        self.assertEqual(await asyncio.wait_for(self.client.call(build_nc()), 5), b'ND00')
+
+    async def test_send_closed(self):
+        connection = await self.client._get_connection()
+        await connection.close()
+        self.assertTrue(connection.closed)
+        with self.assertRaises(ConnectionError):
+            connection.send(build_nc())
+
+
+class TestHSMProcess(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(header='SSSS', skip_parity=True)
+
+    def test_process(self):
+        self.assertEqual(self.hsm.process(b'\x00\x06SSSSNC'), self.hsm.get_diagnostics_data().build())
+
+    def test_process_invalid_header(self):
+        self.assertEqual(self.hsm.process(b'\x00\x06XXXXNC'), b'')
+
+    def test_process_invalid_length(self):
+        self.assertEqual(self.hsm.process(b'\x00\x07SSSSNC'), b'')
+
+    def test_process_empty(self):
+        self.assertEqual(self.hsm.process(b''), b'')
+
+    def test_process_unsupported_command(self):
+        self.assertEqual(self.hsm.process(b'\x00\x06SSSSXX'), b'\x00\x08SSSSZZ00')
+
+    def test_process_failed_request(self):
+        for command, response in [
+            (b'CAU7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0103000123456789', b'CB15'),
+            (b'BU02107C2902D82733C779680AD18C70F5A27C', b'BV15'),
+            (b'CW613D213826396ED1C184D7DC81E484F74999988887777;2512101', b'CX15'),
+            (b'EC7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E01000123456789123', b'ED15'),
+        ]:
+            frame = (4 + len(command)).to_bytes(2, 'big') + b'SSSS' + command
+            self.assertEqual(self.hsm.process(frame), b'\x00\x08SSSS' + response)
+
+    def test_failed_request_counted(self):
+        command = b'CAU7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0103000123456789'
+        self.hsm.process((4 + len(command)).to_bytes(2, 'big') + b'SSSS' + command)
+        self.assertEqual(self.hsm.stats.get_commands(), {b'CA': 1})
+        self.assertEqual(self.hsm.stats.get_errors(), 1)
+
+    def test_process_many(self):
+        responses = self.hsm.process_many([b'\x00\x06SSSSNC', b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453', b'\x00\x06SSSSJ8'])
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[1][2:10], b'SSSSBV00')
+        self.assertEqual(responses[2][6:8], b'J9')
+        self.assertEqual(self.hsm.stats.get_requests(), 3)
+
+
+class TestHSMUnixSocket(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'hsm.sock')
+        self.hsm = HSM(header='SSSS', unix_path=self.path)
+        self.server = await self.hsm.start_server()
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+        self.directory.cleanup()
+
+    async def test_unix_socket(self):
+        self.writer.write(b'\x00\x06SSSSNC')
+        length = await self.reader.readexactly(2)
+        self.assertEqual((await self.reader.readexactly(int.from_bytes(length, 'big')))[:8], b'SSSSND00')
+
+    def test_get_address(self):
+        self.assertEqual(self.hsm.get_address(), 'unix socket {}'.format(self.path))
+
+
+class TestListenerHandoff(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'hsm.ctl')
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.handoff = ListenerHandoff(self.path)
+        self.handoff.listen()
+
+    def tearDown(self):
+        self.handoff.close()
+        self.listener.close()
+        self.directory.cleanup()
+
+    def test_take_over(self):
+        thread = threading.Thread(target=self.handoff.hand_over, args=(self.listener,))
+        thread.start()
+        with take_over(self.path) as listener:
+            thread.join()
+            self.assertEqual(listener.getsockname(), self.listener.getsockname())
+            self.assertEqual(listener.type, socket.SOCK_STREAM)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_no_server(self):
+        self.handoff.close()
+        with self.assertRaises(FileNotFoundError):
+            take_over(self.path)
+
+
+class TestHSMHotRestart(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'hsm.ctl')
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.address = self.listener.getsockname()
+        self.hsm = HSM(header='SSSS', listener=self.listener, control_path=self.path)
+        self.thread = threading.Thread(target=self.hsm.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hand_over_and_drain(self):
+        with socket.create_connection(self.address, timeout=5) as client:
+            client.sendall(b'\x00\x06SSSSNC')
+            self.assertEqual(client.recv(1024)[2:10], b'SSSSND00')
+
+            with take_over(self.path) as listener:
+                self.thread.join(5)
+                self.assertFalse(self.thread.is_alive())
+                self.assertTrue(self.hsm.draining)
+                # The client of the old process is disconnected once its requests are answered
+                self.assertEqual(client.recv(1024), b'')
+                self.assertEqual(listener.getsockname(), self.address)
+
+
+class TestHSMHotRestartAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'hsm.ctl')
+        self.hsm = HSM(header='SSSS', port=0, control_path=self.path)
+        self.server = await self.hsm.start_server()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        self.directory.cleanup()
+
+    async def _call(self, reader, writer):
+        writer.write(b'\x00\x06SSSSNC')
+        length = await reader.readexactly(2)
+        return await reader.readexactly(int.from_bytes(length, 'big'))
+
+    async def test_hand_over_and_drain(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.assertEqual((await self._call(reader, writer))[:8], b'SSSSND00')
+
+        listener = await asyncio.to_thread(take_over, self.path)
+        await asyncio.wait_for(self.hsm.drained, 5)
+        self.assertEqual(await reader.read(), b'')
+        writer.close()
+
+        new_hsm = HSM(header='SSSS', listener=listener)
+        new_server = await new_hsm.start_server()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            self.assertEqual((await self._call(reader, writer))[:8], b'SSSSND00')
+            writer.close()
+        finally:
+            new_server.close()
+            await new_server.wait_closed()
+
+
+class TestHSMReload(unittest.TestCase):
+    def test_reload(self):
+        hsm = HSM(memo=ResponseMemo())
+        hsm.memo.set(b'\x00\x02NC', b'\x00\x04ND00', b'NC')
+        hsm.reload(debug=True, approve_all=True)
+        self.assertTrue(hsm.debug)
+        self.assertTrue(hsm.approve_all)
+        self.assertEqual(len(hsm.memo.cache), 0)
+        hsm.reload(approve_all=False)
+        self.assertTrue(hsm.debug)
+        self.assertFalse(hsm.approve_all)
+
+
+class DatagramClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.responses = asyncio.Queue()
+
+    def datagram_received(self, data, address):
+        self.responses.put_nowait(data)
+
+
+class TestHSMDatagrams(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hsm = HSM(header='SSSS', port=0, udp=True)
+        self.server = await self.hsm.start_server()
+        port = self.server.get_extra_info('sockname')[1]
+        self.transport, self.client = await asyncio.get_running_loop().create_datagram_endpoint(DatagramClient, remote_addr=('127.0.0.1', port))
+
+    async def asyncTearDown(self):
+        self.transport.close()
+        self.server.close()
+
+    async def test_datagrams(self):
+        self.transport.sendto(b'\x00\x06SSSSNC')
+        self.assertEqual((await asyncio.wait_for(self.client.responses.get(), 5))[2:10], b'SSSSND00')
+        self.transport.sendto(b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453')
+        self.assertEqual((await asyncio.wait_for(self.client.responses.get(), 5))[2:10], b'SSSSBV00')
+
+    async def test_invalid_datagram_ignored(self):
+        self.transport.sendto(b'\x00')
+        self.transport.sendto(b'\x00\x06XXXXNC')
+        self.transport.sendto(b'\x00\x06SSSSNC')
+        self.assertEqual((await asyncio.wait_for(self.client.responses.get(), 5))[2:10], b'SSSSND00')
+        self.assertTrue(self.client.responses.empty())
+
+    def test_get_address(self):
+        self.assertEqual(self.hsm.get_address(), 'UDP port 0')
+
+
+class TestHSMSequentialDatagrams(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.hsm = HSM(header='SSSS', listener=self.listener, udp=True)
+        threading.Thread(target=self.hsm.run, daemon=True).start()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(5)
+        self.client.connect(self.listener.getsockname())
+
+    def tearDown(self):
+        self.client.close()
+
+    def call(self, command):
+        self.client.send(len(command).to_bytes(2, 'big') + command)
+        return self.client.recv(1024)[6:]
+
+    def test_failed_request_answered(self):
+        ca = b'SSSS' + build_ca('U7C2902D82733C779680AD18C70F5A27C', 'U827E67B59A1D6B8F1E17D0BEA17FD101', '12', 'FE12241291F0208E', '02', '02', '000123456789')
+        self.assertEqual(self.call(ca)[:4], b'CB15')
+        self.assertEqual(self.call(b'SSSSNC')[:4], b'ND00')
+
+
+class TestResponseMemo(unittest.TestCase):
+    def setUp(self):
+        self.memo = ResponseMemo(size=2, ttl=10)
+
+    def test_get_set(self):
+        self.assertIsNone(self.memo.get(b'request', now=0))
+        self.memo.set(b'request', b'response', b'NC', now=0)
+        self.assertEqual(self.memo.get(b'request', now=5), b'response')
+        self.assertEqual((self.memo.hits, self.memo.misses), (1, 1))
+
+    def test_expired(self):
+        self.memo.set(b'request', b'response', b'NC', now=0)
+        self.assertIsNone(self.memo.get(b'request', now=10))
+        self.assertEqual(len(self.memo.cache), 0)
+
+    def test_bounded(self):
+        for i in range(3):
+            self.memo.set(bytes([i]), b'response', b'NC', now=0)
+        self.assertIsNone(self.memo.get(bytes([0]), now=0))
+        self.assertEqual(len(self.memo.cache), 2)
+
+    def test_key_generation_excluded(self):
+        self.memo.set(b'request', b'response', b'A0', now=0)
+        self.memo.set(b'request', b'response', b'HC', now=0)
+        self.assertEqual(len(self.memo.cache), 0)
+
+    def test_excluded_commands(self):
+        memo = ResponseMemo(excluded=[b'NC'])
+        memo.set(b'request', b'response', b'NC')
+        memo.set(b'request', b'response', b'A0')
+        self.assertEqual(len(memo.cache), 0)
+
+    def test_report(self):
+        self.memo.set(b'request', b'response', b'NC', now=0)
+        self.memo.get(b'request', now=0)
+        self.assertEqual(self.memo.report(), 'Memoized responses: 1, hits: 1, misses: 0, hit rate: 100.0%')
+
+
+class TestHSMMemo(unittest.TestCase):
+    def setUp(self):
+        self.memo = ResponseMemo()
+        self.hsm = HSM(header='SSSS', skip_parity=True, memo=self.memo)
+
+    def test_repeated_request_memoized(self):
+        request = b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453'
+        response = self.hsm.process(request)
+        self.assertEqual(self.hsm.process(request), response)
+        self.assertEqual(self.memo.hits, 1)
+        self.assertEqual(self.hsm.stats.get_commands(), {b'BU': 2})
+
+    def test_key_generation_not_memoized(self):
+        request = b'\x00\x2fSSSSA0170DU;1U4EE249B7C0D842960728DF1B2EC8701EX'
+        self.assertNotEqual(self.hsm.process(request), self.hsm.process(request))
+        self.assertEqual(self.memo.hits, 0)
+
+    def test_unsupported_command_not_memoized(self):
+        self.hsm.process(b'\x00\x06SSSSXX')
+        self.assertEqual(len(self.memo.cache), 0)
+
+    def test_invalid_frame_not_memoized(self):
+        self.hsm.process(b'\x00\x06XXXXNC')
+        self.assertEqual(len(self.memo.cache), 0)
+
+
+class TestDESBlocks(unittest.TestCase):
+    def setUp(self):
+        self.keys = [bytes.fromhex(key) for key in ['133457799BBCDFF1', '0123456789ABCDEF', 'FEDCBA9876543210', '0E329232EA6D0D73']]
+        self.data = bytes.fromhex('0123456789ABCDEF' '0000000000000000' 'FFFFFFFFFFFFFFFF' '8787878787878787')
+
+    def test_encrypt_known_value(self):
+        self.assertEqual(encrypt_blocks([self.keys[0]], bytes.fromhex('0123456789ABCDEF')), bytes.fromhex('85E813540F0AB405'))
+
+    def test_encrypt_single_key(self):
+        self.assertEqual(encrypt_blocks(self.keys[1], self.data), DES.new(self.keys[1], DES.MODE_ECB).encrypt(self.data))
+
+    def test_encrypt_per_block_keys(self):
+        expected = b''.join(DES.new(key, DES.MODE_ECB).encrypt(self.data[i * 8:i * 8 + 8]) for i, key in enumerate(self.keys))
+        self.assertEqual(encrypt_blocks(self.keys, self.data), expected)
+
+    def test_decrypt_per_block_keys(self):
+        expected = b''.join(DES.new(key, DES.MODE_ECB).decrypt(self.data[i * 8:i * 8 + 8]) for i, key in enumerate(self.keys))
+        self.assertEqual(decrypt_blocks(self.keys, self.data), expected)
+
+    def test_triple_des_keys(self):
+        keys = [self.keys[i] + self.keys[i + 1] for i in range(3)] + [self.keys[3] + self.keys[0] + self.keys[1]]
+        expected = b''.join(DES3.new(key, DES3.MODE_ECB).encrypt(self.data[i * 8:i * 8 + 8]) for i, key in enumerate(keys))
+        encrypted = encrypt_blocks(keys, self.data)
+        self.assertEqual(encrypted, expected)
+        self.assertEqual(decrypt_blocks(keys, encrypted), self.data)
+
+    def test_mixed_key_lengths(self):
+        keys = [self.keys[0], self.keys[1] + self.keys[2], self.keys[2], self.keys[3] + self.keys[0]]
+        expected = b''.join((DES.new(key, DES.MODE_ECB) if len(key) == 8 else DES3.new(key, DES3.MODE_ECB)).encrypt(self.data[i * 8:i * 8 + 8]) for i, key in enumerate(keys))
+        self.assertEqual(encrypt_blocks(keys, self.data), expected)
+
+    def test_pycrypto_fallback(self):
+        numpy = des.numpy
+        des.numpy = None
+        try:
+            self.assertEqual(encrypt_blocks(self.keys, self.data), b''.join(DES.new(key, DES.MODE_ECB).encrypt(self.data[i * 8:i * 8 + 8]) for i, key in enumerate(self.keys)))
+        finally:
+            des.numpy = numpy
+
+    def test_incorrect_key_count(self):
+        with self.assertRaisesRegex(ValueError, 'Expected 4 keys but 2 are given'):
+            encrypt_blocks(self.keys[:2], self.data)
+
+    def test_incorrect_key_length(self):
+        with self.assertRaises(ValueError):
+            encrypt_blocks([b'\x00' * 7] * 4, self.data)
+
+
+class TestBatchValues(unittest.TestCase):
+    def test_get_visa_cvvs(self):
+        cards = [
+            (bytes.fromhex('0123456789ABCDEFFEDCBA9876543210'), b'4999988887777000', b'9105', b'111'),
+            (bytes.fromhex('1C1EB1090681CC9E6003E05217C7077E'), b'4575272222567122', b'2010', b'000'),
+        ]
+        self.assertEqual(get_visa_cvvs(cards), [CVV(cvk).get_cvv(pan, expiry_date, service_code) for cvk, pan, expiry_date, service_code in cards])
+
+    def test_get_visa_cvvs_empty(self):
+        self.assertEqual(get_visa_cvvs([]), [])
+
+    def test_get_visa_pvvs(self):
+        cards = [
+            (b'DEADBEEF0123456789ABCDEFDEADBEEF', b'4761739001010119', b'1', b'1234'),
+            (b'0123456789ABCDEFFEDCBA9876543210', b'4000001234562000', b'1', b'7614'),
+        ]
+        self.assertEqual(get_visa_pvvs(cards), [get_visa_pvv(account_number, pvki, pin, pvk) for pvk, account_number, pvki, pin in cards])
+
+
+class TestHSMBatchCrypto(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM()
+
+    def test_decrypt_pinblocks(self):
+        pinblocks = [(b'2B687AEFC34B1A89', b'U0123456789ABCDEFFEDCBA9876543210'), (b'FE12241291F0208E', b'U7C2902D82733C779680AD18C70F5A27C')]
+        self.assertEqual(self.hsm.decrypt_pinblocks(pinblocks), [self.hsm._decrypt_pinblock(*pinblock) for pinblock in pinblocks])
+
+    def test_generate_visa_cvvs(self):
+        cards = [(b'U1C1EB1090681CC9E6003E05217C7077E', b'4575272222567122', b'2010', b'000'), (b'0123456789ABCDEFFEDCBA9876543210', b'4999988887777000', b'9105', b'111')]
+        self.assertEqual(self.hsm.generate_visa_cvvs(cards), [self.hsm._get_cvv(cvk).get_cvv(pan, expiry_date, service_code) for cvk, pan, expiry_date, service_code in cards])
+
+
+class TestKey(unittest.TestCase):
+    def setUp(self):
+        self.key = Key(b'U0123456789ABCDEFFEDCBA9876543210')
+
+    def test_compares_equal_to_field(self):
+        self.assertEqual(self.key, b'U0123456789ABCDEFFEDCBA9876543210')
+
+    def test_scheme(self):
+        self.assertEqual(self.key.scheme, b'U')
+        self.assertEqual(Key(b'0123456789ABCDEF').scheme, b'')
+
+    def test_encoded(self):
+        self.assertEqual(self.key.encoded, b'0123456789ABCDEFFEDCBA9876543210')
+        self.assertEqual(Key(b'0123456789ABCDEF').encoded, b'0123456789ABCDEF')
+
+    def test_raw(self):
+        self.assertEqual(self.key.raw, bytes.fromhex('0123456789ABCDEFFEDCBA9876543210'))
+
+    def test_raw_invalid(self):
+        with self.assertRaises(ValueError):
+            Key(b'UXYZ').raw
+
+    def test_from_raw(self):
+        key = Key.from_raw(bytes.fromhex('0123456789ABCDEFFEDCBA9876543210'))
+        self.assertEqual(key, self.key)
+        self.assertEqual(key.raw, self.key.raw)
+
+    def test_as_key(self):
+        self.assertIs(as_key(self.key), self.key)
+        self.assertIsInstance(as_key(b'U0123456789ABCDEFFEDCBA9876543210'), Key)
+
+    def test_get_check_value(self):
+        self.assertEqual(get_check_value(self.key.raw, 6), key_CV(self.key.encoded, 6))
+
+
+class TestPinBlock(unittest.TestCase):
+    def test_raw(self):
+        self.assertEqual(PinBlock(b'2B687AEFC34B1A89').raw, bytes.fromhex('2B687AEFC34B1A89'))
+
+    def test_from_raw(self):
+        self.assertEqual(PinBlock.from_raw(bytes.fromhex('2b687aefc34b1a89')), b'2B687AEFC34B1A89')
+
+
+class TestTypedFields(unittest.TestCase):
+    def test_key_fields_parsed(self):
+        request = CA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0101000123456789')
+        self.assertIsInstance(request.get('TPK'), Key)
+        self.assertIsInstance(request.get('Destination Key'), Key)
+        self.assertIsInstance(request.get('Source PIN block'), PinBlock)
+        self.assertEqual(request.get('TPK'), b'U7C2902D82733C779680AD18C70F5A27C')
+
+    def test_untyped_field(self):
+        request = CA(b'U7C2902D82733C779680AD18C70F5A27CU827E67B59A1D6B8F1E17D0BEA17FD10112FE12241291F0208E0101000123456789')
+        self.assertIs(type(request.get('Account Number')), bytes)
+
+    def test_key_decrypted_once(self):
+        hsm = HSM()
+        request = M0(b'000000AU827E67B59A1D6B8F1E17D0BEA17FD1010010IDDQD IDKFA IDCL')
+        hsm.check_key_parity(request.get('Key'))
+        self.assertEqual(hsm.keys.cache[b'827E67B59A1D6B8F1E17D0BEA17FD101'].clear, hsm.cipher.decrypt(bytes.fromhex('827E67B59A1D6B8F1E17D0BEA17FD101')))
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM()
+        self.keys = KeyStore(self.hsm.cipher)
+
+    def test_key_entry(self):
+        entry = self.keys.get(b'U613D213826396ED1C184D7DC81E484F7')
+        self.assertEqual(entry.clear, bytes.fromhex('032447698BACCFF0FFDDBB9977553311'))
+        self.assertTrue(entry.parity)
+        self.assertEqual(entry.check_value, b'12CD5E')
+
+    def test_key_cached_without_scheme(self):
+        entry = self.keys.get(b'U613D213826396ED1C184D7DC81E484F7')
+        self.assertIs(self.keys.get(b'613D213826396ED1C184D7DC81E484F7'), entry)
+        self.assertEqual(len(self.keys.cache), 1)
+
+    def test_key_not_hex(self):
+        with self.assertRaises(ValueError):
+            self.keys.get(b'UXYZ')
+
+    def test_degenerate_key_cipher(self):
+        entry = self.keys.get(b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF')
+        with self.assertRaises(ValueError):
+            entry.cipher
+
+
+class TestKeyInventory(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM()
+
+    def test_read_key_inventory(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.keys', delete=False) as f:
+            f.write('# Working keys\n\nTPK U613D213826396ED1C184D7DC81E484F7\npvk pair U0123456789ABCDEFFEDCBA9876543210\n')
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(read_key_inventory(f.name), [
+            (3, 'TPK', b'U613D213826396ED1C184D7DC81E484F7'),
+            (4, 'PVK PAIR', b'U0123456789ABCDEFFEDCBA9876543210'),
+        ])
+
+    def test_warm_up(self):
+        self.assertEqual(self.hsm.warm_up([(1, 'TPK', b'U613D213826396ED1C184D7DC81E484F7'), (2, 'CVK', b'613D213826396ED1C184D7DC81E484F7')]), [])
+        entry = self.hsm.keys.cache[b'613D213826396ED1C184D7DC81E484F7']
+        self.assertEqual(entry.check_value, b'12CD5E')
+        self.assertIsNotNone(self.hsm.cvks.get(b'613D213826396ED1C184D7DC81E484F7'))
+
+    def test_warm_up_invalid_keys(self):
+        invalid = self.hsm.warm_up([
+            (1, 'XYZ', b'U613D213826396ED1C184D7DC81E484F7'),
+            (2, 'ZPK', b'UXYZ'),
+            (3, 'ZPK', b'U0123'),
+            (4, 'ZPK', b'U0123456789ABCDEFFEDCBA9876543210'),
+        ])
+        self.assertEqual([(line_number, reason) for line_number, key_type, key, reason in invalid], [
+            (1, 'Unknown key type'),
+            (2, 'Key is not hex-encoded'),
+            (3, 'Invalid key length'),
+            (4, 'Key parity error'),
+        ])
+
+    def test_warm_up_degenerate_key(self):
+        hsm = HSM(skip_parity=True)
+        invalid = hsm.warm_up([(7, 'ZPK', b'UDEADBEEFDEADBEEFDEADBEEFDEADBEEF')])
+        self.assertEqual(len(invalid), 1)
+        self.assertEqual(invalid[0][0], 7)
+
+    def test_warmed_up_key_used_by_request(self):
+        self.hsm.warm_up([(1, 'TPK', b'U613D213826396ED1C184D7DC81E484F7')])
+        entry = self.hsm.keys.cache[b'613D213826396ED1C184D7DC81E484F7']
+        self.assertTrue(self.hsm.check_key_parity(b'U613D213826396ED1C184D7DC81E484F7'))
+        self.assertIs(self.hsm.keys.get(b'U613D213826396ED1C184D7DC81E484F7'), entry)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
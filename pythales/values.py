@@ -0,0 +1,98 @@
+from binascii import hexlify, unhexlify
+
+from Crypto.Cipher import DES3
+
+
+# Key scheme tags preceding the hex-encoded keys
+KEY_SCHEMES = [b'U', b'T', b'X', b'Y', b'Z']
+
+
+class HexValue(bytes):
+    """
+    Hex-encoded field value. The value is the field as it appears in the message, so it compares equal to the field bytes
+    and is written to the response as is. The raw binary value is decoded once, on the first access.
+    """
+    @classmethod
+    def from_raw(cls, raw, prefix=b''):
+        """
+        Get the value encoded from the raw binary value
+        """
+        value = cls(prefix + hexlify(raw).upper())
+        value._raw = bytes(raw)
+        return value
+
+
+    @property
+    def encoded(self):
+        """
+        Get the hex-encoded value
+        """
+        return bytes(self)
+
+
+    @property
+    def raw(self):
+        """
+        Get the raw binary value
+        """
+        try:
+            return self._raw
+        except AttributeError:
+            self._raw = unhexlify(self.encoded)
+            return self._raw
+
+
+class Key(HexValue):
+    """
+    Key field value: the key scheme tag (e.g. U for the double length key) followed by the hex-encoded key.
+    The clear keys are kept in the key store of the HSM (pythales.keys.KeyStore)
+    """
+    @classmethod
+    def from_raw(cls, raw, scheme=b'U'):
+        """
+        Get the key encoded from the raw binary key, with the key scheme tag
+        """
+        return super().from_raw(raw, scheme)
+
+
+    @property
+    def scheme(self):
+        """
+        Get the key scheme tag, empty if there is none
+        """
+        return self[:1] if self[:1] in KEY_SCHEMES else b''
+
+
+    @property
+    def encoded(self):
+        """
+        Get the hex-encoded key, without the key scheme tag
+        """
+        return self[1:] if self[:1] in KEY_SCHEMES else bytes(self)
+
+
+class PinBlock(HexValue):
+    """
+    Hex-encoded PIN block
+    """
+
+
+def get_check_value(key, length=6):
+    """
+    Get the check value of the raw key: the zero block encrypted with the key, hex-encoded
+    """
+    return hexlify(DES3.new(key, DES3.MODE_ECB).encrypt(bytes(8))).upper()[:length]
+
+
+def as_key(value):
+    """
+    Get the field value as Key
+    """
+    return value if isinstance(value, Key) else Key(value)
+
+
+def as_pinblock(value):
+    """
+    Get the field value as PinBlock
+    """
+    return value if isinstance(value, PinBlock) else PinBlock(value)
@@ -28,4 +28,5 @@ setup(name='pythales',
       license='LGPLv2',
       packages=['pythales'],
       install_requires=['pycrypto', 'tracetools', 'pynblock'],
+      extras_require={'numpy': ['numpy']},
       zip_safe=True)